@@ -1,25 +1,30 @@
-import pandas as pd
-import numpy as np
-from datetime import datetime, timedelta
+# Heavy libraries (pandas, numpy, openpyxl) are imported inside the stages that
+# use them so `--help` and light runs start quickly; see benchmark_reports.py
+import os
+import re
+import json
+import math
 import random
 import string
-import os
-from openpyxl import Workbook, load_workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from openpyxl.chart import BarChart, PieChart, LineChart, Reference
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.drawing.image import Image
-from openpyxl.chart.axis import DateAxis
+import time
+import zlib
+import struct
+import heapq
+import hashlib
+import zipfile
+import argparse
+import itertools
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape as xml_escape, unescape as xml_unescape
 import warnings
 warnings.filterwarnings('ignore')
 
-# Create public folder if it doesn't exist
-public_folder = os.path.join(os.path.dirname(__file__), 'public')
-os.makedirs(public_folder, exist_ok=True)
+public_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public')
 
 # Generate synthetic data for Epic System Integration
 def generate_patient_data(num_patients=500):
     """Generate synthetic patient data"""
+    import pandas as pd
     patients = []
     for i in range(num_patients):
         mrn = f"MRN{str(i+1000000).zfill(7)}"
@@ -39,6 +44,7 @@ def generate_patient_data(num_patients=500):
 
 def generate_lab_orders(num_orders=1500):
     """Generate synthetic laboratory orders"""
+    import pandas as pd
     orders = []
     test_types = ['CBC', 'BMP', 'CMP', 'Lipid Panel', 'HbA1c', 'TSH', 'Urinalysis', 'PT/INR', 'Blood Culture', 'COVID-19 PCR']
     priorities = ['STAT', 'URGENT', 'ROUTINE']
@@ -62,27 +68,49 @@ def generate_lab_orders(num_orders=1500):
     return pd.DataFrame(orders)
 
 def generate_specimen_tracking(num_specimens=2000):
-    """Generate specimen tracking data with QR codes"""
+    """Generate specimen tracking data with QR codes
+
+    Each specimen has one reading per custody step as it moves through the
+    locations; about one in ten drifts out of the 2-8°C cold chain for a step or two.
+    """
+    import pandas as pd
     specimens = []
     locations = ['Collection Station', 'Transport', 'Lab Reception', 'Processing Area', 'Analyzer', 'Storage', 'Disposal']
 
     for i in range(num_specimens):
-        specimens.append({
+        specimen = {
             'SpecimenID': f"SPEC{str(i+3000000).zfill(8)}",
             'QRCode': ''.join(random.choices(string.ascii_uppercase + string.digits, k=12)),
             'OrderID': f"ORD{str(random.randint(2000000, 2001499)).zfill(8)}",
             'TubeType': random.choice(['EDTA', 'SST', 'Heparin', 'Citrate', 'Urine Cup']),
             'Volume': round(random.uniform(1.0, 10.0), 1),
-            'CollectedBy': f"TECH_{random.randint(100,999)}",
-            'CurrentLocation': random.choice(locations),
-            'Temperature': round(random.uniform(2.0, 8.0), 1),
-            'ChainOfCustody': random.randint(1, 10),
-            'Timestamp': datetime.now() - timedelta(hours=random.randint(0, 168))
-        })
+            'CollectedBy': f"TECH_{random.randint(100,999)}"
+        }
+        steps = random.randint(1, len(locations))
+        excursion = random.randrange(steps - 1) if steps > 1 and random.random() < 0.1 else None
+        excursion_steps = random.randint(1, 2)
+        warm = random.random() < 0.8
+        timestamp = datetime.now() - timedelta(hours=random.randint(0, 168))
+        readings = []
+        for step in reversed(range(steps)):
+            if excursion is not None and excursion <= step < excursion + excursion_steps:
+                temperature = random.uniform(8.5, 15.0) if warm else random.uniform(-2.0, 1.5)
+            else:
+                temperature = random.uniform(2.0, 8.0)
+            readings.append({
+                **specimen,
+                'CurrentLocation': locations[step],
+                'Temperature': round(temperature, 1),
+                'ChainOfCustody': step + 1,
+                'Timestamp': timestamp
+            })
+            timestamp -= timedelta(minutes=random.randint(5, 120))
+        specimens.extend(reversed(readings))
     return pd.DataFrame(specimens)
 
 def generate_test_results(num_results=3000):
     """Generate test results data"""
+    import pandas as pd
     results = []
     result_statuses = ['Normal', 'Abnormal', 'Critical', 'Pending Review']
 
@@ -103,6 +131,7 @@ def generate_test_results(num_results=3000):
 
 def generate_sync_logs(num_logs=5000):
     """Generate synchronization logs"""
+    import pandas as pd
     logs = []
     sync_types = ['PATIENT_DEMOGRAPHICS', 'LAB_ORDERS', 'TEST_RESULTS', 'SPECIMEN_STATUS', 'INSURANCE_INFO']
     sync_statuses = ['SUCCESS', 'FAILED', 'PARTIAL', 'RETRY', 'TIMEOUT']
@@ -125,6 +154,7 @@ def generate_sync_logs(num_logs=5000):
 
 def generate_performance_metrics(num_days=30):
     """Generate daily performance metrics"""
+    import pandas as pd
     metrics = []
     base_date = datetime.now() - timedelta(days=num_days)
 
@@ -144,341 +174,1933 @@ def generate_performance_metrics(num_days=30):
         })
     return pd.DataFrame(metrics)
 
+# Deflate levels of saved workbooks: internal intermediates such as
+# input-report.xlsx favour speed, client downloads favour size
+INTERMEDIATE_COMPRESSLEVEL = 1
+DOWNLOAD_COMPRESSLEVEL = 9
+# Parts are deflated in blocks of this size on all cores. As in pigz, every block
+# is primed with the 32 KiB before it and ends byte-aligned, so the joined blocks
+# form one ordinary deflate stream that compresses about as well as a serial one.
+DEFLATE_BLOCK_SIZE = 1 << 20
+DEFLATE_WINDOW = 1 << 15
+# Below this many bytes, or on a single core, the thread pool costs more than it
+# saves and packages go through zipfile's serial deflate
+PARALLEL_DEFLATE_MIN_BYTES = 4 * DEFLATE_BLOCK_SIZE
+
+def _deflate_block(data, start, compresslevel):
+    """Raw deflate of the block of `data` at `start`, continuing the blocks before it"""
+    end = min(start + DEFLATE_BLOCK_SIZE, len(data))
+    primer = {'zdict': data[max(start - DEFLATE_WINDOW, 0):start]} if start else {}
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, **primer)
+    return compressor.compress(data[start:end]) + compressor.flush(zlib.Z_FINISH if end == len(data) else zlib.Z_SYNC_FLUSH)
+
+def write_zip_parts(parts, filepath, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Write package parts (name -> bytes) to a deflated zip, compressing blocks in parallel
+
+    zlib releases the GIL while compressing, so a thread pool keeps every core
+    busy. Small packages, single-core hosts and packages that need zip64
+    headers go through zipfile instead.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    size = sum(map(len, parts.values()))
+    if ((os.cpu_count() or 1) < 2 or size < PARALLEL_DEFLATE_MIN_BYTES
+            or len(parts) >= zipfile.ZIP_FILECOUNT_LIMIT or size >= zipfile.ZIP64_LIMIT):
+        with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as archive:
+            for name, data in parts.items():
+                archive.writestr(name, data)
+        return
+
+    year, month, day, hour, minute, second = time.localtime()[:6]
+    dos_time, dos_date = hour << 11 | minute << 5 | second // 2, (year - 1980) << 9 | month << 5 | day
+    central = []
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor, open(filepath, 'wb') as f:
+        blocks = {name: [executor.submit(_deflate_block, memoryview(data), start, compresslevel)
+                         for start in range(0, len(data) or 1, DEFLATE_BLOCK_SIZE)]
+                  for name, data in parts.items()}
+        for name, data in parts.items():
+            compressed = b''.join(block.result() for block in blocks[name])
+            encoded = name.encode()
+            entry = struct.pack('<HHHHHIIIHH', 20, 0, zipfile.ZIP_DEFLATED, dos_time, dos_date,
+                                zlib.crc32(data), len(compressed), len(data), len(encoded), 0)
+            central.append(b'PK\x01\x02' + struct.pack('<H', 20) + entry +
+                           struct.pack('<HHHII', 0, 0, 0, 0, f.tell()) + encoded)
+            f.write(b'PK\x03\x04' + entry + encoded)
+            f.write(compressed)
+        offset = f.tell()
+        f.write(b''.join(central))
+        f.write(b'PK\x05\x06' + struct.pack('<HHHHIIH', 0, 0, len(central), len(central),
+                                             f.tell() - offset, offset, 0))
+
+def stream_workbook(wb, filepath, compresslevel=INTERMEDIATE_COMPRESSLEVEL):
+    """Save an openpyxl workbook as wb.save() does, part by part straight into the
+    file, but at the given deflate level; for raw exports of unbounded size"""
+    from openpyxl.writer.excel import ExcelWriter
+    ExcelWriter(wb, zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True,
+                                    compresslevel=compresslevel)).save()
+
+def save_workbook(wb, filepath, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Save an openpyxl workbook with write_zip_parts rather than wb.save()'s serial deflate
+
+    The whole package is held in memory, so this is only for reports, whose
+    size is bounded; raw exports go through stream_workbook.
+    """
+    import io
+    from openpyxl.writer.excel import ExcelWriter
+    buffer = io.BytesIO()
+    ExcelWriter(wb, zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED)).save()
+    with zipfile.ZipFile(buffer) as archive:
+        parts = {info.filename: archive.read(info) for info in archive.infolist()}
+    write_zip_parts(parts, filepath, compresslevel)
+
+# Excel caps every sheet at 1,048,576 rows including the header
+EXCEL_MAX_ROWS = 1048576
+MANIFEST_SHEET = 'MANIFEST'
+
+def _frame_rows(df, chunk_size=100000):
+    """Yield DataFrame rows as plain tuples with missing values blanked"""
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        yield from chunk.itertuples(index=False, name=None)
+
+def write_sharded_excel(tables, filepath, max_rows=EXCEL_MAX_ROWS, compresslevel=INTERMEDIATE_COMPRESSLEVEL,
+                        columns=None):
+    """Stream tables into a workbook, continuing oversized tables on extra sheets
+
+    `tables` maps a table name to a DataFrame or an iterable of DataFrame chunks.
+    Rows are written as they arrive; when a sheet fills up it is renamed to
+    TABLE_1 and the table continues on TABLE_2, TABLE_3, ... A MANIFEST sheet
+    records the shards of every table so readers can reassemble them.
+
+    `columns` optionally maps a table to its column names so a chunk iterator
+    that yields nothing still gets a header-only sheet and a 0-row shard.
+    """
+    import pandas as pd
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    manifest = []
+
+    for table, frames in tables.items():
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+
+        shards = []
+        ws = None
+        first_row = 0
+        header = list((columns or {}).get(table, []))
+        for df in frames:
+            header = list(df.columns)
+            for values in _frame_rows(df):
+                if ws is None or shards[-1]['Rows'] == max_rows - 1:
+                    part = len(shards) + 1
+                    if part == 2:
+                        ws.title = f"{table}_1"
+                        shards[0]['Sheet'] = ws.title
+                    ws = wb.create_sheet(table if part == 1 else f"{table}_{part}")
+                    ws.append(list(df.columns))
+                    shards.append({'Table': table, 'Sheet': ws.title, 'Part': part,
+                                   'FirstRow': first_row, 'Rows': 0})
+                ws.append(values)
+                shards[-1]['Rows'] += 1
+                first_row += 1
+
+        if ws is None:  # Keep empty tables readable with just a header row
+            ws = wb.create_sheet(table)
+            ws.append(header)
+            shards.append({'Table': table, 'Sheet': table, 'Part': 1,
+                           'FirstRow': 0, 'Rows': 0})
+
+        manifest.extend(shards)
+
+    ws = wb.create_sheet(MANIFEST_SHEET)
+    ws.append(['Table', 'Sheet', 'Part', 'FirstRow', 'Rows'])
+    for shard in manifest:
+        ws.append([shard['Table'], shard['Sheet'], shard['Part'], shard['FirstRow'], shard['Rows']])
+
+    stream_workbook(wb, filepath, compresslevel)
+    return manifest
+
+def read_raw_manifest(excel_file):
+    """Map each raw table to its shard sheets in order"""
+    if MANIFEST_SHEET not in excel_file.sheet_names:
+        # Workbooks written before sharding hold one table per sheet
+        return {sheet: [sheet] for sheet in excel_file.sheet_names}
+
+    manifest = excel_file.parse(MANIFEST_SHEET).sort_values('Part', kind='stable')
+    return {table: list(group['Sheet']) for table, group in manifest.groupby('Table', sort=False)}
+
+def iter_raw_table(excel_file, manifest, table, **kwargs):
+    """Stream a raw table one shard sheet at a time"""
+    for sheet in manifest[table]:
+        yield excel_file.parse(sheet, **kwargs)
+
+def generate_raw_tables():
+    """Generate every raw table, keyed by its sheet name in the input file"""
+    return {
+        'RAW_PATIENTS': generate_patient_data(),
+        'RAW_ORDERS': generate_lab_orders(),
+        'RAW_SPECIMENS': generate_specimen_tracking(),
+        'RAW_RESULTS': generate_test_results(),
+        'SYNC_LOGS': generate_sync_logs(),
+        'PERF_METRICS': generate_performance_metrics()
+    }
+
 # Create raw input Excel file
-def create_raw_excel():
+def create_raw_excel(tables=None):
     """Create the raw input Excel file with multiple sheets of complex data"""
     filepath = os.path.join(public_folder, 'input-report.xlsx')
+    os.makedirs(public_folder, exist_ok=True)
 
-    with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-        # Generate and write all data sheets
-        generate_patient_data().to_excel(writer, sheet_name='RAW_PATIENTS', index=False)
-        generate_lab_orders().to_excel(writer, sheet_name='RAW_ORDERS', index=False)
-        generate_specimen_tracking().to_excel(writer, sheet_name='RAW_SPECIMENS', index=False)
-        generate_test_results().to_excel(writer, sheet_name='RAW_RESULTS', index=False)
-        generate_sync_logs().to_excel(writer, sheet_name='SYNC_LOGS', index=False)
-        generate_performance_metrics().to_excel(writer, sheet_name='PERF_METRICS', index=False)
+    # Generate (unless already generated), stream all data sheets and keep a partitioned copy
+    tables = tables if tables is not None else generate_raw_tables()
+    write_sharded_excel(tables, filepath)
+    write_dataset(tables)
 
     print(f"Raw input file created: {filepath}")
     return filepath
 
-# Create human-friendly report
-def create_friendly_report():
-    """Create the human-friendly Excel report with charts and formatted data"""
-    # First, read the raw data
-    raw_file = os.path.join(public_folder, 'input-report.xlsx')
-
-    # Read all sheets
-    patients_df = pd.read_excel(raw_file, sheet_name='RAW_PATIENTS')
-    orders_df = pd.read_excel(raw_file, sheet_name='RAW_ORDERS')
-    specimens_df = pd.read_excel(raw_file, sheet_name='RAW_SPECIMENS')
-    results_df = pd.read_excel(raw_file, sheet_name='RAW_RESULTS')
-    sync_logs_df = pd.read_excel(raw_file, sheet_name='SYNC_LOGS')
-    performance_df = pd.read_excel(raw_file, sheet_name='PERF_METRICS')
-
-    # Create workbook
-    wb = Workbook()
-
-    # Define styles
-    header_font = Font(bold=True, color="FFFFFF", size=12)
-    header_fill = PatternFill(start_color="2E75B6", end_color="2E75B6", fill_type="solid")
-    title_font = Font(bold=True, size=16, color="2E75B6")
-    subtitle_font = Font(bold=True, size=14, color="4472C4")
-    data_border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                        top=Side(style='thin'), bottom=Side(style='thin'))
-
-    # Sheet 1: Executive Summary
-    ws1 = wb.active
-    ws1.title = "Executive Summary"
-    ws1['A1'] = "Epic System Integration - Laboratory Management Dashboard"
-    ws1['A1'].font = title_font
-    ws1.merge_cells('A1:F1')
-
-    ws1['A3'] = "Report Generated:"
-    ws1['B3'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    ws1['B3'].font = Font(italic=True)
+# Partitioned copy of the raw tables that reports read from. Every table is split
+# by tenant (where it has one, own or inherited) and day (where rows are events;
+# patients are a register, so `since` leaves their totals alone) into
+#   raw-dataset/<TABLE>/TenantID=<tenant>/date=<day>/part-<n>.csv
+# and manifest.json records each file's keys, row count and numeric column sums,
+# so readers prune partitions by filter and per-tenant totals need no data scan.
+dataset_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'raw-dataset')
+DATASET_MANIFEST = 'manifest.json'
+# Bump whenever partitioning changes so existing datasets are rebuilt
+DATASET_VERSION = 3
+DATASET_PARTITIONS = {
+    'RAW_PATIENTS': {'tenant': 'TenantID'},
+    'RAW_ORDERS': {'tenant': 'TenantID', 'date': 'OrderDateTime'},
+    'RAW_SPECIMENS': {'tenant': 'TenantID', 'date': 'Timestamp'},
+    'RAW_RESULTS': {'tenant': 'TenantID', 'date': 'ResultDateTime'},
+    'SYNC_LOGS': {'tenant': 'TenantID', 'date': 'Timestamp'},
+    'PERF_METRICS': {'date': 'Date'}
+}
+# Tables without a TenantID of their own inherit it from the row they reference:
+# table -> (referencing column, referenced table). PERF_METRICS has no tenant.
+TENANT_LINKS = {
+    'RAW_ORDERS': ('MRN', 'RAW_PATIENTS'),
+    'RAW_SPECIMENS': ('OrderID', 'RAW_ORDERS'),
+    'RAW_RESULTS': ('OrderID', 'RAW_ORDERS')
+}
+
+def derive_tenants(tables):
+    """Add TenantID to the TENANT_LINKS tables, looked up through the row each row references
+
+    `tables` maps a table name to a DataFrame or an iterable of DataFrame chunks,
+    with referenced tables first. Chunks stay lazy: only the key -> tenant maps
+    of referenced tables are kept, filled as their chunks are consumed. Rows
+    whose reference is unknown get the tenant 'unknown'.
+    """
+    import pandas as pd
+    keys = {parent: column for column, parent in TENANT_LINKS.values()}  # same name in both tables
+    lookups = {}
+
+    def with_tenant(table, df):
+        if table in TENANT_LINKS and 'TenantID' not in df:
+            column, parent = TENANT_LINKS[table]
+            df = df.assign(TenantID=df[column].map(lookups.get(parent, {})).fillna('unknown'))
+        if table in keys:
+            lookups.setdefault(table, {}).update(zip(df[keys[table]], df['TenantID']))
+        return df
+
+    def chunks(table, frames):
+        for df in frames:
+            yield with_tenant(table, df)
+
+    return {table: with_tenant(table, frames) if isinstance(frames, pd.DataFrame) else chunks(table, frames)
+            for table, frames in tables.items()}
+
+def _partition_keys(table, df):
+    """Tenant and day of every row of a table, as the partition key columns"""
+    import pandas as pd
+    spec = DATASET_PARTITIONS[table]
+    keys = pd.DataFrame(index=df.index)
+    if 'tenant' in spec:
+        keys['tenant'] = df[spec['tenant']].astype(str)
+    if 'date' in spec:
+        keys['date'] = pd.to_datetime(df[spec['date']], errors='coerce').dt.strftime('%Y-%m-%d').fillna('unknown')
+    return keys
+
+def partition_stats(table, df):
+    """Manifest entries for the partitions of a table chunk: keys, rows and numeric column sums"""
+    keys = _partition_keys(table, df)
+    numeric = list(df.select_dtypes('number').columns)
+    grouped = df[numeric].groupby([keys[column] for column in keys.columns], sort=True)
+    stats = grouped.sum().assign(_rows=grouped.size()).reset_index()
+    return [
+        {'table': table, **{column: record[column] for column in keys.columns}, 'rows': record['_rows'],
+         'sums': {column: record[column] for column in numeric}}
+        for record in stats.to_dict('records')
+    ]
 
-    # Key Metrics Summary
-    ws1['A5'] = "KEY PERFORMANCE INDICATORS"
-    ws1['A5'].font = subtitle_font
-    ws1.merge_cells('A5:F5')
+def dataset_manifest(tables):
+    """Manifest of in-memory tables (after derive_tenants), as write_dataset would record it"""
+    return {'partitions': [entry for table, df in tables.items() for entry in partition_stats(table, df)]}
+
+def write_dataset(tables, folder=dataset_folder):
+    """Write tables as tenant/day partitions plus their manifest
+
+    `tables` maps a table name to a DataFrame or an iterable of DataFrame chunks;
+    each chunk adds one file per partition it touches, so ingest stays streaming.
+    """
+    import shutil
+    import pandas as pd
+    manifest = {'version': DATASET_VERSION, 'schema': {}, 'partitions': []}
+    for table, frames in derive_tenants(tables).items():
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+        shutil.rmtree(os.path.join(folder, table), ignore_errors=True)
+
+        for chunk_idx, df in enumerate(frames):
+            manifest['schema'][table] = {
+                'columns': list(df.columns),
+                'dates': [column for column in df.columns if pd.api.types.is_datetime64_any_dtype(df[column])]
+            }
+            keys = _partition_keys(table, df)
+            groups = df.groupby([keys[column] for column in keys.columns], sort=True)
+            for entry, (_, part) in zip(partition_stats(table, df), groups):
+                segments = [f"{DATASET_PARTITIONS[table]['tenant']}={entry['tenant']}"] if 'tenant' in entry else []
+                if 'date' in entry:
+                    segments.append(f"date={entry['date']}")
+                entry['path'] = '/'.join([table, *segments, f"part-{chunk_idx}.csv"])
+                os.makedirs(os.path.dirname(os.path.join(folder, entry['path'])), exist_ok=True)
+                part.to_csv(os.path.join(folder, entry['path']), index=False)
+                manifest['partitions'].append(entry)
+
+    # Replace the manifest in one step so readers never see a partial one
+    manifest_path = os.path.join(folder, DATASET_MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+def ingest_raw_excel(raw_file, folder=dataset_folder):
+    """Partition an existing input workbook, one shard sheet at a time"""
+    import pandas as pd
+    with pd.ExcelFile(raw_file) as excel_file:
+        manifest = read_raw_manifest(excel_file)
+        tables = {table: iter_raw_table(excel_file, manifest, table)
+                  for table in manifest if table in DATASET_PARTITIONS}
+        return write_dataset(tables, folder)
+
+def read_dataset_manifest(folder=dataset_folder):
+    with open(os.path.join(folder, DATASET_MANIFEST)) as f:
+        return json.load(f)
+
+def prune_manifest(manifest, tenants=None, since=None):
+    """Keep only the partitions that can hold rows for the given tenants and days
+
+    Tables without a tenant (PERF_METRICS) are not pruned by tenant, and their
+    figures are labelled as covering all tenants; tables without a day
+    (RAW_PATIENTS) are not pruned by `since`.
+    """
+    def keep(entry):
+        if tenants is not None and 'tenant' in entry and entry['tenant'] not in tenants:
+            return False
+        return since is None or 'date' not in entry or (entry['date'] != 'unknown' and entry['date'] >= since)
+    return {**manifest, 'partitions': [entry for entry in manifest['partitions'] if keep(entry)]}
+
+def filter_table(table, df, tenants=None, since=None):
+    """Row-level equivalent of prune_manifest for tables held in memory"""
+    import pandas as pd
+    if tenants is None and since is None:
+        return df
+    keys = _partition_keys(table, df)
+    mask = pd.Series(True, index=df.index)
+    if since is not None and 'date' in keys:
+        mask &= keys['date'].ne('unknown') & keys['date'].ge(since)
+    if tenants is not None and 'tenant' in keys:
+        mask &= keys['tenant'].isin(tenants)
+    return df[mask]
+
+def read_dataset_table(manifest, table, columns=None, folder=dataset_folder, deadline=None, seed=0):
+    """Read the listed partitions of a table, parsing only the columns asked for
+
+    With a `deadline` (a time.perf_counter() value) partitions are read in
+    random order until it passes, at least one, so previews get a sample of
+    whole tenant-days without loading the full table.
+    """
+    import numpy as np
+    import pandas as pd
+    schema = manifest['schema'][table]
+    dates = [column for column in schema['dates'] if columns is None or column in columns]
+    entries = [entry for entry in manifest['partitions'] if entry['table'] == table]
+    if deadline is not None:
+        entries = [entries[position] for position in np.random.default_rng(seed).permutation(len(entries))]
+    frames = []
+    for entry in entries:
+        if deadline is not None and frames and time.perf_counter() >= deadline:
+            break
+        frames.append(pd.read_csv(os.path.join(folder, entry['path']), usecols=columns, parse_dates=dates))
+    if not frames:
+        empty = pd.DataFrame(columns=columns if columns is not None else schema['columns'])
+        return empty.astype({column: 'datetime64[ns]' for column in dates})
+    return pd.concat(frames, ignore_index=True)
+
+def tenant_totals(manifest):
+    """Patient count and records processed per tenant from partition statistics alone"""
+    import pandas as pd
+    patients, records = {}, {}
+    for entry in manifest['partitions']:
+        if entry['table'] == 'RAW_PATIENTS':
+            patients[entry['tenant']] = patients.get(entry['tenant'], 0) + entry['rows']
+        elif entry['table'] == 'SYNC_LOGS':
+            records[entry['tenant']] = records.get(entry['tenant'], 0) + entry['sums'].get('RecordsProcessed', 0)
+    tenant_summary = pd.DataFrame({'Tenant': list(patients), 'Patient Count': list(patients.values())})
+    tenant_summary['Records Processed'] = tenant_summary['Tenant'].map(records)
+    tenant_summary = tenant_summary.sort_values(['Patient Count', 'Tenant'], ascending=[False, True], ignore_index=True)
+    tenant_summary['Avg Records/Patient'] = (tenant_summary['Records Processed'] / tenant_summary['Patient Count']).round(1)
+    return tenant_summary
+
+# Chart series are rolled up and downsampled to keep written cells and chart points bounded
+CHART_MAX_POINTS = 365
+ROLLUP_GRANULARITIES = ['hour', 'day', 'week', 'month']
+ROLLUP_LABEL_FORMATS = {'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d', 'week': '%Y-%m-%d', 'month': '%Y-%m'}
+
+def _floor_timestamps(timestamps, granularity):
+    """Truncate timestamps to the start of their hour, day, week (Monday) or month"""
+    import pandas as pd
+    timestamps = pd.DatetimeIndex(timestamps)
+    if granularity == 'hour':
+        return timestamps.floor('h')
+    if granularity == 'day':
+        return timestamps.normalize()
+    if granularity == 'week':
+        return timestamps.normalize() - pd.to_timedelta(timestamps.dayofweek, unit='D')
+    if granularity == 'month':
+        return timestamps.to_period('M').to_timestamp()
+    raise ValueError(f"Unknown granularity: {granularity}")
+
+def rollup_series(df, time_col, value_col=None, granularities=ROLLUP_GRANULARITIES, agg='mean'):
+    """Roll a time series up to several granularities with one pass over the rows
+
+    Rows are bucketed once at the finest requested granularity keeping sums and
+    counts; coarser levels are combined from those partials. `agg` is 'mean',
+    'sum' or 'count' (with no value_col, rows are counted).
+    """
+    import pandas as pd
+    granularities = sorted(granularities, key=ROLLUP_GRANULARITIES.index)
+    keys = _floor_timestamps(df[time_col], granularities[0])
+    if value_col is None:
+        partial = pd.DataFrame({'sum': 1, 'count': 1}, index=keys).groupby(level=0).sum()
+    else:
+        partial = df[value_col].groupby(keys).agg(['sum', 'count'])
+
+    rollups = {}
+    for granularity in granularities:
+        level = partial.groupby(_floor_timestamps(partial.index, granularity)).sum()
+        rollups[granularity] = level['sum'] / level['count'] if agg == 'mean' else level[agg]
+    return rollups
+
+def lttb_indices(x, y, max_points):
+    """Pick at most max_points indices with Largest-Triangle-Three-Buckets
+
+    The first and last points are kept; every bucket in between contributes the
+    point forming the largest triangle with the previous pick and the mean of
+    the next bucket, which preserves peaks and troughs of the series.
+    """
+    import numpy as np
+    n = len(y)
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.append(np.linspace(1, n - 1, max_points - 1).astype(int), n)
+    selected = np.empty(max_points, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+
+    a = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2]
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[bucket + 1] = a
+    return selected
+
+def build_chart_series(df, time_col, value_col=None, granularity='day', agg='mean', max_points=CHART_MAX_POINTS):
+    """Build a chart-ready series: rolled up, downsampled to max_points and labelled
+
+    With granularity='auto' the finest rollup that fits the point budget is used;
+    anything still over budget is reduced with LTTB. Returns a Series indexed by
+    period labels, in time order.
+    """
+    levels = ROLLUP_GRANULARITIES if granularity == 'auto' else [granularity]
+    rollups = rollup_series(df, time_col, value_col, levels, agg)
+    granularity = next((level for level in levels if len(rollups[level]) <= max_points), levels[-1])
+    series = rollups[granularity].dropna()
+
+    keep = lttb_indices(series.index.asi8, series.to_numpy(dtype=float), max_points)
+    series = series.iloc[keep]
+    series.index = series.index.strftime(ROLLUP_LABEL_FORMATS[granularity])
+    series.name = value_col or 'count'
+    return series
+
+# Results outside the reference range by more than this share of its width are critical
+CRITICAL_RANGE_MARGIN = 0.5
+_RANGE_PATTERN = (r'^\s*(?:(?P<low>-?\d+(?:\.\d+)?)\s*-\s*(?P<high>-?\d+(?:\.\d+)?)'
+                  r'|<\s*(?P<below>-?\d+(?:\.\d+)?)|>\s*(?P<above>-?\d+(?:\.\d+)?))\s*$')
+
+def evaluate_results(results_df, critical_margin=CRITICAL_RANGE_MARGIN):
+    """Parse ReferenceRange into numeric bounds and flag abnormal and critical values
+
+    Accepts "low-high", "<high" and ">low" ranges; anything else leaves the
+    result unevaluated. All operations are vectorized over the whole frame.
+    """
+    import pandas as pd
+    bounds = results_df['ReferenceRange'].astype('string').str.extract(_RANGE_PATTERN).astype(float)
+    low = bounds['low'].fillna(bounds['above'])
+    high = bounds['high'].fillna(bounds['below'])
+    value = pd.to_numeric(results_df['Value'], errors='coerce')
+
+    # One-sided ranges use the bound itself as the margin scale
+    width = (high - low).fillna(low.abs()).fillna(high.abs())
+    evaluated = results_df.assign(RangeLow=low, RangeHigh=high)
+    evaluated['Evaluable'] = value.notna() & (low.notna() | high.notna())
+    evaluated['Abnormal'] = (value < low) | (value > high)
+    evaluated['Critical'] = (value < low - critical_margin * width) | (value > high + critical_margin * width)
+    return evaluated
+
+def summarize_result_flags(evaluated):
+    """Abnormal and critical counts and rates per TestComponent in one grouped pass"""
+    summary = evaluated.groupby('TestComponent').agg(
+        results=('ResultID', 'count'),
+        evaluable=('Evaluable', 'sum'),
+        abnormal=('Abnormal', 'sum'),
+        critical=('Critical', 'sum')
+    )
+    evaluable = summary['evaluable'].where(summary['evaluable'] > 0)
+    summary['abnormal_pct'] = (summary['abnormal'] / evaluable * 100).round(1)
+    summary['critical_pct'] = (summary['critical'] / evaluable * 100).round(1)
+    summary = summary.sort_values('abnormal_pct', ascending=False).reset_index()
+    summary = summary[['TestComponent', 'results', 'evaluable', 'abnormal', 'abnormal_pct', 'critical', 'critical_pct']]
+    summary.columns = ['Component', 'Results', 'Evaluable', 'Abnormal', 'Abnormal %', 'Critical', 'Critical %']
+    return summary
+
+# t-digest compression: each sketch keeps at most about this many centroids
+TDIGEST_COMPRESSION = 200
+SYNC_LATENCY_KEYS = ['TenantID', 'SyncType', 'Direction']
+SYNC_LATENCY_QUANTILES = [0.5, 0.95, 0.99]
+SYNC_FAILURE_STATUSES = ['FAILED', 'TIMEOUT']
+
+def _tdigest_compress(means, weights, compression):
+    """Merge sorted neighbouring centroids so each spans at most one unit of the
+    k1 scale, which keeps centroids small near the tails where p99 lives"""
+    import numpy as np
+    order = np.argsort(means, kind='stable')
+    means, weights = means[order], weights[order]
+    if len(means):
+        q_left = (np.cumsum(weights) - weights) / weights.sum()
+        k = compression / np.pi * np.arcsin(2 * q_left - 1)
+        _, starts = np.unique(np.floor(k - k[0]), return_index=True)
+        weights, means = np.add.reduceat(weights, starts), np.add.reduceat(means * weights, starts)
+        means = means / weights
+    return means, weights
+
+def tdigest(values, compression=TDIGEST_COMPRESSION):
+    """Build a t-digest sketch of numeric values"""
+    import numpy as np
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    means, weights = _tdigest_compress(values, np.ones(len(values)), compression)
+    return {'means': means, 'weights': weights,
+            'min': values.min() if len(values) else np.inf,
+            'max': values.max() if len(values) else -np.inf}
+
+def merge_tdigests(digests, compression=TDIGEST_COMPRESSION):
+    """Combine sketches of disjoint chunks into one sketch of all their values"""
+    import numpy as np
+    digests = list(digests)
+    means, weights = _tdigest_compress(np.concatenate([digest['means'] for digest in digests]),
+                                       np.concatenate([digest['weights'] for digest in digests]), compression)
+    return {'means': means, 'weights': weights,
+            'min': min(digest['min'] for digest in digests),
+            'max': max(digest['max'] for digest in digests)}
+
+def tdigest_quantile(digest, q):
+    """Estimate the q-quantile(s), interpolating between centroid centres"""
+    import numpy as np
+    weights = digest['weights']
+    if not len(weights):
+        return np.full(np.shape(q), np.nan)
+    total = weights.sum()
+    centres = np.concatenate([[0], np.cumsum(weights) - weights / 2, [total]])
+    values = np.concatenate([[digest['min']], digest['means'], [digest['max']]])
+    return np.interp(np.asarray(q) * total, centres, values)
+
+def sync_latency_sketch(sync_logs, compression=TDIGEST_COMPRESSION):
+    """Partial latency summary of a chunk of SYNC_LOGS
+
+    Maps each (TenantID, SyncType, Direction) to its sync and failure counts and
+    a t-digest of Duration. Partials from chunks, shards or parallel workers are
+    combined with merge_sync_latency, so raw durations never need to be kept.
+    """
+    import pandas as pd
+    logs = sync_logs[SYNC_LATENCY_KEYS].assign(
+        Duration=pd.to_numeric(sync_logs['Duration'], errors='coerce'),
+        Failed=sync_logs['Status'].isin(SYNC_FAILURE_STATUSES))
+    return {
+        key: {'syncs': len(group), 'failures': int(group['Failed'].sum()),
+              'digest': tdigest(group['Duration'].to_numpy(), compression)}
+        for key, group in logs.groupby(SYNC_LATENCY_KEYS, sort=False)
+    }
+
+def merge_sync_latency(sketches, keys=SYNC_LATENCY_KEYS, compression=TDIGEST_COMPRESSION):
+    """Combine partial sketches, optionally rolling up to a subset of the keys"""
+    positions = [SYNC_LATENCY_KEYS.index(key) for key in keys]
+    grouped = {}
+    for sketch in sketches:
+        for key, partial in sketch.items():
+            grouped.setdefault(tuple(key[pos] for pos in positions), []).append(partial)
+    return {
+        key: {'syncs': sum(partial['syncs'] for partial in partials),
+              'failures': sum(partial['failures'] for partial in partials),
+              'digest': merge_tdigests((partial['digest'] for partial in partials), compression)}
+        for key, partials in grouped.items()
+    }
+
+def summarize_sync_latency(sketch, key_labels):
+    """Table of sync counts, failure rate and Duration percentiles per sketch key
+
+    Keys without any numeric Duration get blank percentiles.
+    """
+    import pandas as pd
+    rows = []
+    for key, partial in sorted(sketch.items()):
+        percentiles = tdigest_quantile(partial['digest'], SYNC_LATENCY_QUANTILES)
+        rows.append([*key, partial['syncs'], partial['failures'],
+                     round(partial['failures'] / partial['syncs'] * 100, 1),
+                     *[round(float(value)) if math.isfinite(value) else None for value in percentiles]])
+    labels = [f"P{round(q * 100)} (ms)" for q in SYNC_LATENCY_QUANTILES]
+    return pd.DataFrame(rows, columns=key_labels + ['Syncs', 'Failures', 'Failure %'] + labels)
+
+# Specimens must stay within this range (°C) along the whole cold chain
+SPECIMEN_TEMPERATURE_RANGE = (2.0, 8.0)
+SPECIMEN_READING_COLUMNS = ['SpecimenID', 'TubeType', 'CurrentLocation', 'Temperature', 'Timestamp']
+EXCURSION_DTYPES = {'SpecimenID': object, 'TubeType': object, 'Location': object, 'Start': 'datetime64[ns]',
+                    'Readings': int, 'PeakDeviation': float, 'Ongoing': bool, 'Minutes': float}
+
+def _excursion_runs(readings, low, high):
+    """Group readings sorted by specimen and time into excursions: runs of
+    consecutive out-of-range readings of one specimen
+
+    Returns the run of every reading (-1 when in range) and one row per run. A
+    run lasts from its first reading to the next reading back in range; runs
+    with no such reading yet are ongoing and last until their latest reading.
+    """
+    import numpy as np
+    import pandas as pd
+    if readings.empty:
+        return pd.Series(-1, index=readings.index), pd.DataFrame(columns=list(EXCURSION_DTYPES)).astype(EXCURSION_DTYPES)
+    same = readings['SpecimenID'].eq(readings['SpecimenID'].shift())
+    deviation = np.maximum(readings['Temperature'] - high, low - readings['Temperature'])
+    out = deviation.gt(0)
+    run = (out & ~(out.shift(fill_value=False) & same)).cumsum().where(out, -1)
+    back_in_range = same.shift(-1, fill_value=False) & ~out.shift(-1, fill_value=False)
+    runs = readings[out].assign(
+        Run=run[out], Deviation=deviation[out], End=readings['Timestamp'].shift(-1).where(back_in_range)[out]
+    ).groupby('Run', sort=False).agg(
+        SpecimenID=('SpecimenID', 'first'), TubeType=('TubeType', 'first'), Location=('CurrentLocation', 'first'),
+        Start=('Timestamp', 'first'), Last=('Timestamp', 'last'), End=('End', 'last'),
+        Readings=('Temperature', 'size'), PeakDeviation=('Deviation', 'max'))
+    runs['Ongoing'] = runs['End'].isna()
+    runs['Minutes'] = (runs['End'].fillna(runs['Last']) - runs['Start']).dt.total_seconds() / 60
+    return run, runs.drop(columns=['Last', 'End'])
+
+def detect_excursions(chunks, temperature_range=SPECIMEN_TEMPERATURE_RANGE):
+    """Temperature excursions in a stream of specimen readings
+
+    Yields the excursions that ended in each chunk, then those still ongoing at
+    the end of the stream. Chunks must arrive in time order per specimen, as a
+    sensor feed does; only the readings of open excursions are carried over to
+    the next chunk, so memory is bounded by the chunk size.
+    """
+    import pandas as pd
+    low, high = temperature_range
+    carry = None
+    for chunk in chunks:
+        readings = chunk[SPECIMEN_READING_COLUMNS].dropna(subset=['Temperature', 'Timestamp'])
+        if carry is not None:
+            readings = pd.concat([carry, readings], ignore_index=True)
+        readings = readings.sort_values(['SpecimenID', 'Timestamp'], kind='stable', ignore_index=True)
+        run, runs = _excursion_runs(readings, low, high)
+        carry = readings[run.isin(runs.index[runs['Ongoing']])]
+        yield runs[~runs['Ongoing']].reset_index(drop=True)
+    if carry is None:
+        carry = pd.DataFrame(columns=SPECIMEN_READING_COLUMNS)
+    yield _excursion_runs(carry, low, high)[1].reset_index(drop=True)
+
+def summarize_excursions(excursions):
+    """Excursion counts and durations per location and tube type, most minutes first"""
+    summary = excursions.groupby(['Location', 'TubeType']).agg(
+        excursions=('SpecimenID', 'size'),
+        specimens=('SpecimenID', 'nunique'),
+        ongoing=('Ongoing', 'sum'),
+        total=('Minutes', 'sum'),
+        mean=('Minutes', 'mean'),
+        longest=('Minutes', 'max'),
+        peak=('PeakDeviation', 'max')
+    )
+    summary = summary.sort_values(['total', 'excursions'], ascending=False).reset_index()
+    summary[['total', 'longest']] = summary[['total', 'longest']].round().astype(int)
+    summary[['mean', 'peak']] = summary[['mean', 'peak']].round(1)
+    summary.columns = ['Location', 'Tube Type', 'Excursions', 'Specimens', 'Ongoing', 'Total (min)', 'Avg (min)',
+                       'Longest (min)', 'Peak Deviation (°C)']
+    return summary
+
+# Preview reports are computed from a stratified sample of the raw tables sized
+# to a time budget. Counts are scaled up to the full tables and rates get 95%
+# Wilson score intervals, shown in a column after each table.
+PREVIEW_BUDGET = 5.0  # seconds
+PREVIEW_LOAD_SHARE = 0.5  # of the budget, spent reading partitions before sampling
+PREVIEW_STRATA = {'RAW_PATIENTS': ['TenantID'], 'RAW_ORDERS': ['Department'], 'SYNC_LOGS': ['TenantID']}
+# Tables sampled by whole clusters instead, so every specimen keeps all its readings
+PREVIEW_CLUSTERS = {'RAW_SPECIMENS': 'SpecimenID'}
+PREVIEW_MIN_ROWS = 1000  # smaller tables are always used whole
+PREVIEW_PILOT_ROWS = 2000
+PREVIEW_Z = 1.96
+
+def stratified_order(df, strata, seed=0):
+    """Row positions ordered by stratum, then at random"""
+    import numpy as np
+    keys = [np.random.default_rng(seed).random(len(df))]
+    if strata:
+        keys.append(df.groupby(strata, sort=True, dropna=False).ngroup().to_numpy())
+    return np.lexsort(keys)
+
+def cluster_keys(df, column, seed=0):
+    """A random key in [0, 1) per row, shared by all rows with the same `column` value"""
+    import numpy as np
+    codes = df.groupby(column, sort=False, dropna=False).ngroup().to_numpy()
+    return np.random.default_rng(seed).random(codes.max() + 1 if len(codes) else 0)[codes]
+
+def stratified_positions(order, fraction, seed=0):
+    """Proportional stratified sample of about `fraction` of the ordered rows
+
+    Every (1/fraction)-th row is taken from a random start, so each stratum keeps
+    its share of the sample even when it has fewer than 1/fraction rows.
+    """
+    import numpy as np
+    if fraction >= 1:
+        return np.arange(len(order))
+    steps = np.floor(np.arange(len(order) + 1) * fraction + np.random.default_rng(seed).random())
+    return np.sort(order[np.diff(steps) > 0])
+
+def sample_frames(frames, orders, fraction, totals):
+    """Stratified samples of the raw tables, with every table's full and sampled row counts
+
+    `orders` holds each table's stratified_order, or its cluster_keys for
+    PREVIEW_CLUSTERS tables; tables of at most PREVIEW_MIN_ROWS rows are used whole.
+    `totals` gives the full row count of tables that were only partly loaded.
+    """
+    sampled, sample = {}, {}
+    for table, df in frames.items():
+        if len(df) > PREVIEW_MIN_ROWS and table in PREVIEW_CLUSTERS:
+            df = df[orders[table] < fraction]
+        elif len(df) > PREVIEW_MIN_ROWS:
+            df = df.iloc[stratified_positions(orders[table], fraction)]
+        sampled[table] = df
+        sample[table] = {'rows': totals.get(table, len(frames[table])), 'sampled': len(df)}
+    return sampled, sample
+
+def _sample_scale(options, table):
+    """Factor from sampled to full-table counts; None unless the table was sampled"""
+    sample = (options.get('sample') or {}).get(table)
+    if sample and sample['sampled'] < sample['rows']:
+        return sample['rows'] / sample['sampled']
+    return None
+
+def rate_interval(successes, trials, z=PREVIEW_Z):
+    """Wilson score interval of a proportion, in percent"""
+    import numpy as np
+    successes, trials = np.asarray(successes, dtype=float), np.asarray(trials, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = successes / trials
+        centre = (p + z**2 / (2 * trials)) / (1 + z**2 / trials)
+        margin = z * np.sqrt(p * (1 - p) / trials + z**2 / (4 * trials**2)) / (1 + z**2 / trials)
+    return (centre - margin) * 100, (centre + margin) * 100
+
+def _interval_text(low, high):
+    if not (math.isfinite(low) and math.isfinite(high)):
+        return ''
+    # Rounding error can leave the bounds just outside 0-100; + 0.0 turns -0.0 into 0.0
+    return f"{max(low, 0.0) + 0.0:.1f}–{min(high, 100.0):.1f}"
+
+def preview_table(df, options, table, counts=None, rates=None):
+    """Scale sampled count columns up to the full table and follow the table with
+    a 95% CI column per rate, given as {rate column: (successes, trials)} where
+    each is a column name or a number. With no `counts` every value is a count.
+    Tables outside previews pass through."""
+    scale = _sample_scale(options, table)
+    if scale is None:
+        return df
+    df = df.copy()
+    for rate, (successes, trials) in (rates or {}).items():
+        low, high = rate_interval(df[successes] if isinstance(successes, str) else successes,
+                                  df[trials] if isinstance(trials, str) else trials)
+        df[f'{rate} 95% CI'] = [_interval_text(*bounds) for bounds in zip(low, high)]
+    if counts is None:
+        return (df * scale).round().astype(int)
+    df[counts] = (df[counts] * scale).round().astype(int)
+    return df
+
+def compute_nodes(order, frames, options):
+    nodes = {}
+    for name in order:
+        nodes[name] = REPORT_NODES[name]['compute'](frames, nodes, options)
+    return nodes
+
+def preview_nodes(order, frames, options, budget, totals=None):
+    """Compute the nodes from the largest stratified sample that fits in `budget` seconds
+
+    A pilot of about PREVIEW_PILOT_ROWS rows per table is timed first and the
+    sample is then grown assuming compute time is linear in the sampled rows;
+    a pilot already at least half the affordable size is kept. `totals` holds
+    the full row count per table when `frames` were only partly loaded.
+    """
+    totals = totals or {}
+    started = time.perf_counter()
+    orders = {table: cluster_keys(df, PREVIEW_CLUSTERS[table]) if table in PREVIEW_CLUSTERS
+              else stratified_order(df, [column for column in PREVIEW_STRATA.get(table, []) if column in df])
+              for table, df in frames.items() if len(df) > PREVIEW_MIN_ROWS}
+    largest = max((len(df) for df in frames.values()), default=0)
+    fraction = min(1.0, PREVIEW_PILOT_ROWS / largest) if largest else 1.0
+    while True:
+        sampled, sample = sample_frames(frames, orders, fraction, totals)
+        computing = time.perf_counter()
+        nodes = compute_nodes(order, sampled, {**options, 'sample': sample})
+        elapsed = time.perf_counter() - computing
+        remaining = budget - (time.perf_counter() - started)
+        target = min(1.0, fraction * remaining / elapsed) if elapsed > 0 else 1.0
+        if fraction >= 1 or target < 2 * fraction:
+            return nodes
+        fraction = target
+
+# Bump whenever the report layout changes so cached templates are rebuilt
+REPORT_TEMPLATE_VERSION = 7
+template_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report-templates')
+_template_cache = {}
+# Shapes include every table's row count, so batch runs see many; only the most
+# recently used templates are kept, in memory and on disk alike
+TEMPLATE_CACHE_SIZE = 32
+
+# Report nodes: each declares the raw columns it reads, the nodes it builds on
+# and how to compute its value. Sections below only name the nodes they show,
+# so shared intermediates are computed once and unused ones not at all.
+def _kpis(frames, nodes, options):
+    patients_df = frames['RAW_PATIENTS']
+    orders_df = frames['RAW_ORDERS']
+    results_df = frames['RAW_RESULTS']
+    sync_status_counts = nodes['sync_status_counts']
+
+    def scaled(count, table):
+        # Counts from sampled tables are estimates for the full table
+        return round(count * (_sample_scale(options, table) or 1))
 
     # Calculate KPIs
-    total_patients = len(patients_df)
-    total_orders = len(orders_df)
-    completed_tests = len(orders_df[orders_df['Status'] == 'RESULTED'])
-    avg_tat = performance_df['AverageTAT'].mean()
-    sync_success_rate = sync_logs_df[sync_logs_df['Status'] == 'SUCCESS'].shape[0] / len(sync_logs_df) * 100
-    critical_values_total = results_df[results_df['Status'] == 'Critical'].shape[0]
-
-    kpi_data = [
-        ['Metric', 'Value', 'Status', 'Target', 'Achievement'],
+    total_patients = scaled(len(patients_df), 'RAW_PATIENTS')
+    total_orders = scaled(len(orders_df), 'RAW_ORDERS')
+    completed_tests = scaled(len(orders_df[orders_df['Status'] == 'RESULTED']), 'RAW_ORDERS')
+    avg_tat = frames['PERF_METRICS']['AverageTAT'].mean()
+    tat_label = 'Average TAT (hours, all tenants)' if options.get('tenants') else 'Average TAT (hours)'
+    sync_success_rate = sync_status_counts.get('SUCCESS', 0) / sync_status_counts.sum() * 100
+    critical_values_total = scaled(results_df[results_df['Status'] == 'Critical'].shape[0], 'RAW_RESULTS')
+
+    sync_success_text = f'{sync_success_rate:.1f}%'
+    sync_scale = _sample_scale(options, 'SYNC_LOGS')
+    if sync_scale is not None:
+        interval = _interval_text(*rate_interval(sync_status_counts.get('SUCCESS', 0) / sync_scale,
+                                                 sync_status_counts.sum() / sync_scale))
+        sync_success_text += f' ({interval}%)'
+
+    return [
         ['Total Active Patients', f'{total_patients:,}', 'On Track', '450', f'{(total_patients/450*100):.1f}%'],
         ['Total Lab Orders', f'{total_orders:,}', 'Excellent', '1,200', f'{(total_orders/1200*100):.1f}%'],
         ['Tests Completed', f'{completed_tests:,}', 'Good', '1,000', f'{(completed_tests/1000*100):.1f}%'],
-        ['Average TAT (hours)', f'{avg_tat:.2f}', 'Good', '6.0', f'{(6/avg_tat*100):.1f}%'],
-        ['Sync Success Rate', f'{sync_success_rate:.1f}%', 'Excellent', '95%', f'{(sync_success_rate/95*100):.1f}%'],
+        [tat_label, f'{avg_tat:.2f}', 'Good', '6.0', f'{(6/avg_tat*100):.1f}%'],
+        ['Sync Success Rate', sync_success_text, 'Excellent', '95%', f'{(sync_success_rate/95*100):.1f}%'],
         ['Critical Values Reported', f'{critical_values_total:,}', 'Normal', 'N/A', 'N/A']
     ]
 
-    for row_idx, row_data in enumerate(kpi_data, start=7):
-        for col_idx, value in enumerate(row_data, start=1):
-            cell = ws1.cell(row=row_idx, column=col_idx, value=value)
-            if row_idx == 7:  # Header row
-                cell.font = header_font
-                cell.fill = header_fill
-            cell.border = data_border
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-
-    # Sheet 2: Test Volume Analysis
-    ws2 = wb.create_sheet("Test Volume Analysis")
-    ws2['A1'] = "Laboratory Test Volume Analysis"
-    ws2['A1'].font = title_font
-    ws2.merge_cells('A1:D1')
-
+def _test_summary(frames, nodes, options):
     # Group orders by test type
-    test_summary = orders_df.groupby('TestName').agg({
+    test_summary = frames['RAW_ORDERS'].groupby('TestName').agg({
         'OrderID': 'count',
         'Priority': lambda x: (x == 'STAT').sum()
     }).reset_index()
     test_summary.columns = ['Test Type', 'Total Orders', 'STAT Orders']
     test_summary['% STAT'] = (test_summary['STAT Orders'] / test_summary['Total Orders'] * 100).round(1)
-    test_summary = test_summary.sort_values('Total Orders', ascending=False)
-
-    # Write test summary
-    ws2['A3'] = "Test Type Distribution"
-    ws2['A3'].font = subtitle_font
-
-    for col_idx, header in enumerate(['Test Type', 'Total Orders', 'STAT Orders', '% STAT'], start=1):
-        cell = ws2.cell(row=5, column=col_idx, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.border = data_border
-
-    for row_idx, row in test_summary.iterrows():
-        for col_idx, value in enumerate(row, start=1):
-            cell = ws2.cell(row=row_idx+6, column=col_idx, value=value)
-            cell.border = data_border
-            if col_idx > 1:
-                cell.alignment = Alignment(horizontal='center')
-
-    # Add bar chart for test volumes
-    chart1 = BarChart()
-    chart1.title = "Test Volume by Type"
-    chart1.x_axis.title = "Test Type"
-    chart1.y_axis.title = "Number of Orders"
-    chart1.height = 10
-    chart1.width = 15
-
-    data = Reference(ws2, min_col=2, min_row=5, max_row=5+len(test_summary), max_col=2)
-    categories = Reference(ws2, min_col=1, min_row=6, max_row=5+len(test_summary))
-    chart1.add_data(data, titles_from_data=True)
-    chart1.set_categories(categories)
-    ws2.add_chart(chart1, "F5")
-
-    # Sheet 3: TAT Performance
-    ws3 = wb.create_sheet("TAT Performance")
-    ws3['A1'] = "Turnaround Time Performance"
-    ws3['A1'].font = title_font
-    ws3.merge_cells('A1:E1')
+    test_summary = preview_table(test_summary, options, 'RAW_ORDERS', ['Total Orders', 'STAT Orders'],
+                                 {'% STAT': ('STAT Orders', 'Total Orders')})
+    return test_summary.sort_values('Total Orders', ascending=False)
 
+def _dept_tat(frames, nodes, options):
     # Department TAT analysis
-    dept_tat = orders_df.groupby('Department').agg({
+    dept_tat = frames['RAW_ORDERS'].groupby('Department').agg({
         'OrderID': 'count'
     }).reset_index()
     dept_tat.columns = ['Department', 'Total Orders']
+    dept_tat = preview_table(dept_tat, options, 'RAW_ORDERS', ['Total Orders'])
     dept_tat['Avg TAT (hrs)'] = [round(random.uniform(2, 8), 2) for _ in range(len(dept_tat))]
     dept_tat['Within Target'] = [f"{random.randint(85, 99)}%" for _ in range(len(dept_tat))]
-    dept_tat = dept_tat.sort_values('Total Orders', ascending=False)
-
-    ws3['A3'] = "Department-wise TAT Analysis"
-    ws3['A3'].font = subtitle_font
+    return dept_tat.sort_values('Total Orders', ascending=False)
 
-    for col_idx, header in enumerate(['Department', 'Total Orders', 'Avg TAT (hrs)', 'Within Target'], start=1):
-        cell = ws3.cell(row=5, column=col_idx, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.border = data_border
+def _tat_trend(frames, nodes, options):
+    # Daily TAT trend, downsampled when the metrics span more days than the chart budget
+    return build_chart_series(frames['PERF_METRICS'], 'Date', 'AverageTAT', granularity='day',
+                              max_points=options['chart_max_points']).rename_axis('Date').reset_index()
 
-    for row_idx, row in dept_tat.iterrows():
-        for col_idx, value in enumerate(row, start=1):
-            cell = ws3.cell(row=row_idx+6, column=col_idx, value=value)
-            cell.border = data_border
-            if col_idx > 1:
-                cell.alignment = Alignment(horizontal='center')
-
-    # Add line chart for TAT trend
-    chart2 = LineChart()
-    chart2.title = "Daily Average TAT Trend"
-    chart2.x_axis.title = "Date"
-    chart2.y_axis.title = "TAT (hours)"
-    chart2.height = 10
-    chart2.width = 15
-
-    # Write performance metrics for chart
-    perf_start_row = 15
-    ws3['A14'] = "Daily TAT Trend"
-    ws3['A14'].font = subtitle_font
+def _location_summary(frames, nodes, options):
+    # Location distribution, as of every specimen's latest reading
+    specimens = frames['RAW_SPECIMENS'].sort_values('Timestamp', kind='stable').drop_duplicates('SpecimenID', keep='last')
+    location_summary = specimens['CurrentLocation'].value_counts().reset_index()
+    location_summary.columns = ['Location', 'Count']
+    location_summary['Percentage'] = (location_summary['Count'] / location_summary['Count'].sum() * 100).round(1)
+    return preview_table(location_summary, options, 'RAW_SPECIMENS', ['Count'],
+                         {'Percentage': ('Count', location_summary['Count'].sum())})
+
+def _specimen_excursions(frames, nodes, options):
+    # The loaded table is a single chunk; detect_excursions also streams larger feeds
+    import pandas as pd
+    return pd.concat(detect_excursions([frames['RAW_SPECIMENS']]), ignore_index=True)
+
+def _generated(frames, nodes, options):
+    generated = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    sample = options.get('sample')
+    if sample:
+        share = sum(table['sampled'] for table in sample.values()) / max(sum(table['rows'] for table in sample.values()), 1)
+        generated += f" (preview from a {share:.1%} stratified sample, counts scaled)"
+    return generated
+
+def _sync_latency_sketch(frames, nodes, options):
+    # Sketch one dataset partition (tenant and day) at a time and merge the partials
+    logs = frames['SYNC_LOGS']
+    partitions = _partition_keys('SYNC_LOGS', logs)
+    return merge_sync_latency(sync_latency_sketch(chunk)
+                              for _, chunk in logs.groupby([partitions[key] for key in partitions], sort=False))
+
+def _preview_sync_latency(summary, options):
+    return preview_table(summary, options, 'SYNC_LOGS', ['Syncs', 'Failures'], {'Failure %': ('Failures', 'Syncs')})
+
+REPORT_NODES = {
+    'generated': {
+        'compute': _generated
+    },
+    'sync_status_counts': {
+        'inputs': {'SYNC_LOGS': ['Status']},
+        'compute': lambda frames, nodes, options: preview_table(
+            frames['SYNC_LOGS']['Status'].value_counts(), options, 'SYNC_LOGS', None)
+    },
+    'kpis': {
+        'inputs': {'RAW_PATIENTS': ['MRN'], 'RAW_ORDERS': ['Status'], 'RAW_RESULTS': ['Status'],
+                   'PERF_METRICS': ['AverageTAT']},
+        'needs': ['sync_status_counts'],
+        'compute': _kpis
+    },
+    'test_summary': {
+        'inputs': {'RAW_ORDERS': ['OrderID', 'TestName', 'Priority']},
+        'compute': _test_summary
+    },
+    'dept_tat': {
+        'inputs': {'RAW_ORDERS': ['OrderID', 'Department']},
+        'compute': _dept_tat
+    },
+    'tat_trend': {
+        'inputs': {'PERF_METRICS': ['Date', 'AverageTAT']},
+        'compute': _tat_trend
+    },
+    'tat_trend_title': {
+        # PERF_METRICS has no tenant, so a tenant-filtered report says whose days these are
+        'compute': lambda frames, nodes, options: "Daily TAT Trend (all tenants)" if options.get('tenants')
+                                                  else "Daily TAT Trend"
+    },
+    'sync_summary': {
+        'inputs': {'SYNC_LOGS': ['SyncType', 'Status']},
+        'compute': lambda frames, nodes, options: preview_table(
+            frames['SYNC_LOGS'].groupby(['SyncType', 'Status']).size().unstack(fill_value=0),
+            options, 'SYNC_LOGS', None)
+    },
+    'location_summary': {
+        'inputs': {'RAW_SPECIMENS': ['SpecimenID', 'CurrentLocation', 'Timestamp']},
+        'compute': _location_summary
+    },
+    'specimen_excursions': {
+        'inputs': {'RAW_SPECIMENS': SPECIMEN_READING_COLUMNS},
+        'compute': _specimen_excursions
+    },
+    'excursion_summary': {
+        'needs': ['specimen_excursions'],
+        'compute': lambda frames, nodes, options: preview_table(
+            summarize_excursions(nodes['specimen_excursions']), options, 'RAW_SPECIMENS',
+            ['Excursions', 'Specimens', 'Ongoing', 'Total (min)'])
+    },
+    'tenant_summary': {
+        # Totals come from the dataset manifest, so no raw table is read
+        'compute': lambda frames, nodes, options: tenant_totals(options['manifest'])
+    },
+    'sync_latency_sketch': {
+        'inputs': {'SYNC_LOGS': SYNC_LATENCY_KEYS + ['Status', 'Duration', 'Timestamp']},
+        'compute': _sync_latency_sketch
+    },
+    'sync_latency': {
+        'needs': ['sync_latency_sketch'],
+        'compute': lambda frames, nodes, options: _preview_sync_latency(summarize_sync_latency(
+            nodes['sync_latency_sketch'], ['Tenant', 'Sync Type', 'Direction']), options)
+    },
+    'sync_latency_by_type': {
+        'needs': ['sync_latency_sketch'],
+        'compute': lambda frames, nodes, options: _preview_sync_latency(summarize_sync_latency(
+            merge_sync_latency([nodes['sync_latency_sketch']], keys=['SyncType']), ['Sync Type']), options)
+    },
+    'evaluated_results': {
+        'inputs': {'RAW_RESULTS': ['ResultID', 'TestComponent', 'Value', 'ReferenceRange']},
+        'compute': lambda frames, nodes, options: evaluate_results(frames['RAW_RESULTS'])
+    },
+    'result_flags': {
+        'needs': ['evaluated_results'],
+        'compute': lambda frames, nodes, options: preview_table(
+            summarize_result_flags(nodes['evaluated_results']), options, 'RAW_RESULTS',
+            ['Results', 'Evaluable', 'Abnormal', 'Critical'],
+            {'Abnormal %': ('Abnormal', 'Evaluable'), 'Critical %': ('Critical', 'Evaluable')})
+    }
+}
+
+# Report sheets are described independently of the xlsx library: a sheet is a
+# dict of styled cells keyed by (row, column), blocks of rows read lazily, merged
+# ranges, column widths and charts. A writer backend pulls the sheet's rows in
+# order through sheet_rows() and turns a list of sheets into a workbook file, so
+# each run can pick the one that suits it. With `autofit`, column widths follow
+# the longest value seen while writing.
+def new_sheet(title):
+    return {'title': title, 'cells': {}, 'blocks': [], 'merges': [], 'widths': {}, 'autofit': False, 'charts': []}
+
+def _cell_ref(ref):
+    """(row, column) of an 'A1' reference; tuples pass through"""
+    if isinstance(ref, tuple):
+        return ref
+    letters, row_idx = re.match(r'([A-Z]+)(\d+)$', ref).groups()
+    return int(row_idx), _column_index(letters)
+
+def put_cell(sheet, ref, value=None, style=None):
+    """Set a cell's value and/or add style properties; a bare call still creates it"""
+    cell = sheet['cells'].setdefault(_cell_ref(ref), {'value': None, 'style': {}})
+    if value is not None:
+        cell['value'] = value
+    if style:
+        cell['style'] = {**cell['style'], **style}
+
+def merge_cells(sheet, cell_range):
+    first, last = cell_range.split(':')
+    sheet['merges'].append((*_cell_ref(first), *_cell_ref(last)))
+    put_cell(sheet, first)
+
+def add_rows(sheet, first_row, rows, first_col=1, styles=None):
+    """Add a block of rows starting at the given corner, read only when the sheet is written
+
+    `rows` may be any iterable, e.g. a generator or DataFrame.itertuples(), and is
+    consumed once; `styles` gives one style per column of the block.
+    """
+    def block_cells():
+        for row_idx, row in enumerate(rows, start=first_row):
+            for offset, value in enumerate(row):
+                yield row_idx, first_col + offset, value, styles[offset] if styles else {}
+    sheet['blocks'].append(block_cells())
+
+def add_values(sheet, values):
+    """Add data values keyed by cell reference over the laid-out cells"""
+    cells = sorted(((*_cell_ref(ref), value, {}) for ref, value in values.items()), key=lambda cell: cell[:2])
+    sheet['blocks'].append(iter(cells))
+
+def sheet_rows(sheet, lengths=None):
+    """Yield (row, [(column, value, style), ...]) in row order
+
+    Cells and row blocks are merged as they are reached, so only one row is held
+    at a time; where they overlap, values fill blanks and styles combine. The
+    longest rendered value per column is recorded in `lengths` when given.
+    """
+    static = ((row_idx, col_idx, cell['value'], cell['style'])
+              for (row_idx, col_idx), cell in sorted(sheet['cells'].items()))
+    merged = heapq.merge(static, *sheet['blocks'], key=lambda cell: cell[:2])
+    for row_idx, row_cells in itertools.groupby(merged, key=lambda cell: cell[0]):
+        row = {}
+        for _, col_idx, value, style in row_cells:
+            if col_idx in row:
+                previous_value, previous_style = row[col_idx]
+                value = previous_value if value is None else value
+                style = {**previous_style, **style}
+            row[col_idx] = (value, style)
+        if lengths is not None:
+            for col_idx, (value, _) in row.items():
+                if value is not None:
+                    lengths[col_idx] = max(lengths.get(col_idx, 0), len(str(value)))
+        yield row_idx, [(col_idx, value, style) for col_idx, (value, style) in sorted(row.items())]
+
+def _sheet_widths(sheet, lengths):
+    """Column widths of a written sheet: fixed ones, then autofit from `lengths`"""
+    if not sheet['autofit']:
+        return sheet['widths']
+    return {**sheet['widths'], **{col_idx: _column_width(length) for col_idx, length in lengths.items()}}
+
+def add_chart(sheet, anchor, kind, series, categories, title=None, x_title=None, y_title=None,
+              height=7.5, width=15, style=None, stacked=False, titles_from_data=True):
+    """Add a 'col', 'bar', 'line' or 'pie' chart
+
+    `series` lists (first_row, column, last_row) ranges, each headed by its title
+    when `titles_from_data`; `categories` is one such range. Sizes are in cm.
+    """
+    sheet['charts'].append({'anchor': anchor, 'kind': kind, 'series': series, 'categories': categories,
+                            'title': title, 'x_title': x_title, 'y_title': y_title, 'height': height,
+                            'width': width, 'style': style, 'stacked': stacked,
+                            'titles_from_data': titles_from_data})
+
+def _openpyxl_style(style):
+    from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+    attrs = {}
+    font = {key: style[key] for key in ('bold', 'italic', 'size', 'color') if key in style}
+    if font:
+        attrs['font'] = Font(**font)
+    if 'fill' in style:
+        attrs['fill'] = PatternFill(start_color=style['fill'], end_color=style['fill'], fill_type='solid')
+    if style.get('border'):
+        side = Side(style='thin')
+        attrs['border'] = Border(left=side, right=side, top=side, bottom=side)
+    if 'align' in style or 'valign' in style:
+        attrs['alignment'] = Alignment(horizontal=style.get('align'), vertical=style.get('valign'))
+    return attrs
+
+def _openpyxl_chart(ws, chart):
+    from openpyxl.chart import BarChart, LineChart, PieChart, Reference
+    if chart['kind'] == 'pie':
+        obj = PieChart()
+    elif chart['kind'] == 'line':
+        obj = LineChart()
+    else:
+        obj = BarChart()
+        obj.type = chart['kind']
+        if chart['stacked']:
+            obj.grouping = 'stacked'
+            obj.overlap = 100
+    if chart['style'] is not None:
+        obj.style = chart['style']
+    obj.title = chart['title']
+    if chart['kind'] != 'pie':
+        obj.x_axis.title = chart['x_title']
+        obj.y_axis.title = chart['y_title']
+
+    for first_row, col_idx, last_row in chart['series']:
+        obj.add_data(Reference(ws, min_col=col_idx, min_row=first_row, max_row=last_row),
+                     titles_from_data=chart['titles_from_data'])
+    first_row, col_idx, last_row = chart['categories']
+    obj.set_categories(Reference(ws, min_col=col_idx, min_row=first_row, max_row=last_row))
+    obj.height = chart['height']
+    obj.width = chart['width']
+    ws.add_chart(obj, chart['anchor'])
+
+def write_openpyxl(sheets, filepath, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Build the whole workbook in openpyxl's object model, then save it"""
+    from copy import copy
+    from openpyxl import Workbook
+    wb = Workbook()
+    styled = {}  # style key -> style array of the first cell using it
+    for sheet_idx, sheet in enumerate(sheets):
+        ws = wb.active if sheet_idx == 0 else wb.create_sheet()
+        ws.title = sheet['title']
+        lengths = {}
+        for row_idx, row in sheet_rows(sheet, lengths):
+            for col_idx, value, style in row:
+                target = ws.cell(row=row_idx, column=col_idx, value=value)
+                if not style:
+                    continue
+                key = tuple(sorted(style.items()))
+                if key in styled:
+                    target._style = copy(styled[key])
+                else:
+                    for attr, attr_value in _openpyxl_style(style).items():
+                        setattr(target, attr, attr_value)
+                    styled[key] = target._style
+        for first_row, first_col, last_row, last_col in sheet['merges']:
+            ws.merge_cells(start_row=first_row, start_column=first_col, end_row=last_row, end_column=last_col)
+        for col_idx, width in _sheet_widths(sheet, lengths).items():
+            ws.column_dimensions[_column_letter(col_idx)].width = width
+        for chart in sheet['charts']:
+            _openpyxl_chart(ws, chart)
+    save_workbook(wb, filepath, compresslevel)
+
+def _xlsxwriter_format(workbook, formats, style):
+    """Shared xlsxwriter format for a style, created on first use"""
+    if not style:
+        return None
+    key = tuple(sorted(style.items()))
+    if key not in formats:
+        props = {}
+        for name, prop in (('bold', 'bold'), ('italic', 'italic'), ('size', 'font_size')):
+            if name in style:
+                props[prop] = style[name]
+        if 'color' in style:
+            props['font_color'] = '#' + style['color']
+        if 'fill' in style:
+            props.update(pattern=1, bg_color='#' + style['fill'])
+        if style.get('border'):
+            props['border'] = 1
+        if 'align' in style:
+            props['align'] = style['align']
+        if 'valign' in style:
+            props['valign'] = {'center': 'vcenter'}.get(style['valign'], style['valign'])
+        formats[key] = workbook.add_format(props)
+    return formats[key]
+
+def _xlsxwriter_chart(workbook, worksheet, chart):
+    kind = {'col': 'column', 'bar': 'bar', 'line': 'line', 'pie': 'pie'}[chart['kind']]
+    obj = workbook.add_chart({'type': kind, **({'subtype': 'stacked'} if chart['stacked'] else {})})
+    name = worksheet.get_name()
+    titled = int(chart['titles_from_data'])
+    cat_first, cat_col, cat_last = chart['categories']
+    for first_row, col_idx, last_row in chart['series']:
+        series = {'values': [name, first_row - 1 + titled, col_idx - 1, last_row - 1, col_idx - 1],
+                  'categories': [name, cat_first - 1, cat_col - 1, cat_last - 1, cat_col - 1]}
+        if titled:
+            series['name'] = [name, first_row - 1, col_idx - 1]
+        obj.add_series(series)
+    if chart['title']:
+        obj.set_title({'name': chart['title']})
+    if chart['kind'] != 'pie':
+        obj.set_x_axis({'name': chart['x_title']} if chart['x_title'] else {})
+        obj.set_y_axis({'name': chart['y_title']} if chart['y_title'] else {})
+    if chart['style'] is not None:
+        obj.set_style(chart['style'])
+    obj.set_size({'width': round(chart['width'] * 96 / 2.54), 'height': round(chart['height'] * 96 / 2.54)})
+    worksheet.insert_chart(chart['anchor'], obj)
+
+def write_xlsxwriter(sheets, filepath, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Stream the workbook with xlsxwriter in constant-memory mode
+
+    Rows are pulled from sheet_rows() one at a time and each finished row is
+    flushed to disk, so memory stays flat however large the row blocks are.
+    xlsxwriter zips the package itself at zlib's default level, so
+    `compresslevel` is ignored.
+    """
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(filepath, {'constant_memory': True})
+    formats = {}
+    for sheet in sheets:
+        worksheet = workbook.add_worksheet(sheet['title'])
+        merges = {(first_row, first_col): (last_row, last_col)
+                  for first_row, first_col, last_row, last_col in sheet['merges']}
+        covered = {(row_idx, col_idx)
+                   for (first_row, first_col), (last_row, last_col) in merges.items()
+                   for row_idx in range(first_row, last_row + 1)
+                   for col_idx in range(first_col, last_col + 1)} - set(merges)
+        lengths = {}
+        for row_idx, row in sheet_rows(sheet, lengths):
+            for col_idx, value, style in row:
+                cell_format = _xlsxwriter_format(workbook, formats, style)
+                value = value.item() if hasattr(value, 'item') else value
+                if (row_idx, col_idx) in merges:
+                    last_row, last_col = merges[(row_idx, col_idx)]
+                    worksheet.merge_range(row_idx - 1, col_idx - 1, last_row - 1, last_col - 1,
+                                          value if value is not None else '', cell_format)
+                elif (row_idx, col_idx) in covered:
+                    continue
+                elif value is None:
+                    # Unstyled blanks are dropped by xlsxwriter; keep the row so templates can fill it
+                    worksheet.write_blank(row_idx - 1, col_idx - 1, None, cell_format)
+                    if cell_format is None:
+                        worksheet.set_row(row_idx - 1, None)
+                elif isinstance(value, float) and not math.isfinite(value):
+                    worksheet.write_blank(row_idx - 1, col_idx - 1, None, cell_format)
+                else:
+                    worksheet.write(row_idx - 1, col_idx - 1, value, cell_format)
+        # Column info is only serialized on close, so widths can follow the rows
+        for col_idx, width in _sheet_widths(sheet, lengths).items():
+            worksheet.set_column(col_idx - 1, col_idx - 1, width)
+
+        for chart in sheet['charts']:
+            _xlsxwriter_chart(workbook, worksheet, chart)
+    workbook.close()
+
+WRITER_BACKENDS = {'openpyxl': write_openpyxl, 'xlsxwriter': write_xlsxwriter}
+DEFAULT_WRITER = 'openpyxl'
+# Backends that stream cells to disk; filling a template would hold the sheets in
+# memory instead, so reports for these (or larger than TEMPLATE_MAX_CELLS) are rendered
+STREAMING_WRITERS = {'xlsxwriter'}
+TEMPLATE_MAX_CELLS = 100000
+
+def _report_styles():
+    # Define styles
+    return {
+        'header_font': {'bold': True, 'color': "FFFFFF", 'size': 12},
+        'header_fill': {'fill': "2E75B6"},
+        'title_font': {'bold': True, 'size': 16, 'color': "2E75B6"},
+        'subtitle_font': {'bold': True, 'size': 14, 'color': "4472C4"},
+        'data_border': {'border': True}
+    }
+
+def _sheet_title(sheet, styles, title, merge_to, subtitle):
+    put_cell(sheet, 'A1', title, styles['title_font'])
+    merge_cells(sheet, f'A1:{merge_to}1')
+
+    put_cell(sheet, 'A3', subtitle, styles['subtitle_font'])
+
+def _header_row(sheet, styles, row, headers, bordered=True):
+    for col_idx, header in enumerate(headers, start=1):
+        put_cell(sheet, (row, col_idx), header, {**styles['header_font'], **styles['header_fill']})
+        if bordered:
+            put_cell(sheet, (row, col_idx), style=styles['data_border'])
+
+def _data_block(sheet, styles, first_row, num_rows, num_cols, bordered=False, center_from=None):
+    # Blank rows over the whole range so it exists in the saved sheet
+    column_styles = [{**(styles['data_border'] if bordered else {}),
+                      **({'align': 'center'} if center_from is not None and col_idx >= center_from else {})}
+                     for col_idx in range(1, num_cols + 1)]
+    add_rows(sheet, first_row, ([None] * num_cols for _ in range(num_rows)), styles=column_styles)
+
+def _put_rows(cells, first_row, rows, first_col=1):
+    """Place a sequence of rows into a cell map starting at the given corner"""
+    for row_idx, row in enumerate(rows, start=first_row):
+        for col_idx, value in enumerate(row, start=first_col):
+            cells[(row_idx, col_idx)] = value
+
+def _padded_headers(headers, width):
+    """Headers followed by blanks for the interval columns a preview adds; their cells name them"""
+    return headers + [None] * (width - len(headers))
+
+def _put_extra_headers(cells, row, df, known):
+    """Name the columns a preview appends after the `known` columns of a table"""
+    _put_rows(cells, row, [list(df.columns[known:])], first_col=known + 1)
+
+def _layout_executive_summary(sheet, shape, styles):
+    put_cell(sheet, 'A1', "Epic System Integration - Laboratory Management Dashboard", styles['title_font'])
+    merge_cells(sheet, 'A1:F1')
+
+    put_cell(sheet, 'A3', "Report Generated:")
+    put_cell(sheet, 'B3', style={'italic': True})
 
-    for col_idx, header in enumerate(['Date', 'Avg TAT'], start=1):
-        cell = ws3.cell(row=perf_start_row, column=col_idx, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
+    # Key Metrics Summary
+    put_cell(sheet, 'A5', "KEY PERFORMANCE INDICATORS", styles['subtitle_font'])
+    merge_cells(sheet, 'A5:F5')
 
-    for row_idx, row in performance_df[['Date', 'AverageTAT']].iterrows():
-        ws3.cell(row=row_idx+perf_start_row+1, column=1, value=row['Date'])
-        ws3.cell(row=row_idx+perf_start_row+1, column=2, value=row['AverageTAT'])
+    num_kpis = shape['kpis'][0]
+    _header_row(sheet, styles, 7, ['Metric', 'Value', 'Status', 'Target', 'Achievement'])
+    _data_block(sheet, styles, 8, num_kpis, 5, bordered=True)
+    for row_idx in range(7, 8 + num_kpis):
+        for col_idx in range(1, 6):
+            put_cell(sheet, (row_idx, col_idx), style={'align': 'center', 'valign': 'center'})
 
-    data = Reference(ws3, min_col=2, min_row=perf_start_row, max_row=perf_start_row+len(performance_df), max_col=2)
-    dates = Reference(ws3, min_col=1, min_row=perf_start_row+1, max_row=perf_start_row+len(performance_df))
-    chart2.add_data(data, titles_from_data=True)
-    chart2.set_categories(dates)
-    ws3.add_chart(chart2, "F15")
+def _cells_executive_summary(nodes):
+    cells = {(3, 2): nodes['generated']}
+    _put_rows(cells, 8, nodes['kpis'])
+    return cells
 
-    # Sheet 4: System Integration Status
-    ws4 = wb.create_sheet("Integration Status")
-    ws4['A1'] = "Epic-LIMS Integration Status"
-    ws4['A1'].font = title_font
-    ws4.merge_cells('A1:E1')
+def _layout_test_volume(sheet, shape, styles):
+    _sheet_title(sheet, styles, "Laboratory Test Volume Analysis", 'D', "Test Type Distribution")
 
-    # Sync status summary
-    sync_summary = sync_logs_df.groupby(['SyncType', 'Status']).size().unstack(fill_value=0)
+    num_tests, width = shape['test_summary']
+    _header_row(sheet, styles, 5, _padded_headers(['Test Type', 'Total Orders', 'STAT Orders', '% STAT'], width))
+    _data_block(sheet, styles, 6, num_tests, width, bordered=True, center_from=2)
 
-    ws4['A3'] = "Synchronization Performance by Type"
-    ws4['A3'].font = subtitle_font
+    # Add bar chart for test volumes
+    add_chart(sheet, "F5", 'col', series=[(5, 2, 5+num_tests)], categories=(6, 1, 5+num_tests),
+              title="Test Volume by Type", x_title="Test Type", y_title="Number of Orders", height=10, width=15)
 
-    # Write sync summary
-    start_row = 5
-    ws4.cell(row=start_row, column=1, value="Sync Type").font = header_font
-    ws4.cell(row=start_row, column=1).fill = header_fill
+def _cells_test_volume(nodes):
+    cells = {}
+    _put_extra_headers(cells, 5, nodes['test_summary'], 4)
+    _put_rows(cells, 6, nodes['test_summary'].itertuples(index=False, name=None))
+    return cells
 
-    for col_idx, status in enumerate(sync_summary.columns, start=2):
-        cell = ws4.cell(row=start_row, column=col_idx, value=status)
-        cell.font = header_font
-        cell.fill = header_fill
+def _layout_tat_performance(sheet, shape, styles):
+    _sheet_title(sheet, styles, "Turnaround Time Performance", 'E', "Department-wise TAT Analysis")
 
-    for row_idx, (sync_type, row_data) in enumerate(sync_summary.iterrows(), start=start_row+1):
-        ws4.cell(row=row_idx, column=1, value=sync_type)
-        for col_idx, value in enumerate(row_data, start=2):
-            ws4.cell(row=row_idx, column=col_idx, value=value)
+    _header_row(sheet, styles, 5, ['Department', 'Total Orders', 'Avg TAT (hrs)', 'Within Target'])
+    _data_block(sheet, styles, 6, shape['dept_tat'][0], 4, bordered=True, center_from=2)
 
-    # Add pie chart for sync status
-    chart3 = PieChart()
-    chart3.title = "Overall Sync Status Distribution"
-    chart3.height = 10
-    chart3.width = 10
-
-    sync_status_counts = sync_logs_df['Status'].value_counts()
-
-    ws4['A15'] = "Overall Sync Status"
-    ws4['A15'].font = subtitle_font
-
-    for idx, (status, count) in enumerate(sync_status_counts.items(), start=17):
-        ws4.cell(row=idx, column=1, value=status)
-        ws4.cell(row=idx, column=2, value=count)
-
-    data = Reference(ws4, min_col=2, min_row=17, max_row=16+len(sync_status_counts))
-    labels = Reference(ws4, min_col=1, min_row=17, max_row=16+len(sync_status_counts))
-    chart3.add_data(data)
-    chart3.set_categories(labels)
-    ws4.add_chart(chart3, "D15")
-
-    # Sheet 5: Specimen Tracking
-    ws5 = wb.create_sheet("Specimen Tracking")
-    ws5['A1'] = "Specimen Chain of Custody Analysis"
-    ws5['A1'].font = title_font
-    ws5.merge_cells('A1:D1')
-
-    # Location distribution
-    location_summary = specimens_df['CurrentLocation'].value_counts().reset_index()
-    location_summary.columns = ['Location', 'Count']
-    location_summary['Percentage'] = (location_summary['Count'] / location_summary['Count'].sum() * 100).round(1)
+    # Performance metrics for chart
+    perf_start_row = 15
+    num_days = shape['tat_trend'][0]
+    put_cell(sheet, 'A14', style=styles['subtitle_font'])
 
-    ws5['A3'] = "Current Specimen Locations"
-    ws5['A3'].font = subtitle_font
+    _header_row(sheet, styles, perf_start_row, ['Date', 'Avg TAT'], bordered=False)
+    _data_block(sheet, styles, perf_start_row+1, num_days, 2)
 
-    for col_idx, header in enumerate(['Location', 'Count', 'Percentage'], start=1):
-        cell = ws5.cell(row=5, column=col_idx, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
+    # Add line chart for TAT trend
+    add_chart(sheet, "F15", 'line', series=[(perf_start_row, 2, perf_start_row+num_days)],
+              categories=(perf_start_row+1, 1, perf_start_row+num_days), title="Daily Average TAT Trend",
+              x_title="Date", y_title="TAT (hours)", height=10, width=15)
 
-    for row_idx, row in location_summary.iterrows():
-        for col_idx, value in enumerate(row, start=1):
-            ws5.cell(row=row_idx+6, column=col_idx, value=value)
+def _cells_tat_performance(nodes):
+    cells = {(14, 1): nodes['tat_trend_title']}
+    _put_rows(cells, 6, nodes['dept_tat'].itertuples(index=False, name=None))
+    _put_rows(cells, 16, nodes['tat_trend'].itertuples(index=False, name=None))
+    return cells
 
-    # Sheet 6: Multi-Tenant Analytics
-    ws6 = wb.create_sheet("Multi-Tenant Analytics")
-    ws6['A1'] = "Multi-Tenant System Usage"
-    ws6['A1'].font = title_font
-    ws6.merge_cells('A1:D1')
+def _layout_integration_status(sheet, shape, styles):
+    _sheet_title(sheet, styles, "Epic-LIMS Integration Status", 'E', "Synchronization Performance by Type")
 
-    # Tenant usage summary
-    tenant_summary = patients_df['TenantID'].value_counts().reset_index()
-    tenant_summary.columns = ['Tenant', 'Patient Count']
+    # Sync summary; the status column headers come from the data
+    start_row = 5
+    num_sync_types, num_statuses = shape['sync_summary']
+    _header_row(sheet, styles, start_row, ["Sync Type"] + [None] * num_statuses, bordered=False)
+    _data_block(sheet, styles, start_row+1, num_sync_types, 1 + num_statuses)
 
-    # Add more tenant metrics
-    tenant_orders = sync_logs_df.groupby('TenantID')['RecordsProcessed'].sum().reset_index()
-    tenant_orders.columns = ['Tenant', 'Records Processed']
+    num_status_counts = shape['sync_status_counts'][0]
+    put_cell(sheet, 'A15', "Overall Sync Status", styles['subtitle_font'])
+    _data_block(sheet, styles, 17, num_status_counts, 2)
 
-    tenant_summary = tenant_summary.merge(tenant_orders, on='Tenant', how='left')
-    tenant_summary['Avg Records/Patient'] = (tenant_summary['Records Processed'] / tenant_summary['Patient Count']).round(1)
+    # Add pie chart for sync status
+    add_chart(sheet, "D15", 'pie', series=[(17, 2, 16+num_status_counts)], categories=(17, 1, 16+num_status_counts),
+              title="Overall Sync Status Distribution", height=10, width=10, titles_from_data=False)
+
+def _cells_integration_status(nodes):
+    cells = {}
+    sync_summary = nodes['sync_summary']
+    _put_rows(cells, 5, [sync_summary.columns], first_col=2)
+    _put_rows(cells, 6, sync_summary.itertuples(name=None))
+    _put_rows(cells, 17, nodes['sync_status_counts'].items())
+    return cells
+
+def _layout_sync_latency(sheet, shape, styles):
+    _sheet_title(sheet, styles, "Sync Duration Percentiles", 'I', "By Sync Type (all tenants and directions)")
+
+    num_types, width = shape['sync_latency_by_type']
+    _header_row(sheet, styles, 5, _padded_headers(['Sync Type', 'Syncs', 'Failures', 'Failure %', 'P50 (ms)',
+                                                   'P95 (ms)', 'P99 (ms)'], width))
+    _data_block(sheet, styles, 6, num_types, width, bordered=True, center_from=2)
+
+    # Add bar chart for the percentiles per sync type
+    add_chart(sheet, "K5", 'col', series=[(5, col, 5+num_types) for col in (5, 6, 7)], categories=(6, 1, 5+num_types),
+              title="Sync Duration Percentiles by Type", x_title="Sync Type", y_title="Duration (ms)",
+              height=10, width=15)
+
+    detail_row = 8 + num_types
+    put_cell(sheet, (detail_row, 1), "By Tenant, Sync Type and Direction", styles['subtitle_font'])
+    num_rows, width = shape['sync_latency']
+    _header_row(sheet, styles, detail_row + 2, _padded_headers(['Tenant', 'Sync Type', 'Direction', 'Syncs', 'Failures',
+                                                                'Failure %', 'P50 (ms)', 'P95 (ms)', 'P99 (ms)'], width))
+    _data_block(sheet, styles, detail_row + 3, num_rows, width, bordered=True, center_from=4)
+
+def _cells_sync_latency(nodes):
+    cells = {}
+    by_type = nodes['sync_latency_by_type']
+    _put_extra_headers(cells, 5, by_type, 7)
+    _put_rows(cells, 6, by_type.itertuples(index=False, name=None))
+    _put_extra_headers(cells, 10 + len(by_type), nodes['sync_latency'], 9)
+    _put_rows(cells, 11 + len(by_type), nodes['sync_latency'].itertuples(index=False, name=None))
+    return cells
+
+def _layout_specimen_tracking(sheet, shape, styles):
+    _sheet_title(sheet, styles, "Specimen Chain of Custody Analysis", 'I', "Current Specimen Locations")
+
+    num_locations, width = shape['location_summary']
+    _header_row(sheet, styles, 5, _padded_headers(['Location', 'Count', 'Percentage'], width), bordered=False)
+    _data_block(sheet, styles, 6, num_locations, width)
+
+    low, high = SPECIMEN_TEMPERATURE_RANGE
+    excursion_row = 8 + num_locations
+    put_cell(sheet, (excursion_row, 1), f"Temperature Excursions Outside {low:g}-{high:g}°C by Location and Tube Type",
+             styles['subtitle_font'])
+    num_rows, width = shape['excursion_summary']
+    _header_row(sheet, styles, excursion_row + 2, ['Location', 'Tube Type', 'Excursions', 'Specimens', 'Ongoing',
+                                                   'Total (min)', 'Avg (min)', 'Longest (min)', 'Peak Deviation (°C)'])
+    _data_block(sheet, styles, excursion_row + 3, num_rows, width, bordered=True, center_from=3)
+
+def _cells_specimen_tracking(nodes):
+    cells = {}
+    _put_extra_headers(cells, 5, nodes['location_summary'], 3)
+    _put_rows(cells, 6, nodes['location_summary'].itertuples(index=False, name=None))
+    _put_rows(cells, 11 + len(nodes['location_summary']), nodes['excursion_summary'].itertuples(index=False, name=None))
+    return cells
+
+def _layout_multi_tenant(sheet, shape, styles):
+    _sheet_title(sheet, styles, "Multi-Tenant System Usage", 'D', "Tenant Usage Statistics")
+
+    _header_row(sheet, styles, 5, ['Tenant', 'Patient Count', 'Records Processed', 'Avg Records/Patient'], bordered=False)
+    _data_block(sheet, styles, 6, shape['tenant_summary'][0], 4)
+
+def _cells_multi_tenant(nodes):
+    cells = {}
+    _put_rows(cells, 6, nodes['tenant_summary'].itertuples(index=False, name=None))
+    return cells
+
+def _layout_result_evaluation(sheet, shape, styles):
+    _sheet_title(sheet, styles, "Laboratory Result Abnormality Rates", 'G',
+                 "Results Outside Reference Range by Component")
+
+    num_components, width = shape['result_flags']
+    _header_row(sheet, styles, 5, _padded_headers(['Component', 'Results', 'Evaluable', 'Abnormal', 'Abnormal %',
+                                                   'Critical', 'Critical %'], width))
+    _data_block(sheet, styles, 6, num_components, width, bordered=True, center_from=2)
+
+    # Add bar chart for abnormal and critical rates
+    add_chart(sheet, "I5", 'col', series=[(5, col, 5+num_components) for col in (5, 7)],
+              categories=(6, 1, 5+num_components), title="Abnormal and Critical Rate by Component",
+              x_title="Component", y_title="% of Evaluable Results", height=10, width=15)
+
+def _cells_result_evaluation(nodes):
+    cells = {}
+    _put_extra_headers(cells, 5, nodes['result_flags'], 7)
+    _put_rows(cells, 6, nodes['result_flags'].itertuples(index=False, name=None))
+    return cells
+
+# Sheets of the friendly report in workbook order
+REPORT_SECTIONS = [
+    {'sheet': 'Executive Summary', 'summary': 'Executive Summary with KPIs',
+     'needs': ['generated', 'kpis'],
+     'layout': _layout_executive_summary, 'cells': _cells_executive_summary},
+    {'sheet': 'Test Volume Analysis', 'summary': 'Test Volume Analysis with bar charts',
+     'needs': ['test_summary'],
+     'layout': _layout_test_volume, 'cells': _cells_test_volume},
+    {'sheet': 'TAT Performance', 'summary': 'TAT Performance with trend charts',
+     'needs': ['dept_tat', 'tat_trend', 'tat_trend_title'],
+     'layout': _layout_tat_performance, 'cells': _cells_tat_performance},
+    {'sheet': 'Integration Status', 'summary': 'Integration Status with pie charts',
+     'needs': ['sync_summary', 'sync_status_counts'],
+     'layout': _layout_integration_status, 'cells': _cells_integration_status},
+    {'sheet': 'Sync Latency', 'summary': 'Sync Latency percentiles and failure rates per tenant',
+     'needs': ['sync_latency_by_type', 'sync_latency'],
+     'layout': _layout_sync_latency, 'cells': _cells_sync_latency},
+    {'sheet': 'Specimen Tracking', 'summary': 'Specimen Tracking with temperature excursions',
+     'needs': ['location_summary', 'excursion_summary'],
+     'layout': _layout_specimen_tracking, 'cells': _cells_specimen_tracking},
+    {'sheet': 'Multi-Tenant Analytics', 'summary': 'Multi-Tenant usage statistics',
+     'needs': ['tenant_summary'],
+     'layout': _layout_multi_tenant, 'cells': _cells_multi_tenant},
+    {'sheet': 'Result Evaluation', 'summary': 'Result Evaluation with abnormal and critical rates',
+     'needs': ['result_flags'],
+     'layout': _layout_result_evaluation, 'cells': _cells_result_evaluation}
+]
+
+def select_sections(sheets=None):
+    """Return the report sections for the requested sheet titles, in workbook order"""
+    if sheets:
+        known = {section['sheet'] for section in REPORT_SECTIONS}
+        unknown = [sheet for sheet in sheets if sheet not in known]
+        if unknown:
+            raise ValueError(f"Unknown report sheets: {', '.join(unknown)}")
+    return [section for section in REPORT_SECTIONS if not sheets or section['sheet'] in sheets]
+
+def untenanted_sections(sections):
+    """The sections that read a raw table without a tenant, whose figures from it cover all tenants"""
+    return [section for section in sections
+            if any('tenant' not in DATASET_PARTITIONS[table] for table in plan_report([section])[1])]
+
+def plan_report(sections):
+    """Resolve the nodes the sections depend on, in dependency order, and the raw
+    columns they read per table"""
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Report node cycle through {name}")
+        visiting.add(name)
+        for dependency in REPORT_NODES[name].get('needs', []):
+            visit(dependency)
+        visiting.discard(name)
+        order.append(name)
+
+    for section in sections:
+        for name in section['needs']:
+            visit(name)
+
+    columns = {}
+    for name in order:
+        for table, table_columns in REPORT_NODES[name].get('inputs', {}).items():
+            columns.setdefault(table, [])
+            columns[table] += [column for column in table_columns if column not in columns[table]]
+    return order, columns
+
+def evaluate_report(load_table, manifest, sheets=None, chart_max_points=CHART_MAX_POINTS, preview_budget=None,
+                    tenants=None):
+    """Compute only what the requested sheets need
+
+    `load_table(table, columns, deadline=None)` returns a DataFrame with at least
+    those columns, or with a `deadline` (a time.perf_counter() value) as many of
+    its rows as can be read by then; each raw table is loaded once with the union
+    of columns its nodes declare. `manifest` holds the partition statistics of the
+    same (filtered) data. With `preview_budget` (seconds) up to PREVIEW_LOAD_SHARE
+    of the budget is spent loading, shared out over the tables, and the nodes come
+    from a stratified sample of what was loaded, sized so computing fits the rest. `tenants` marks the data as filtered
+    by tenant, so figures from tables without a tenant are labelled as covering
+    all tenants.
+    """
+    started = time.perf_counter()
+    sections = select_sections(sheets)
+    order, columns = plan_report(sections)
+    if preview_budget is not None:
+        for table, strata in PREVIEW_STRATA.items():
+            if table in columns:
+                columns[table] += [column for column in strata if column not in columns[table]]
+        for table, column in PREVIEW_CLUSTERS.items():
+            if table in columns and column not in columns[table]:
+                columns[table].append(column)
+    options = {'chart_max_points': chart_max_points, 'manifest': manifest, 'tenants': tenants}
+    if preview_budget is None:
+        frames = {table: load_table(table, table_columns) for table, table_columns in columns.items()}
+        return sections, compute_nodes(order, frames, options)
+
+    load_deadline = started + preview_budget * PREVIEW_LOAD_SHARE
+    frames = {}
+    for remaining, (table, table_columns) in zip(range(len(columns), 0, -1), columns.items()):
+        # Time a table leaves unused carries over to the ones after it
+        frames[table] = load_table(table, table_columns,
+                                   time.perf_counter() + (load_deadline - time.perf_counter()) / remaining)
+    totals = {}
+    for entry in manifest['partitions']:
+        totals[entry['table']] = totals.get(entry['table'], 0) + entry['rows']
+    return sections, preview_nodes(order, frames, options, preview_budget - (time.perf_counter() - started), totals)
+
+def report_shape(sections, nodes):
+    """Describe the size of every data block; reports of equal shape share a template"""
+    import numpy as np
+    return {
+        section['sheet']: {name: list(np.shape(nodes[name])) for name in section['needs']}
+        for section in sections
+    }
+
+def build_report_layout(shape):
+    """Lay out everything that does not depend on the data: titles, merged headers,
+    header fills, borders on the data ranges and charts bound to those ranges"""
+    styles = _report_styles()
+    layouts = {section['sheet']: section['layout'] for section in REPORT_SECTIONS}
+    sheets = []
+    for title, sheet_shape in shape.items():
+        sheet = new_sheet(title)
+        layouts[title](sheet, sheet_shape, styles)
+        sheets.append(sheet)
+    return sheets
+
+def report_cells(sections, nodes):
+    """Map every data cell of the friendly report to its value, per sheet"""
+    return {section['sheet']: section['cells'](nodes) for section in sections}
+
+def _column_text_lengths(sheets):
+    """Longest rendered value per column of every sheet's cells, keyed by column index
+
+    Row blocks are left unread; a layout's blocks only hold blanks.
+    """
+    lengths = {}
+    for sheet in sheets:
+        sheet_lengths = lengths[sheet['title']] = {}
+        for (_, col_idx), cell in sheet['cells'].items():
+            if cell['value'] is not None:
+                sheet_lengths[col_idx] = max(sheet_lengths.get(col_idx, 0), len(str(cell['value'])))
+    return lengths
+
+def _column_width(max_length):
+    return min(max_length + 2, 30)
+
+def render_friendly_report(sections, nodes, filepath, writer=DEFAULT_WRITER, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Write the friendly report directly with the chosen writer backend"""
+    sheets = build_report_layout(report_shape(sections, nodes))
+    cells = report_cells(sections, nodes)
+    for sheet in sheets:
+        add_values(sheet, cells[sheet['title']])
+        sheet['autofit'] = True
+    WRITER_BACKENDS[writer](sheets, filepath, compresslevel)
+
+def load_report_template(shape, writer=DEFAULT_WRITER):
+    """Return the serialized template for a report shape, building it on first use
+
+    Templates are cached in memory and under report-templates/ so batch runs only pay
+    for titles, styles and charts once per distinct shape; the least recently used
+    beyond TEMPLATE_CACHE_SIZE are dropped.
+    """
+    key = hashlib.sha1(json.dumps([REPORT_TEMPLATE_VERSION, writer, shape], sort_keys=True).encode()).hexdigest()[:16]
+    if key in _template_cache:
+        _template_cache[key] = _template_cache.pop(key)  # most recently used last
+        return _template_cache[key]
+
+    template_path = os.path.join(template_folder, f'friendly-report-{key}.xlsx')
+    meta_path = os.path.join(template_folder, f'friendly-report-{key}.json')
+    if os.path.exists(template_path) and os.path.exists(meta_path):
+        os.utime(meta_path)  # mark as recently used for _evict_templates
+    else:
+        # Write under temporary names and move the meta into place last, so a crash
+        # or a concurrent worker never leaves a partial template behind
+        os.makedirs(template_folder, exist_ok=True)
+        suffix = f'.{os.getpid()}.tmp'
+        sheets = build_report_layout(shape)
+        WRITER_BACKENDS[writer](sheets, template_path + suffix, INTERMEDIATE_COMPRESSLEVEL)
+        with open(meta_path + suffix, 'w') as f:
+            json.dump({title: {str(col): length for col, length in sheet_lengths.items()}
+                       for title, sheet_lengths in _column_text_lengths(sheets).items()}, f)
+        os.replace(template_path + suffix, template_path)
+        os.replace(meta_path + suffix, meta_path)
+        _evict_templates()
+
+    with zipfile.ZipFile(template_path) as archive:
+        parts = {info.filename: archive.read(info) for info in archive.infolist()}
+    with open(meta_path) as f:
+        static_lengths = {title: {int(col): length for col, length in sheet_lengths.items()}
+                          for title, sheet_lengths in json.load(f).items()}
+
+    template = {'parts': parts, 'sheets': _worksheet_parts(parts), 'lengths': static_lengths}
+    _template_cache[key] = template
+    while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+        del _template_cache[next(iter(_template_cache))]
+    return template
+
+def _evict_templates():
+    """Delete all but the TEMPLATE_CACHE_SIZE most recently used templates under report-templates/"""
+    metas = sorted((entry for entry in os.scandir(template_folder)
+                    if entry.name.startswith('friendly-report-') and entry.name.endswith('.json')),
+                   key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in metas[TEMPLATE_CACHE_SIZE:]:
+        # The meta goes first, so the template reads as missing rather than partial
+        for path in (entry.path, entry.path[:-len('.json')] + '.xlsx'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def _worksheet_parts(parts):
+    """Map sheet titles to their XML part names inside an xlsx package"""
+    rels = re.findall(r'<Relationship\b[^>]*?>', parts['xl/_rels/workbook.xml.rels'].decode())
+    targets = {}
+    for rel in rels:
+        rel_id = re.search(r'\bId="([^"]+)"', rel).group(1)
+        target = re.search(r'\bTarget="([^"]+)"', rel).group(1)
+        targets[rel_id] = target.lstrip('/') if target.startswith('/') else 'xl/' + target
+
+    sheets = {}
+    for sheet in re.findall(r'<sheet\b[^>]*?>', parts['xl/workbook.xml'].decode()):
+        title = xml_unescape(re.search(r'\bname="([^"]*)"', sheet).group(1), {'&quot;': '"'})
+        sheets[title] = targets[re.search(r'\br:id="([^"]+)"', sheet).group(1)]
+    return sheets
+
+_ROW_XML = re.compile(r'<row r="(\d+)"([^>]*?)(?:/>|>(.*?)</row>)', re.S)
+_CELL_XML = re.compile(r'<c r="([A-Z]+)\d+"([^>]*?)(?:/>|>.*?</c>)', re.S)
+_STYLE_ATTR = re.compile(r'\bs="(\d+)"')
+
+def _column_letter(col_idx):
+    letters = ''
+    while col_idx:
+        col_idx, remainder = divmod(col_idx - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def _column_index(letters):
+    col_idx = 0
+    for letter in letters:
+        col_idx = col_idx * 26 + ord(letter) - 64
+    return col_idx
+
+def _cell_xml(ref, style, value):
+    """Serialize one cell, using inline strings so sharedStrings stays untouched"""
+    style_attr = f' s="{style}"' if style else ''
+    if hasattr(value, 'item'):  # NumPy scalars
+        value = value.item()
+    if value is None or (isinstance(value, float) and not math.isfinite(value)):
+        return f'<c r="{ref}"{style_attr}/>'
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{style_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"{style_attr} t="n"><v>{value!r}</v></c>'
+    text = xml_escape(str(value))
+    return f'<c r="{ref}"{style_attr} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def _fill_sheet_xml(sheet_xml, sheet_cells, widths):
+    """Write data cells into a template sheet, keeping the styles laid out for them"""
+    by_row = {}
+    for (row_idx, col_idx), value in sheet_cells.items():
+        by_row.setdefault(row_idx, {})[col_idx] = value
+
+    def fill_row(match):
+        row_idx = int(match.group(1))
+        if row_idx not in by_row:
+            return match.group(0)
+        row_cells = {_column_index(cell.group(1)): cell.group(0)
+                     for cell in _CELL_XML.finditer(match.group(3) or '')}
+        for col_idx, value in by_row.pop(row_idx).items():
+            style = _STYLE_ATTR.search(row_cells.get(col_idx, ''))
+            row_cells[col_idx] = _cell_xml(f'{_column_letter(col_idx)}{row_idx}',
+                                           style.group(1) if style else None, value)
+        return f'<row r="{row_idx}"{match.group(2)}>' + ''.join(row_cells[col] for col in sorted(row_cells)) + '</row>'
+
+    sheet_xml = _ROW_XML.sub(fill_row, sheet_xml)
+    if by_row:
+        # Rows the template does not hold: merge them in order among the existing ones
+        new_rows = ''.join(
+            f'<row r="{row_idx}">' + ''.join(_cell_xml(f'{_column_letter(col_idx)}{row_idx}', None, row_cells[col_idx])
+                                             for col_idx in sorted(row_cells)) + '</row>'
+            for row_idx, row_cells in sorted(by_row.items()))
+        sheet_xml = _insert_rows(sheet_xml, new_rows)
+
+    cols = '<cols>' + ''.join(f'<col min="{col}" max="{col}" width="{width}" customWidth="1"/>'
+                              for col, width in sorted(widths.items())) + '</cols>'
+    sheet_xml = re.sub(r'<cols>.*?</cols>|<cols\s*/>', '', sheet_xml, flags=re.S)
+    return sheet_xml.replace('<sheetData', cols + '<sheetData', 1)
+
+def _insert_rows(sheet_xml, new_rows):
+    """Merge serialized rows into sheetData keeping rows sorted by index"""
+    rows = {int(match.group(1)): match.group(0) for match in _ROW_XML.finditer(sheet_xml)}
+    rows.update({int(match.group(1)): match.group(0) for match in _ROW_XML.finditer(new_rows)})
+    sheet_data = '<sheetData>' + ''.join(rows[row_idx] for row_idx in sorted(rows)) + '</sheetData>'
+    sheet_xml = re.sub(r'<sheetData>.*?</sheetData>|<sheetData\s*/>', lambda _: sheet_data, sheet_xml, count=1, flags=re.S)
+    return re.sub(r'<dimension ref="[^"]*"\s*/>', '', sheet_xml, count=1)
+
+def fill_report_template(template, cells, filepath, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Clone a serialized template and fill only its data ranges"""
+    filled = {}
+    for title, sheet_cells in cells.items():
+        lengths = dict(template['lengths'].get(title, {}))
+        for (_, col_idx), value in sheet_cells.items():
+            if value is not None:
+                lengths[col_idx] = max(lengths.get(col_idx, 0), len(str(value)))
+        widths = {col: _column_width(length) for col, length in lengths.items()}
+
+        part = template['sheets'][title]
+        filled[part] = _fill_sheet_xml(template['parts'][part].decode(), sheet_cells, widths).encode()
+
+    write_zip_parts({name: filled.get(name, data) for name, data in template['parts'].items()},
+                    filepath, compresslevel)
 
-    ws6['A3'] = "Tenant Usage Statistics"
-    ws6['A3'].font = subtitle_font
-
-    for col_idx, header in enumerate(['Tenant', 'Patient Count', 'Records Processed', 'Avg Records/Patient'], start=1):
-        cell = ws6.cell(row=5, column=col_idx, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-
-    for row_idx, row in tenant_summary.iterrows():
-        for col_idx, value in enumerate(row, start=1):
-            ws6.cell(row=row_idx+6, column=col_idx, value=value)
-
-    # Adjust column widths
-    for ws in wb.worksheets:
-        for column in ws.columns:
-            max_length = 0
-            try:
-                column_letter = column[0].column_letter
-            except AttributeError:
-                continue
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 30)
-            ws.column_dimensions[column_letter].width = adjusted_width
+# Create human-friendly report
+def create_friendly_report(sheets=None, use_template=True, chart_max_points=CHART_MAX_POINTS, tables=None,
+                           tenants=None, since=None, writer=DEFAULT_WRITER, preview_budget=None,
+                           compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Create the human-friendly Excel report with charts and formatted data
+
+    `sheets` limits the report to those sheet titles; only the raw columns and
+    aggregates they depend on are read and computed. `tenants` and `since`
+    (YYYY-MM-DD) restrict the data, pruning dataset partitions before any read;
+    with `tenants`, figures from tables without a tenant are labelled as covering all tenants.
+    Pass the generated `tables` to skip reading them back from disk. `writer`
+    names the backend in WRITER_BACKENDS that writes the workbook (or template);
+    `use_template` is ignored for STREAMING_WRITERS and reports over
+    TEMPLATE_MAX_CELLS cells, which are always rendered directly.
+    With `preview_budget` (seconds) a preview is built from a stratified sample;
+    the report file is replaced in one step, so a later full run supersedes it.
+    `compresslevel` is the deflate level of the full report; previews are
+    short-lived and always use INTERMEDIATE_COMPRESSLEVEL.
+    """
+    if tables is not None:
+        tables = {table: filter_table(table, df, tenants, since) for table, df in derive_tenants(tables).items()}
+        sections, nodes = evaluate_report(lambda table, columns, deadline=None: tables[table][columns],
+                                          dataset_manifest(tables),
+                                          sheets=sheets, chart_max_points=chart_max_points,
+                                          preview_budget=preview_budget, tenants=tenants)
+    else:
+        # Read the partitioned dataset, (re)building it from input-report.xlsx when that is newer or outdated
+        raw_file = os.path.join(public_folder, 'input-report.xlsx')
+        manifest_path = os.path.join(dataset_folder, DATASET_MANIFEST)
+        if (not os.path.exists(manifest_path) or os.path.getmtime(manifest_path) < os.path.getmtime(raw_file)
+                or read_dataset_manifest().get('version') != DATASET_VERSION):
+            ingest_raw_excel(raw_file)
+
+        manifest = prune_manifest(read_dataset_manifest(), tenants, since)
+        sections, nodes = evaluate_report(lambda table, columns, deadline=None: read_dataset_table(
+                                              manifest, table, columns, deadline=deadline),
+                                          manifest, sheets=sheets, chart_max_points=chart_max_points,
+                                          preview_budget=preview_budget, tenants=tenants)
 
     # Save the report
     filepath = os.path.join(public_folder, 'sample-report.xlsx')
-    wb.save(filepath)
-    print(f"Human-friendly report created: {filepath}")
+    partial_path = os.path.join(public_folder, 'sample-report.partial.xlsx')
+    os.makedirs(public_folder, exist_ok=True)
+    if preview_budget is not None:
+        compresslevel = INTERMEDIATE_COMPRESSLEVEL
+    cells = report_cells(sections, nodes)
+    if use_template and writer not in STREAMING_WRITERS and sum(map(len, cells.values())) <= TEMPLATE_MAX_CELLS:
+        fill_report_template(load_report_template(report_shape(sections, nodes), writer), cells,
+                             partial_path, compresslevel)
+    else:
+        render_friendly_report(sections, nodes, partial_path, writer, compresslevel)
+    os.replace(partial_path, filepath)
+    print(f"{'Preview' if preview_budget is not None else 'Human-friendly'} report created: {filepath}")
     return filepath
 
+def run_pipelined(sheets=None, tenants=None, since=None, writer=DEFAULT_WRITER, preview_budget=None,
+                  compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Generate once, then build the report from the in-memory tables while a
+    background process serializes the raw workbook
+
+    End-to-end time becomes roughly the slower of the two stages rather than
+    their sum, and the report no longer re-reads input-report.xlsx. With
+    `preview_budget` a preview report is written first.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    tables = generate_raw_tables()
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        raw_future = executor.submit(create_raw_excel, tables)
+        if preview_budget is not None:
+            create_friendly_report(sheets=sheets, tables=tables, tenants=tenants, since=since, writer=writer,
+                                   preview_budget=preview_budget)
+        report_file = create_friendly_report(sheets=sheets, tables=tables, tenants=tenants, since=since, writer=writer,
+                                             compresslevel=compresslevel)
+        raw_file = raw_future.result()
+    return raw_file, report_file
+
 # Main execution
-if __name__ == "__main__":
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Epic System Integration - Report Generator")
+    parser.add_argument('--sheets', help="Comma-separated report sheets to build, e.g. "
+                                         "\"Integration Status,Executive Summary\" (default: all)")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="Build the report from the generated data while the raw file is written in the background")
+    parser.add_argument('--tenants', help="Comma-separated tenants to report on, e.g. \"TENANT_001,TENANT_003\" (default: all)")
+    parser.add_argument('--since', help="Only report data from this day on (YYYY-MM-DD)")
+    parser.add_argument('--writer', choices=sorted(WRITER_BACKENDS), default=DEFAULT_WRITER,
+                        help=f"Workbook writer backend (default: {DEFAULT_WRITER})")
+    parser.add_argument('--compresslevel', type=int, choices=range(10), default=DOWNLOAD_COMPRESSLEVEL, metavar='0-9',
+                        help=f"Deflate level of the report (default: {DOWNLOAD_COMPRESSLEVEL}); the raw input file "
+                             f"always uses {INTERMEDIATE_COMPRESSLEVEL}")
+    parser.add_argument('--preview', type=float, nargs='?', const=PREVIEW_BUDGET, metavar='SECONDS',
+                        help="First write a preview report from a stratified sample within this time budget "
+                             f"(default: {PREVIEW_BUDGET:g}), then replace it with the full report")
+    args = parser.parse_args(argv)
+    sheets = [sheet.strip() for sheet in args.sheets.split(',')] if args.sheets else None
+    tenants = [tenant.strip() for tenant in args.tenants.split(',')] if args.tenants else None
+    try:
+        select_sections(sheets)
+        if args.since:
+            datetime.strptime(args.since, '%Y-%m-%d')
+    except ValueError as e:
+        parser.error(str(e))
+
     print("Epic System Integration - Report Generator")
     print("==========================================")
     print()
-
-    print("Step 1: Creating raw input Excel file with complex data...")
-    raw_file = create_raw_excel()
-    print(f"[OK] Raw data file created with 6 sheets containing {5000}+ records")
-    print()
-
-    print("Step 2: Processing data and creating human-friendly report...")
-    report_file = create_friendly_report()
+    untenanted = untenanted_sections(select_sections(sheets)) if tenants is not None else []
+    if untenanted:
+        print(f"Filtering by tenant; figures without tenant data cover all tenants on: "
+              f"{', '.join(section['sheet'] for section in untenanted)}")
+        print()
+
+    if args.pipelined:
+        print("Generating data, writing the raw input file and building the report concurrently...")
+        raw_file, report_file = run_pipelined(sheets=sheets, tenants=tenants, since=args.since, writer=args.writer,
+                                              preview_budget=args.preview, compresslevel=args.compresslevel)
+    else:
+        tables = generate_raw_tables()
+        if args.preview is not None:
+            # Built from the generated tables, so the draft is ready before the raw file is written
+            print("Preview: building a draft report from a sample of the generated data...")
+            create_friendly_report(sheets=sheets, tables=tables, tenants=tenants, since=args.since, writer=args.writer,
+                                   preview_budget=args.preview)
+            print()
+
+        print("Step 1: Creating raw input Excel file with complex data...")
+        raw_file = create_raw_excel(tables)
+        print(f"[OK] Raw data file created with 6 sheets containing {5000}+ records")
+        print()
+
+        print("Step 2: Processing data and creating human-friendly report...")
+        report_file = create_friendly_report(sheets=sheets, tenants=tenants, since=args.since, writer=args.writer,
+                                             compresslevel=args.compresslevel)
     print(f"[OK] Human-friendly report created with:")
-    print("  - Executive Summary with KPIs")
-    print("  - Test Volume Analysis with bar charts")
-    print("  - TAT Performance with trend charts")
-    print("  - Integration Status with pie charts")
-    print("  - Specimen Tracking analytics")
-    print("  - Multi-Tenant usage statistics")
+    for section in select_sections(sheets):
+        print(f"  - {section['summary']}")
     print()
 
     print("Report generation complete!")
     print(f"Input file: {raw_file}")
-    print(f"Output file: {report_file}")
\ No newline at end of file
+    print(f"Output file: {report_file}")
+
+if __name__ == "__main__":
+    main()
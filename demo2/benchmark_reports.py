@@ -0,0 +1,174 @@
+import io
+import os
+import re
+import sys
+import time
+import argparse
+import contextlib
+import importlib
+import zipfile
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = 'generate_nhs_reports.py'
+MODULE = 'generate_nhs_reports'
+
+def time_command(command, repeat=5):
+    """Median wall time in milliseconds of running a command to completion"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=script_folder, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def import_profile(module):
+    """Cumulative import time in milliseconds per package pulled in by `import module`"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=script_folder, check=True, capture_output=True, text=True)
+    profile = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line)
+        if match and len(match.group(2)) <= 3:  # top-level imports and their direct children
+            profile[match.group(3)] = int(match.group(1)) / 1000
+    return profile
+
+def bench_startup(repeat=5, top=5):
+    """Time `--help` and a bare import, and list the slowest imports"""
+    help_ms = time_command([sys.executable, SCRIPT, '--help'], repeat)
+    import_ms = time_command([sys.executable, '-c', f'import {MODULE}'], repeat)
+    print(f"Startup ({SCRIPT}, median of {repeat}):")
+    print(f"  --help:  {help_ms:8.1f} ms")
+    print(f"  import:  {import_ms:8.1f} ms")
+    profile = import_profile(MODULE)
+    print("  Slowest imports:")
+    for name, ms in sorted(profile.items(), key=lambda item: -item[1])[:top]:
+        print(f"    {name:<30} {ms:8.1f} ms")
+    heavy = [name for name in ('pandas', 'numpy', 'openpyxl') if name in profile]
+    if heavy:
+        print(f"  [WARN] Heavy modules imported at startup: {', '.join(heavy)}")
+    return help_ms
+
+def large_sheet(report, rows, columns=8):
+    """Synthetic report sheet: styled header, bordered numeric block and a chart over it
+
+    The block is a generator, so its rows only exist while the writer consumes them.
+    """
+    sheet = report.new_sheet('Large')
+    for col_idx in range(1, columns + 1):
+        report.put_cell(sheet, (1, col_idx), f'Column {col_idx}', {'bold': True, 'fill': 'D9D9D9'})
+    report.add_rows(sheet, 2, ([f'Row {row_idx - 1}'] + [(row_idx * col_idx) % 997 / 10 for col_idx in range(2, columns + 1)]
+                               for row_idx in range(2, rows + 2)),
+                    styles=[{'border': True}] * columns)
+    report.add_chart(sheet, 'K2', 'line', series=[(1, 2, min(rows + 1, 366))], categories=(2, 1, min(rows + 1, 366)))
+    return [sheet]
+
+def report_module():
+    sys.path.insert(0, script_folder)
+    return importlib.import_module(MODULE)
+
+def package_parts(filepath):
+    """Uncompressed parts of an xlsx package by name"""
+    with zipfile.ZipFile(filepath) as archive:
+        return {info.filename: archive.read(info) for info in archive.infolist()}
+
+def bench_writers(rows):
+    """Time, throughput and peak Python memory of every writer backend on one large sheet
+
+    Building the sheet is part of every measurement, so the peak covers the
+    whole path from rows to file rather than the backend alone.
+    """
+    report = report_module()
+    print(f"Writer backends ({rows:,} rows x 8 columns, sheet model included):")
+    with tempfile.TemporaryDirectory() as folder:
+        for name, write in sorted(report.WRITER_BACKENDS.items()):
+            filepath = os.path.join(folder, f'{name}.xlsx')
+            start = time.perf_counter()
+            write(large_sheet(report, rows), filepath)
+            elapsed = time.perf_counter() - start
+
+            # Measured in a second run so tracing does not inflate the timing
+            tracemalloc.start()
+            write(large_sheet(report, rows), filepath)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            written = sum(map(len, package_parts(filepath).values()))
+            print(f"  {name:<12} {elapsed:8.2f} s  {written / elapsed / 2**20:6.1f} MiB/s  "
+                  f"peak {peak / 2**20:8.1f} MiB  size {os.path.getsize(filepath) / 2**20:6.1f} MiB")
+
+def _zipfile_parts(parts, filepath, compresslevel):
+    """Serial deflate through zipfile, as wb.save() does"""
+    with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as archive:
+        for name, data in parts.items():
+            archive.writestr(name, data)
+
+def bench_compression(rows):
+    """Write throughput and output size of the large sheet's package, zipfile vs write_zip_parts"""
+    report = report_module()
+    with tempfile.TemporaryDirectory() as folder:
+        filepath = os.path.join(folder, 'large.xlsx')
+        report.write_openpyxl(large_sheet(report, rows), filepath)
+        parts = package_parts(filepath)
+        total = sum(map(len, parts.values()))
+        parallel = (os.cpu_count() or 1) > 1 and total >= report.PARALLEL_DEFLATE_MIN_BYTES
+        print(f"Package compression ({total / 2**20:.1f} MiB of parts, {os.cpu_count()} cores, "
+              f"write_zip_parts {'deflates in parallel' if parallel else 'falls back to zipfile'}):")
+        for level in sorted({report.INTERMEDIATE_COMPRESSLEVEL, 6, report.DOWNLOAD_COMPRESSLEVEL}):
+            for name, save in (('zipfile', _zipfile_parts), ('write_zip_parts', report.write_zip_parts)):
+                start = time.perf_counter()
+                save(parts, filepath, level)
+                elapsed = time.perf_counter() - start
+                size = os.path.getsize(filepath)
+                print(f"  level {level} {name:<15} {elapsed:6.2f} s  {total / elapsed / 2**20:6.1f} MiB/s  "
+                      f"size {size / 2**20:6.2f} MiB ({total / size:4.1f}x)")
+
+def bench_report(repeat=3):
+    """Time the real create_human_friendly_report path with every writer backend
+
+    The default template fill is used where the backend allows it, so this
+    measures what a normal run does rather than the writer on its own.
+    """
+    report = report_module()
+    data = report.generate_raw_data()
+    print(f"Report generation (create_human_friendly_report on generated data, median of {repeat}):")
+    with tempfile.TemporaryDirectory() as folder:
+        for name in sorted(report.WRITER_BACKENDS):
+            filepath = os.path.join(folder, f'{name}.xlsx')
+            timings = []
+            for _ in range(repeat + 1):  # the first run builds the template
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    report.create_human_friendly_report(data, filepath, writer=name)
+                timings.append(time.perf_counter() - start)
+            path = 'rendered' if name in report.STREAMING_WRITERS else 'template'
+            print(f"  {name:<12} {statistics.median(timings[1:]):8.2f} s  ({path})  "
+                  f"size {os.path.getsize(filepath) / 2**20:6.2f} MiB")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the NHS report generator")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per measurement (default: 5)")
+    parser.add_argument('--budget-ms', type=float,
+                        help="Fail when `--help` takes longer than this many milliseconds")
+    parser.add_argument('--report-repeat', type=int, default=3,
+                        help="Timed runs of the full report per writer backend, 0 to skip (default: 3)")
+    parser.add_argument('--writer-rows', type=int, default=20000,
+                        help="Rows of the large sheet written with each writer backend and deflated at "
+                             "each compression level, 0 to skip (default: 20000)")
+    args = parser.parse_args(argv)
+
+    help_ms = bench_startup(repeat=args.repeat)
+    if args.budget_ms is not None and help_ms > args.budget_ms:
+        print(f"[FAIL] Startup {help_ms:.1f} ms exceeds budget of {args.budget_ms:.1f} ms")
+        sys.exit(1)
+    if args.writer_rows:
+        bench_writers(args.writer_rows)
+        bench_compression(args.writer_rows)
+    if args.report_repeat:
+        bench_report(args.report_repeat)
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,24 @@
-import pandas as pd
-import numpy as np
-from datetime import datetime, timedelta
-import random
+# Heavy libraries (pandas, numpy, openpyxl) are imported inside the stages that
+# use them so `--help` and light runs start quickly; see benchmark_reports.py
 import os
-from openpyxl import Workbook, load_workbook
-from openpyxl.chart import BarChart, LineChart, PieChart, Reference
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.drawing.image import Image
-from openpyxl.chart.axis import DateAxis
+import re
+import json
+import math
+import time
+import zlib
+import random
 import string
+import struct
+import heapq
+import hashlib
+import zipfile
+import argparse
+import itertools
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape as xml_escape, unescape as xml_unescape
 
 script_folder = os.path.dirname(os.path.abspath(__file__))
 public_folder = os.path.join(script_folder, 'public')
-os.makedirs(public_folder, exist_ok=True)
 
 def generate_patient_ids(count):
     """Generate NHS-style patient IDs"""
@@ -53,6 +58,8 @@ def generate_medication_codes():
 
 def generate_raw_data():
     """Generate raw NHS data for input file"""
+    import pandas as pd
+    import numpy as np
     np.random.seed(42)
     random.seed(42)
 
@@ -131,6 +138,7 @@ def generate_raw_data():
         })
 
     # Generate admission data
+    ward_codes = [''.join(random.choices(string.ascii_uppercase, k=3)) + str(random.randint(1, 9)) for _ in range(8)]
     admissions = []
     for _ in range(500):
         admission_date = datetime.now() - timedelta(days=random.randint(0, 730))
@@ -139,7 +147,7 @@ def generate_raw_data():
             'patient_id': random.choice(patient_ids),
             'admission_date': admission_date,
             'discharge_date': admission_date + timedelta(days=los),
-            'ward_code': ''.join(random.choices(string.ascii_uppercase, k=3)) + str(random.randint(1, 9)),
+            'ward_code': random.choice(ward_codes),
             'admission_method': np.random.choice(range(11, 31)),
             'discharge_destination': np.random.choice(range(19, 99)),
             'primary_diagnosis': random.choice(list(conditions.keys())),
@@ -147,375 +155,1700 @@ def generate_raw_data():
             'readmission_flag': np.random.choice([0, 1], p=[0.85, 0.15])
         })
 
-    # Generate QOF metrics
-    qof_metrics = []
-    qof_indicators = ['DM001', 'DM002', 'CHD001', 'HYP001', 'AST001', 'MH001', 'CAN001', 'COPD001', 'AF001', 'PAL001']
-    for indicator in qof_indicators:
-        qof_metrics.append({
-            'indicator_code': indicator,
-            'numerator': np.random.randint(100, 400),
-            'denominator': np.random.randint(400, 500),
-            'achievement_points': np.random.uniform(0, 100),
-            'target_percentage': np.random.uniform(70, 95),
-            'exception_reporting': np.random.uniform(0, 15)
-        })
-
     return {
         'demographics': pd.DataFrame(demographics_data),
         'diagnoses': pd.DataFrame(diagnoses_records),
         'medications': pd.DataFrame(medications_records),
         'appointments': pd.DataFrame(appointments_records),
         'test_results': pd.DataFrame(test_results),
-        'admissions': pd.DataFrame(admissions),
-        'qof_metrics': pd.DataFrame(qof_metrics)
+        'admissions': pd.DataFrame(admissions)
     }
 
+# Deflate levels of saved workbooks: internal intermediates such as
+# input-report.xlsx favour speed, client downloads favour size
+INTERMEDIATE_COMPRESSLEVEL = 1
+DOWNLOAD_COMPRESSLEVEL = 9
+# Parts are deflated in blocks of this size on all cores. As in pigz, every block
+# is primed with the 32 KiB before it and ends byte-aligned, so the joined blocks
+# form one ordinary deflate stream that compresses about as well as a serial one.
+DEFLATE_BLOCK_SIZE = 1 << 20
+DEFLATE_WINDOW = 1 << 15
+# Below this many bytes, or on a single core, the thread pool costs more than it
+# saves and packages go through zipfile's serial deflate
+PARALLEL_DEFLATE_MIN_BYTES = 4 * DEFLATE_BLOCK_SIZE
+
+def _deflate_block(data, start, compresslevel):
+    """Raw deflate of the block of `data` at `start`, continuing the blocks before it"""
+    end = min(start + DEFLATE_BLOCK_SIZE, len(data))
+    primer = {'zdict': data[max(start - DEFLATE_WINDOW, 0):start]} if start else {}
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, **primer)
+    return compressor.compress(data[start:end]) + compressor.flush(zlib.Z_FINISH if end == len(data) else zlib.Z_SYNC_FLUSH)
+
+def write_zip_parts(parts, filepath, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Write package parts (name -> bytes) to a deflated zip, compressing blocks in parallel
+
+    zlib releases the GIL while compressing, so a thread pool keeps every core
+    busy. Small packages, single-core hosts and packages that need zip64
+    headers go through zipfile instead.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    size = sum(map(len, parts.values()))
+    if ((os.cpu_count() or 1) < 2 or size < PARALLEL_DEFLATE_MIN_BYTES
+            or len(parts) >= zipfile.ZIP_FILECOUNT_LIMIT or size >= zipfile.ZIP64_LIMIT):
+        with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as archive:
+            for name, data in parts.items():
+                archive.writestr(name, data)
+        return
+
+    year, month, day, hour, minute, second = time.localtime()[:6]
+    dos_time, dos_date = hour << 11 | minute << 5 | second // 2, (year - 1980) << 9 | month << 5 | day
+    central = []
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor, open(filepath, 'wb') as f:
+        blocks = {name: [executor.submit(_deflate_block, memoryview(data), start, compresslevel)
+                         for start in range(0, len(data) or 1, DEFLATE_BLOCK_SIZE)]
+                  for name, data in parts.items()}
+        for name, data in parts.items():
+            compressed = b''.join(block.result() for block in blocks[name])
+            encoded = name.encode()
+            entry = struct.pack('<HHHHHIIIHH', 20, 0, zipfile.ZIP_DEFLATED, dos_time, dos_date,
+                                zlib.crc32(data), len(compressed), len(data), len(encoded), 0)
+            central.append(b'PK\x01\x02' + struct.pack('<H', 20) + entry +
+                           struct.pack('<HHHII', 0, 0, 0, 0, f.tell()) + encoded)
+            f.write(b'PK\x03\x04' + entry + encoded)
+            f.write(compressed)
+        offset = f.tell()
+        f.write(b''.join(central))
+        f.write(b'PK\x05\x06' + struct.pack('<HHHHIIH', 0, 0, len(central), len(central),
+                                             f.tell() - offset, offset, 0))
+
+def stream_workbook(wb, filepath, compresslevel=INTERMEDIATE_COMPRESSLEVEL):
+    """Save an openpyxl workbook as wb.save() does, part by part straight into the
+    file, but at the given deflate level; for raw exports of unbounded size"""
+    from openpyxl.writer.excel import ExcelWriter
+    ExcelWriter(wb, zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True,
+                                    compresslevel=compresslevel)).save()
+
+def save_workbook(wb, filepath, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Save an openpyxl workbook with write_zip_parts rather than wb.save()'s serial deflate
+
+    The whole package is held in memory, so this is only for reports, whose
+    size is bounded; raw exports go through stream_workbook.
+    """
+    import io
+    from openpyxl.writer.excel import ExcelWriter
+    buffer = io.BytesIO()
+    ExcelWriter(wb, zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED)).save()
+    with zipfile.ZipFile(buffer) as archive:
+        parts = {info.filename: archive.read(info) for info in archive.infolist()}
+    write_zip_parts(parts, filepath, compresslevel)
+
+# Excel caps every sheet at 1,048,576 rows including the header
+EXCEL_MAX_ROWS = 1048576
+MANIFEST_SHEET = 'manifest'
+
+def _frame_rows(df, chunk_size=100000):
+    """Yield DataFrame rows as plain tuples with missing values blanked"""
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        yield from chunk.itertuples(index=False, name=None)
+
+def write_sharded_excel(tables, filepath, max_rows=EXCEL_MAX_ROWS, compresslevel=INTERMEDIATE_COMPRESSLEVEL,
+                        columns=None):
+    """Stream tables into a workbook, continuing oversized tables on extra sheets
+
+    `tables` maps a table name to a DataFrame or an iterable of DataFrame chunks.
+    When a sheet fills up it is renamed to table_1 and the rows continue on
+    table_2, table_3, ... A manifest sheet lists the shards of every table.
+
+    `columns` optionally maps a table to its column names so a chunk iterator
+    that yields nothing still gets a header-only sheet and a 0-row shard.
+    """
+    import pandas as pd
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    manifest = []
+
+    for table, frames in tables.items():
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+
+        shards = []
+        ws = None
+        first_row = 0
+        header = list((columns or {}).get(table, []))
+        for df in frames:
+            header = list(df.columns)
+            for values in _frame_rows(df):
+                if ws is None or shards[-1]['rows'] == max_rows - 1:
+                    part = len(shards) + 1
+                    if part == 2:
+                        ws.title = f"{table}_1"
+                        shards[0]['sheet'] = ws.title
+                    ws = wb.create_sheet(table if part == 1 else f"{table}_{part}")
+                    ws.append(list(df.columns))
+                    shards.append({'table': table, 'sheet': ws.title, 'part': part,
+                                   'first_row': first_row, 'rows': 0})
+                ws.append(values)
+                shards[-1]['rows'] += 1
+                first_row += 1
+
+        if ws is None:  # Keep empty tables readable with just a header row
+            ws = wb.create_sheet(table)
+            ws.append(header)
+            shards.append({'table': table, 'sheet': table, 'part': 1,
+                           'first_row': 0, 'rows': 0})
+
+        manifest.extend(shards)
+
+    ws = wb.create_sheet(MANIFEST_SHEET)
+    ws.append(['table', 'sheet', 'part', 'first_row', 'rows'])
+    for shard in manifest:
+        ws.append([shard['table'], shard['sheet'], shard['part'], shard['first_row'], shard['rows']])
+
+    stream_workbook(wb, filepath, compresslevel)
+    return manifest
+
 def save_raw_data(data_dict, filepath):
     """Save raw data to Excel file with multiple sheets"""
-    with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-        for sheet_name, df in data_dict.items():
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    write_sharded_excel(data_dict, filepath)
     print(f"Raw data saved to {filepath}")
 
-def create_human_friendly_report(data_dict, filepath):
-    """Transform raw data into human-friendly report with charts"""
-
-    wb = Workbook()
-
-    # Create Executive Summary sheet
-    ws_summary = wb.active
-    ws_summary.title = "Executive Summary"
-
-    # Styling
-    header_font = Font(bold=True, size=14, color="FFFFFF")
-    header_fill = PatternFill(start_color="2B579A", end_color="2B579A", fill_type="solid")
-    subheader_font = Font(bold=True, size=12)
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
+# Chart series are rolled up and downsampled to keep written cells and chart points bounded
+CHART_MAX_POINTS = 365
+ROLLUP_GRANULARITIES = ['hour', 'day', 'week', 'month']
+ROLLUP_LABEL_FORMATS = {'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d', 'week': '%Y-%m-%d', 'month': '%Y-%m'}
+
+def _floor_timestamps(timestamps, granularity):
+    """Truncate timestamps to the start of their hour, day, week (Monday) or month"""
+    import pandas as pd
+    timestamps = pd.DatetimeIndex(timestamps)
+    if granularity == 'hour':
+        return timestamps.floor('h')
+    if granularity == 'day':
+        return timestamps.normalize()
+    if granularity == 'week':
+        return timestamps.normalize() - pd.to_timedelta(timestamps.dayofweek, unit='D')
+    if granularity == 'month':
+        return timestamps.to_period('M').to_timestamp()
+    raise ValueError(f"Unknown granularity: {granularity}")
+
+def rollup_series(df, time_col, value_col=None, granularities=ROLLUP_GRANULARITIES, agg='mean'):
+    """Roll a time series up to several granularities with one pass over the rows
+
+    Rows are bucketed once at the finest requested granularity keeping sums and
+    counts; coarser levels are combined from those partials. `agg` is 'mean',
+    'sum' or 'count' (with no value_col, rows are counted).
+    """
+    import pandas as pd
+    granularities = sorted(granularities, key=ROLLUP_GRANULARITIES.index)
+    keys = _floor_timestamps(df[time_col], granularities[0])
+    if value_col is None:
+        partial = pd.DataFrame({'sum': 1, 'count': 1}, index=keys).groupby(level=0).sum()
+    else:
+        partial = df[value_col].groupby(keys).agg(['sum', 'count'])
+
+    rollups = {}
+    for granularity in granularities:
+        level = partial.groupby(_floor_timestamps(partial.index, granularity)).sum()
+        rollups[granularity] = level['sum'] / level['count'] if agg == 'mean' else level[agg]
+    return rollups
+
+def lttb_indices(x, y, max_points):
+    """Pick at most max_points indices with Largest-Triangle-Three-Buckets
+
+    The first and last points are kept; every bucket in between contributes the
+    point forming the largest triangle with the previous pick and the mean of
+    the next bucket, which preserves peaks and troughs of the series.
+    """
+    import numpy as np
+    n = len(y)
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.append(np.linspace(1, n - 1, max_points - 1).astype(int), n)
+    selected = np.empty(max_points, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+
+    a = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2]
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[bucket + 1] = a
+    return selected
+
+def build_chart_series(df, time_col, value_col=None, granularity='day', agg='mean', max_points=CHART_MAX_POINTS):
+    """Build a chart-ready series: rolled up, downsampled to max_points and labelled
+
+    With granularity='auto' the finest rollup that fits the point budget is used;
+    anything still over budget is reduced with LTTB. Returns a Series indexed by
+    period labels, in time order.
+    """
+    levels = ROLLUP_GRANULARITIES if granularity == 'auto' else [granularity]
+    rollups = rollup_series(df, time_col, value_col, levels, agg)
+    granularity = next((level for level in levels if len(rollups[level]) <= max_points), levels[-1])
+    series = rollups[granularity].dropna()
+
+    keep = lttb_indices(series.index.asi8, series.to_numpy(dtype=float), max_points)
+    series = series.iloc[keep]
+    series.index = series.index.strftime(ROLLUP_LABEL_FORMATS[granularity])
+    series.name = value_col or 'count'
+    return series
+
+# Results outside the reference range by more than this share of its width are critical
+CRITICAL_RANGE_MARGIN = 0.5
+
+def evaluate_test_results(results_df, critical_margin=CRITICAL_RANGE_MARGIN):
+    """Derive abnormal (0 Normal, 1 High, 2 Low) and critical flags from the reference range
+
+    Bounds may arrive as numbers or text; both are coerced in one vectorized step
+    and results without a usable range are left unevaluated.
+    """
+    import pandas as pd
+    import numpy as np
+    value = pd.to_numeric(results_df['result_value'], errors='coerce')
+    low = pd.to_numeric(results_df['reference_min'], errors='coerce')
+    high = pd.to_numeric(results_df['reference_max'], errors='coerce')
+    width = high - low
+
+    evaluated = results_df.copy()
+    evaluated['evaluable'] = value.notna() & low.notna() & high.notna()
+    evaluated['derived_flag'] = np.select([value > high, value < low], [1, 2], default=0)
+    evaluated['critical'] = (value > high + critical_margin * width) | (value < low - critical_margin * width)
+    return evaluated
+
+def summarize_test_flags(evaluated):
+    """Abnormal and critical counts and rates per test_code in one grouped pass"""
+    summary = evaluated.assign(
+        high=evaluated['derived_flag'] == 1,
+        low=evaluated['derived_flag'] == 2
+    ).groupby('test_code').agg(
+        results=('evaluable', 'size'),
+        evaluable=('evaluable', 'sum'),
+        high=('high', 'sum'),
+        low=('low', 'sum'),
+        critical=('critical', 'sum')
     )
-
-    # Title
-    ws_summary['A1'] = "NHS Integration Platform - Clinical Dashboard Report"
-    ws_summary['A1'].font = Font(bold=True, size=16)
-    ws_summary.merge_cells('A1:H1')
-
-    ws_summary['A3'] = f"Report Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-    ws_summary['A4'] = f"Reporting Period: {(datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d')} to {datetime.now().strftime('%Y-%m-%d')}"
-
-    # Key Metrics
-    ws_summary['A6'] = "KEY PERFORMANCE INDICATORS"
-    ws_summary['A6'].font = header_font
-    ws_summary['A6'].fill = header_fill
-    ws_summary.merge_cells('A6:D6')
-
-    total_patients = len(data_dict['demographics'])
-    active_patients = len(data_dict['appointments']['patient_id'].unique())
-    total_appointments = len(data_dict['appointments'])
-    completed_appointments = len(data_dict['appointments'][data_dict['appointments']['status'] == 2])
-
-    metrics = [
-        ['Metric', 'Value', 'Target', 'Status'],
+    evaluable = summary['evaluable'].where(summary['evaluable'] > 0)
+    summary['abnormal_pct'] = ((summary['high'] + summary['low']) / evaluable * 100).round(1)
+    summary['critical_pct'] = (summary['critical'] / evaluable * 100).round(1)
+    return summary.sort_values('abnormal_pct', ascending=False)
+
+# Admissions starting within this many days of the previous discharge are readmissions
+READMISSION_WINDOW_DAYS = 30
+LOS_BANDS = [(0, 1), (2, 3), (4, 7), (8, 14), (15, 29), (30, None)]
+
+def los_band_labels():
+    return [f'{low}-{high}d' if high is not None else f'{low}+d' for low, high in LOS_BANDS]
+
+def derive_readmissions(admissions_df, window_days=READMISSION_WINDOW_DAYS):
+    """Flag episodes that start within `window_days` of the patient's previous discharge
+
+    Episodes are sorted once by patient and admission date; the previous
+    discharge comes from a grouped shift, so no per-patient Python loop runs.
+    Overlapping episodes (admitted before the previous discharge) are not counted.
+    """
+    import pandas as pd
+    episodes = admissions_df.assign(
+        admission_date=pd.to_datetime(admissions_df['admission_date']),
+        discharge_date=pd.to_datetime(admissions_df['discharge_date'])
+    ).sort_values(['patient_id', 'admission_date'], kind='stable')
+    previous_discharge = episodes.groupby('patient_id', sort=False)['discharge_date'].shift()
+    episodes['days_since_discharge'] = (episodes['admission_date'] - previous_discharge).dt.days
+    episodes['readmission'] = episodes['days_since_discharge'].between(0, window_days)
+    episodes['los'] = (episodes['discharge_date'] - episodes['admission_date']).dt.days
+    return episodes
+
+def summarize_ward_los(episodes):
+    """Length-of-stay statistics, LOS band counts and readmissions per ward"""
+    import pandas as pd
+    import numpy as np
+    wards = episodes.groupby('ward_code')
+    summary = wards.agg(
+        admissions=('los', 'size'),
+        mean_los=('los', 'mean'),
+        median_los=('los', 'median'),
+        readmissions=('readmission', 'sum')
+    )
+    summary['p90_los'] = wards['los'].quantile(0.9)
+
+    edges = [low for low, _ in LOS_BANDS] + [np.inf]
+    labels = los_band_labels()
+    bands = pd.cut(episodes['los'], bins=edges, right=False, labels=labels)
+    summary = summary.join(pd.crosstab(episodes['ward_code'], bands).reindex(columns=labels, fill_value=0))
+    summary['readmission_pct'] = (summary['readmissions'] / summary['admissions'] * 100).round(1)
+    summary[['mean_los', 'p90_los']] = summary[['mean_los', 'p90_los']].round(1)
+    return summary.sort_values('admissions', ascending=False)
+
+# QOF indicators as rules over the clinical tables. The denominator (register)
+# is patients with an active diagnosis of any listed SNOMED code; the numerator
+# is register patients whose latest test value meets the bound, who have an
+# active prescription of any listed dm+d code and/or whose last completed
+# appointment falls within the review window. Points scale linearly between the
+# lower and upper achievement thresholds (%).
+QOF_INDICATORS = [
+    {'code': 'DM001', 'description': 'Diabetes: latest HbA1c 58 mmol/mol or less',
+     'register': ['73211009'], 'latest': {'test': 'HBA1C', 'at_most': 58}, 'thresholds': (35, 75), 'points': 17},
+    {'code': 'DM002', 'description': 'Diabetes: latest systolic BP 140 mmHg or less',
+     'register': ['73211009'], 'latest': {'test': 'BP_SYS', 'at_most': 140}, 'thresholds': (38, 78), 'points': 10},
+    {'code': 'DM003', 'description': 'Diabetes: on a statin',
+     'register': ['73211009'], 'medication': ['374804007'], 'thresholds': (50, 90), 'points': 4},
+    {'code': 'CHD001', 'description': 'CHD: latest systolic BP 140 mmHg or less',
+     'register': ['53741008'], 'latest': {'test': 'BP_SYS', 'at_most': 140}, 'thresholds': (53, 93), 'points': 17},
+    {'code': 'CHD002', 'description': 'CHD: on aspirin',
+     'register': ['53741008'], 'medication': ['387458008'], 'thresholds': (56, 96), 'points': 7},
+    {'code': 'HYP001', 'description': 'Hypertension: latest systolic BP 150 mmHg or less',
+     'register': ['38341003'], 'latest': {'test': 'BP_SYS', 'at_most': 150}, 'thresholds': (40, 80), 'points': 20},
+    {'code': 'AST001', 'description': 'Asthma: reliever inhaler prescribed',
+     'register': ['195967001'], 'medication': ['376584008'], 'thresholds': (45, 70), 'points': 20},
+    {'code': 'MH001', 'description': 'Depression or anxiety: reviewed in the last 12 months',
+     'register': ['35489007', '197480006'], 'reviewed_within_days': 365, 'thresholds': (45, 80), 'points': 10},
+    {'code': 'COPD001', 'description': 'COPD: reliever inhaler prescribed',
+     'register': ['13645005'], 'medication': ['376584008'], 'thresholds': (50, 90), 'points': 9},
+    {'code': 'AF001', 'description': 'Atrial fibrillation: reviewed in the last 12 months',
+     'register': ['49436004'], 'reviewed_within_days': 365, 'thresholds': (45, 80), 'points': 12},
+    {'code': 'HF001', 'description': 'Heart failure: on an ACE inhibitor with eGFR 30 or more',
+     'register': ['84114007'], 'medication': ['391761004'], 'latest': {'test': 'EGFR', 'at_least': 30},
+     'thresholds': (60, 92), 'points': 6}
+]
+
+def qof_patient_lookups(frames):
+    """Per-patient lookups shared by every QOF indicator
+
+    Active registers, latest value per test, active prescriptions and the last
+    completed appointment are each built with one pass over their table and
+    aligned to the registered patients, so indicators only combine columns
+    instead of rescanning the tables.
+    """
+    import pandas as pd
+    patients = pd.Index(frames['demographics']['patient_id'].unique(), name='patient_id')
+
+    diagnoses = frames['diagnoses']
+    active = diagnoses[diagnoses['status_code'] == 1]
+    registers = pd.crosstab(active['patient_id'], active['snomed_code'].astype(str)).gt(0)
+
+    tests = frames['test_results']
+    latest = tests.sort_values('test_date', kind='stable').drop_duplicates(['patient_id', 'test_code'], keep='last')
+    latest = latest.pivot(index='patient_id', columns='test_code', values='result_value')
+
+    medications = frames['medications']
+    current = medications[medications['status'] == 1]
+    prescribed = pd.crosstab(current['patient_id'], current['dm_d_code'].astype(str)).gt(0)
+
+    appointments = frames['appointments']
+    now = pd.Timestamp.now()
+    completed = appointments[(appointments['status'] == 2) & (appointments['appointment_date'] <= now)]
+    days_since_seen = (now - completed.groupby('patient_id')['appointment_date'].max()).dt.days
+
+    return {'registers': registers.reindex(patients, fill_value=False),
+            'latest': latest.reindex(patients),
+            'prescribed': prescribed.reindex(patients, fill_value=False),
+            'days_since_seen': days_since_seen.reindex(patients)}
+
+def _any_code(lookup, codes):
+    """Patients flagged for any of the codes; codes absent from the data match no one"""
+    return lookup.reindex(columns=codes, fill_value=False).any(axis=1)
+
+def evaluate_qof_indicators(lookups, indicators=QOF_INDICATORS):
+    """Numerator, denominator and points of every indicator from the shared lookups"""
+    import pandas as pd
+    rows = []
+    for rule in indicators:
+        register = _any_code(lookups['registers'], rule['register'])
+        achieved = register.copy()
+        if 'latest' in rule:
+            bound = rule['latest']
+            values = lookups['latest'].reindex(columns=[bound['test']])[bound['test']]
+            if 'at_most' in bound:
+                achieved &= values.le(bound['at_most'])
+            if 'at_least' in bound:
+                achieved &= values.ge(bound['at_least'])
+        if 'medication' in rule:
+            achieved &= _any_code(lookups['prescribed'], rule['medication'])
+        if 'reviewed_within_days' in rule:
+            achieved &= lookups['days_since_seen'].le(rule['reviewed_within_days'])
+
+        denominator, numerator = int(register.sum()), int(achieved.sum())
+        rate = numerator / denominator * 100 if denominator else 0.0
+        lower, upper = rule['thresholds']
+        rows.append({
+            'indicator_code': rule['code'],
+            'description': rule['description'],
+            'numerator': numerator,
+            'denominator': denominator,
+            'achievement_points': rule['points'] * min(max((rate - lower) / (upper - lower), 0.0), 1.0),
+            'target_percentage': float(upper)
+        })
+    return pd.DataFrame(rows)
+
+# Pairs listed per table on the multimorbidity sheet
+COOCCURRENCE_TOP_PAIRS = 10
+
+def build_incidence_matrix(df, row_col, code_col, row_index=None):
+    """Sparse 0/1 matrix with a row per `row_col` value and a column per code
+
+    Rows follow `row_index` when given, so matrices built from different tables
+    over the same patients can be multiplied. Repeated records collapse to 1.
+    Returns the CSR matrix and the codes labelling its columns.
+    """
+    import pandas as pd
+    import numpy as np
+    from scipy import sparse
+    if row_index is None:
+        row_index = pd.Index(df[row_col].dropna().unique())
+    rows = row_index.get_indexer(df[row_col])
+    cols, codes = pd.factorize(df[code_col], sort=True)
+    keep = (rows >= 0) & (cols >= 0)
+    matrix = sparse.csr_matrix((np.ones(keep.sum(), dtype=np.int32), (rows[keep], cols[keep])),
+                               shape=(len(row_index), len(codes)))
+    matrix.data[:] = 1  # duplicates were summed on construction
+    return matrix, pd.Index(codes)
+
+def top_cooccurring_pairs(counts, top=COOCCURRENCE_TOP_PAIRS):
+    """Row positions, column positions and counts of the largest entries of a
+    sparse co-occurrence matrix, ties broken by position"""
+    import numpy as np
+    counts = counts.tocoo()
+    order = np.lexsort((counts.col, counts.row, -counts.data))[:top]
+    return counts.row[order], counts.col[order], counts.data[order]
+
+def _patient_incidence(frames, nodes, options):
+    # One patient axis shared by both matrices so they can be multiplied together
+    import pandas as pd
+    diagnoses, medications = frames['diagnoses'], frames['medications']
+    patients = pd.Index(pd.concat([diagnoses['patient_id'], medications['patient_id']]).dropna().unique())
+    conditions, snomed_codes = build_incidence_matrix(diagnoses, 'patient_id', 'snomed_code', patients)
+    prescriptions, dmd_codes = build_incidence_matrix(medications, 'patient_id', 'dm_d_code', patients)
+    return {'conditions': conditions, 'snomed_codes': snomed_codes,
+            'prescriptions': prescriptions, 'dmd_codes': dmd_codes}
+
+def _multimorbidity_summary(frames, nodes, options):
+    import numpy as np
+    per_patient = np.asarray(nodes['incidence']['conditions'].sum(axis=1)).ravel()
+    diagnosed = int((per_patient > 0).sum())
+    rows = [['Patients with a recorded condition', f"{scale_count(diagnosed, options):,}"]]
+    for threshold in (2, 3):
+        patients = int((per_patient >= threshold).sum())
+        share = patients / diagnosed * 100 if diagnosed else 0.0
+        rows.append([f'Patients with {threshold}+ conditions', f"{scale_count(patients, options):,} ({share:.1f}%)"])
+    mean_conditions = per_patient[per_patient > 0].mean() if diagnosed else 0.0
+    rows.append(['Mean conditions per diagnosed patient', f"{mean_conditions:.2f}"])
+    return rows
+
+def _condition_pairs(frames, nodes, options):
+    import pandas as pd
+    from scipy import sparse
+    incidence = nodes['incidence']
+    conditions = incidence['conditions']
+    cooccurrence = (conditions.T @ conditions).tocsr()
+    prevalence = cooccurrence.diagonal()
+    rows, cols, counts = top_cooccurring_pairs(sparse.triu(cooccurrence, k=1))
+    names = generate_snomed_codes()
+    codes = incidence['snomed_codes']
+    return preview_table(pd.DataFrame({
+        'condition_a': [names.get(code, code) for code in codes[rows]],
+        'condition_b': [names.get(code, code) for code in codes[cols]],
+        'patients': counts,
+        'pct_of_a': (counts / prevalence[rows] * 100).round(1),
+        'pct_of_b': (counts / prevalence[cols] * 100).round(1)
+    }), options, ['patients'])
+
+def _condition_medications(frames, nodes, options):
+    import pandas as pd
+    import numpy as np
+    incidence = nodes['incidence']
+    conditions = incidence['conditions']
+    links = conditions.T @ incidence['prescriptions']
+    prevalence = np.asarray(conditions.sum(axis=0)).ravel()
+    rows, cols, counts = top_cooccurring_pairs(links)
+    condition_names = generate_snomed_codes()
+    medication_names = generate_medication_codes()
+    return preview_table(pd.DataFrame({
+        'condition': [condition_names.get(code, code) for code in incidence['snomed_codes'][rows]],
+        'medication': [medication_names.get(code, code) for code in incidence['dmd_codes'][cols]],
+        'patients': counts,
+        'pct_of_condition': (counts / prevalence[rows] * 100).round(1)
+    }), options, ['patients'])
+
+# Preview reports are computed from a stratified sample of patients sized to a
+# time budget; every row of a sampled patient is kept, so joins, registers and
+# readmissions stay intact. Counts are scaled up to all patients and rates get
+# 95% Wilson score intervals.
+PREVIEW_BUDGET = 5.0  # seconds
+PREVIEW_STRATA = ['gp_practice_code']
+PREVIEW_PILOT_PATIENTS = 200
+PREVIEW_Z = 1.96
+
+def stratified_order(df, strata, seed=0):
+    """Row positions ordered by stratum, then at random"""
+    import numpy as np
+    keys = [np.random.default_rng(seed).random(len(df))]
+    if strata:
+        keys.append(df.groupby(strata, sort=True, dropna=False).ngroup().to_numpy())
+    return np.lexsort(keys)
+
+def stratified_positions(order, fraction, seed=0):
+    """Proportional stratified sample of about `fraction` of the ordered rows
+
+    Every (1/fraction)-th row is taken from a random start, so each stratum keeps
+    its share of the sample even when it has fewer than 1/fraction rows (as most
+    GP practices do in a small extract).
+    """
+    import numpy as np
+    if fraction >= 1:
+        return np.arange(len(order))
+    steps = np.floor(np.arange(len(order) + 1) * fraction + np.random.default_rng(seed).random())
+    return np.sort(order[np.diff(steps) > 0])
+
+def sample_frames(frames, patient_ids, ranking, fraction):
+    """Keep the rows of a stratified sample of patients in every patient-level table
+
+    `ranking` is the stratified_order of `patient_ids`. Returns the sampled
+    frames and the full and sampled patient counts.
+    """
+    chosen = patient_ids.iloc[stratified_positions(ranking, fraction)]
+    sampled = {table: df[df['patient_id'].isin(chosen)] if 'patient_id' in df else df
+               for table, df in frames.items()}
+    return sampled, {'patients': len(patient_ids), 'sampled': len(chosen)}
+
+def _sample_scale(options):
+    """Factor from sampled to all-patient counts; None unless patients were sampled"""
+    sample = options.get('sample')
+    if sample and sample['sampled'] < sample['patients']:
+        return sample['patients'] / sample['sampled']
+    return None
+
+def scale_count(count, options):
+    return round(count * (_sample_scale(options) or 1))
+
+def rate_interval(successes, trials, z=PREVIEW_Z):
+    """Wilson score interval of a proportion, in percent"""
+    import numpy as np
+    successes, trials = np.asarray(successes, dtype=float), np.asarray(trials, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = successes / trials
+        centre = (p + z**2 / (2 * trials)) / (1 + z**2 / trials)
+        margin = z * np.sqrt(p * (1 - p) / trials + z**2 / (4 * trials**2)) / (1 + z**2 / trials)
+    return (centre - margin) * 100, (centre + margin) * 100
+
+def _interval_text(low, high):
+    if not (math.isfinite(low) and math.isfinite(high)):
+        return ''
+    # Rounding error can leave the bounds just outside 0-100; + 0.0 turns -0.0 into 0.0
+    return f"{max(low, 0.0) + 0.0:.1f}–{min(high, 100.0):.1f}"
+
+def preview_table(df, options, counts=None, rates=None):
+    """Scale sampled count columns up to all patients and follow the table with a
+    95% CI column per rate, given as {label: (successes, trials)} where each is a
+    column name or values. With no `counts` every value is a count. Tables
+    outside previews pass through."""
+    scale = _sample_scale(options)
+    if scale is None:
+        return df
+    df = df.copy()
+    for label, (successes, trials) in (rates or {}).items():
+        low, high = rate_interval(df[successes] if isinstance(successes, str) else successes,
+                                  df[trials] if isinstance(trials, str) else trials)
+        df[f'{label} 95% CI'] = [_interval_text(*bounds) for bounds in zip(low, high)]
+    if counts is None:
+        return (df * scale).round().astype(int)
+    df[counts] = (df[counts] * scale).round().astype(int)
+    return df
+
+def _rate_text(successes, trials, options):
+    """A rate in percent, followed by its 95% CI in previews"""
+    text = f"{(successes/trials*100):.1f}%"
+    if _sample_scale(options) is not None:
+        text += f" ({_interval_text(*rate_interval(successes, trials))}%)"
+    return text
+
+def compute_nodes(order, frames, options):
+    nodes = {}
+    for name in order:
+        nodes[name] = REPORT_NODES[name]['compute'](frames, nodes, options)
+    return nodes
+
+def preview_nodes(order, frames, demographics, options, budget):
+    """Compute the nodes from the largest stratified patient sample that fits in `budget` seconds
+
+    A pilot of about PREVIEW_PILOT_PATIENTS patients is timed first and the
+    sample is then grown assuming compute time is linear in the sampled rows;
+    a pilot already at least half the affordable size is kept.
+    """
+    started = time.perf_counter()
+    patient_ids = demographics['patient_id']
+    ranking = stratified_order(demographics, [column for column in PREVIEW_STRATA if column in demographics])
+    fraction = min(1.0, PREVIEW_PILOT_PATIENTS / len(patient_ids)) if len(patient_ids) else 1.0
+    while True:
+        sampled, sample = sample_frames(frames, patient_ids, ranking, fraction)
+        computing = time.perf_counter()
+        nodes = compute_nodes(order, sampled, {**options, 'sample': sample})
+        elapsed = time.perf_counter() - computing
+        remaining = budget - (time.perf_counter() - started)
+        target = min(1.0, fraction * remaining / elapsed) if elapsed > 0 else 1.0
+        if fraction >= 1 or target < 2 * fraction:
+            return nodes
+        fraction = target
+
+# Bump whenever the report layout changes so cached templates are rebuilt
+REPORT_TEMPLATE_VERSION = 8
+template_folder = os.path.join(script_folder, 'report-templates')
+_template_cache = {}
+# Shapes include every table's row count, so batch runs see many; only the most
+# recently used templates are kept, in memory and on disk alike
+TEMPLATE_CACHE_SIZE = 32
+
+# Report nodes: each declares the raw columns it reads, the nodes it builds on
+# and how to compute its value. Sections below only name the nodes they show,
+# so shared intermediates (e.g. the age-grouped demographics behind both the
+# distribution tables and the pie chart) are computed once.
+def _summary_metrics(frames, nodes, options):
+    appointments = frames['appointments']
+    episodes = nodes['episodes']
+    readmission_rate = episodes['readmission'].mean()
+
+    total_patients = scale_count(len(frames['demographics']), options)
+    active_patients = scale_count(len(appointments['patient_id'].unique()), options)
+    sampled_appointments = len(appointments)
+    total_appointments = scale_count(sampled_appointments, options)
+    completed_appointments = len(appointments[appointments['status'] == 2])
+
+    return [
         ['Total Registered Patients', f"{total_patients:,}", '500', '✓'],
         ['Active Patients (with appointments)', f"{active_patients:,}", '400', '✓' if active_patients >= 400 else '✗'],
         ['Total Appointments', f"{total_appointments:,}", '1,800', '✓' if total_appointments >= 1800 else '✗'],
-        ['Appointment Completion Rate', f"{(completed_appointments/total_appointments*100):.1f}%", '85%', '✓' if completed_appointments/total_appointments >= 0.85 else '✗'],
-        ['Average Wait Time (days)', f"{data_dict['appointments']['wait_time_days'].mean():.1f}", '< 60', '✓' if data_dict['appointments']['wait_time_days'].mean() < 60 else '✗'],
-        ['30-Day Readmission Rate', f"{(data_dict['admissions']['readmission_flag'].mean()*100):.1f}%", '< 20%', '✓' if data_dict['admissions']['readmission_flag'].mean() < 0.20 else '✗']
+        ['Appointment Completion Rate', _rate_text(completed_appointments, sampled_appointments, options), '85%', '✓' if completed_appointments/sampled_appointments >= 0.85 else '✗'],
+        ['Average Wait Time (days)', f"{appointments['wait_time_days'].mean():.1f}", '< 60', '✓' if appointments['wait_time_days'].mean() < 60 else '✗'],
+        [f'{READMISSION_WINDOW_DAYS}-Day Readmission Rate', _rate_text(episodes['readmission'].sum(), len(episodes), options), '< 20%', '✓' if readmission_rate < 0.20 else '✗']
     ]
 
-    for row_idx, row_data in enumerate(metrics, start=8):
-        for col_idx, value in enumerate(row_data, start=1):
-            cell = ws_summary.cell(row=row_idx, column=col_idx, value=value)
-            if row_idx == 8:
-                cell.font = Font(bold=True)
-                cell.fill = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
-            cell.border = border
-
-    # Create Patient Demographics sheet
-    ws_demo = wb.create_sheet("Patient Demographics")
-
+def _demographics_by_age(frames, nodes, options):
     # Transform demographics data
-    conditions = generate_snomed_codes()
-    demo_df = data_dict['demographics'].copy()
+    import pandas as pd
+    demo_df = frames['demographics'].copy()
     demo_df['Gender'] = demo_df['gender_code'].map({1: 'Male', 2: 'Female', 9: 'Not Specified'})
-    demo_df['Age'] = ((datetime.now() - pd.to_datetime(demo_df['dob'])).dt.days / 365.25).astype(int)
+    demo_df['Age'] = ((nodes['generated'] - pd.to_datetime(demo_df['dob'])).dt.days / 365.25).astype(int)
     demo_df['Age Group'] = pd.cut(demo_df['Age'], bins=[0, 18, 30, 50, 65, 100], labels=['0-17', '18-29', '30-49', '50-64', '65+'])
+    return demo_df
 
-    # Add summary statistics to demographics sheet
-    ws_demo['A1'] = "PATIENT DEMOGRAPHICS ANALYSIS"
-    ws_demo['A1'].font = header_font
-    ws_demo['A1'].fill = header_fill
-    ws_demo.merge_cells('A1:F1')
-
-    # Age distribution summary
-    age_dist = demo_df['Age Group'].value_counts().sort_index()
-    ws_demo['A3'] = "Age Distribution"
-    ws_demo['A3'].font = subheader_font
-
-    row = 4
-    for age_group, count in age_dist.items():
-        ws_demo[f'A{row}'] = age_group
-        ws_demo[f'B{row}'] = count
-        ws_demo[f'C{row}'] = f"{(count/len(demo_df)*100):.1f}%"
-        row += 1
-
-    # Gender distribution
-    ws_demo['E3'] = "Gender Distribution"
-    ws_demo['E3'].font = subheader_font
-
-    gender_dist = demo_df['Gender'].value_counts()
-    row = 4
-    for gender, count in gender_dist.items():
-        ws_demo[f'E{row}'] = gender
-        ws_demo[f'F{row}'] = count
-        ws_demo[f'G{row}'] = f"{(count/len(demo_df)*100):.1f}%"
-        row += 1
-
-    # Create Clinical Conditions sheet
-    ws_clinical = wb.create_sheet("Clinical Conditions")
-
-    diag_df = data_dict['diagnoses'].copy()
-    diag_df['Condition'] = diag_df['snomed_code'].map(conditions)
-    diag_df['Status'] = diag_df['status_code'].map({1: 'Active', 2: 'Resolved', 3: 'Inactive'})
-
-    # Top conditions summary
-    ws_clinical['A1'] = "TOP 10 CLINICAL CONDITIONS"
-    ws_clinical['A1'].font = header_font
-    ws_clinical['A1'].fill = header_fill
-    ws_clinical.merge_cells('A1:D1')
-
-    condition_counts = diag_df['Condition'].value_counts().head(10)
-
-    ws_clinical['A3'] = 'Rank'
-    ws_clinical['B3'] = 'Condition'
-    ws_clinical['C3'] = 'Patient Count'
-    ws_clinical['D3'] = 'Prevalence %'
-
-    for col in ['A3', 'B3', 'C3', 'D3']:
-        ws_clinical[col].font = Font(bold=True)
-        ws_clinical[col].fill = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
+def _named_diagnoses(frames, nodes, options):
+    diag_df = frames['diagnoses'].copy()
+    diag_df['Condition'] = diag_df['snomed_code'].map(generate_snomed_codes())
+    return diag_df
 
-    for idx, (condition, count) in enumerate(condition_counts.items(), start=1):
-        ws_clinical[f'A{idx+3}'] = idx
-        ws_clinical[f'B{idx+3}'] = condition
-        ws_clinical[f'C{idx+3}'] = count
-        ws_clinical[f'D{idx+3}'] = f"{(count/len(diag_df['patient_id'].unique())*100):.1f}%"
-
-    # Create Medications sheet
-    ws_meds = wb.create_sheet("Medication Analysis")
-
-    meds_dict = generate_medication_codes()
-    meds_df = data_dict['medications'].copy()
-    meds_df['Medication'] = meds_df['dm_d_code'].map(meds_dict)
+def _named_medications(frames, nodes, options):
+    meds_df = frames['medications'].copy()
+    meds_df['Medication'] = meds_df['dm_d_code'].map(generate_medication_codes())
     meds_df['Status'] = meds_df['status'].map({1: 'Active', 2: 'Discontinued', 3: 'On-hold'})
+    return meds_df
 
-    ws_meds['A1'] = "MEDICATION PRESCRIBING PATTERNS"
-    ws_meds['A1'].font = header_font
-    ws_meds['A1'].fill = header_fill
-    ws_meds.merge_cells('A1:E1')
-
-    # Top prescribed medications
-    med_counts = meds_df['Medication'].value_counts().head(10)
-
-    ws_meds['A3'] = 'Rank'
-    ws_meds['B3'] = 'Medication'
-    ws_meds['C3'] = 'Prescriptions'
-    ws_meds['D3'] = 'Avg Adherence'
-    ws_meds['E3'] = 'Status'
-
-    for col in ['A3', 'B3', 'C3', 'D3', 'E3']:
-        ws_meds[col].font = Font(bold=True)
-        ws_meds[col].fill = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
-
-    for idx, (med, count) in enumerate(med_counts.items(), start=1):
-        ws_meds[f'A{idx+3}'] = idx
-        ws_meds[f'B{idx+3}'] = med
-        ws_meds[f'C{idx+3}'] = count
-        avg_adherence = meds_df[meds_df['Medication'] == med]['adherence_score'].mean()
-        ws_meds[f'D{idx+3}'] = f"{(avg_adherence*100):.1f}%"
-        active_count = len(meds_df[(meds_df['Medication'] == med) & (meds_df['Status'] == 'Active')])
-        ws_meds[f'E{idx+3}'] = f"{active_count}/{count} Active"
-
-    # Create QOF Performance sheet
-    ws_qof = wb.create_sheet("QOF Performance")
-
-    qof_df = data_dict['qof_metrics'].copy()
-    qof_df['Achievement Rate'] = (qof_df['numerator'] / qof_df['denominator'] * 100).round(1)
+def _qof_achievement(frames, nodes, options):
+    qof_df = evaluate_qof_indicators(nodes['qof_lookups'])
+    qof_df['Achievement Rate'] = (qof_df['numerator'] / qof_df['denominator'].where(qof_df['denominator'] > 0) * 100).fillna(0).round(1)
     qof_df['Target Met'] = qof_df['Achievement Rate'] >= qof_df['target_percentage']
+    return preview_table(qof_df, options, ['numerator', 'denominator'])
+
+def _monthly_appointments(frames, nodes, options):
+    return preview_table(build_chart_series(frames['appointments'], 'appointment_date', granularity='month',
+                                            agg='count', max_points=options['chart_max_points']).tail(6), options)
+
+def _preview_note(frames, nodes, options):
+    sample = options.get('sample')
+    if _sample_scale(options) is None:
+        return ''
+    return (f"Preview from a stratified sample of {sample['sampled']:,} of {sample['patients']:,} patients; "
+            f"counts are scaled and rates show 95% confidence intervals")
+
+def _ward_los(frames, nodes, options):
+    ward_los = summarize_ward_los(nodes['episodes'])
+    return preview_table(ward_los, options, ['admissions', 'readmissions'] + los_band_labels(),
+                         {'Readmission %': ('readmissions', 'admissions')})
+
+def _test_flags(frames, nodes, options):
+    flags = summarize_test_flags(evaluate_test_results(frames['test_results']))
+    return preview_table(flags, options, ['results', 'evaluable', 'high', 'low', 'critical'],
+                         {'Abnormal %': (flags['high'] + flags['low'], 'evaluable'),
+                          'Critical %': ('critical', 'evaluable')})
+
+REPORT_NODES = {
+    'generated': {
+        'compute': lambda frames, nodes, options: datetime.now()
+    },
+    'preview_note': {
+        'compute': _preview_note
+    },
+    'metrics': {
+        'inputs': {'demographics': ['patient_id'], 'appointments': ['patient_id', 'status', 'wait_time_days']},
+        'needs': ['episodes'],
+        'compute': _summary_metrics
+    },
+    'monthly_appts': {
+        'inputs': {'appointments': ['appointment_date']},
+        'compute': _monthly_appointments
+    },
+    'demographics_by_age': {
+        'inputs': {'demographics': ['dob', 'gender_code']},
+        'needs': ['generated'],
+        'compute': _demographics_by_age
+    },
+    'age_dist': {
+        'needs': ['demographics_by_age'],
+        'compute': lambda frames, nodes, options: preview_table(
+            nodes['demographics_by_age']['Age Group'].value_counts().sort_index(), options)
+    },
+    'gender_dist': {
+        'needs': ['demographics_by_age'],
+        'compute': lambda frames, nodes, options: preview_table(
+            nodes['demographics_by_age']['Gender'].value_counts(), options)
+    },
+    'patients': {
+        'inputs': {'demographics': ['patient_id']},
+        'compute': lambda frames, nodes, options: scale_count(len(frames['demographics']), options)
+    },
+    'named_diagnoses': {
+        'inputs': {'diagnoses': ['patient_id', 'snomed_code']},
+        'compute': _named_diagnoses
+    },
+    'condition_counts': {
+        'needs': ['named_diagnoses'],
+        'compute': lambda frames, nodes, options: preview_table(
+            nodes['named_diagnoses']['Condition'].value_counts().head(10), options)
+    },
+    'diagnosed_patients': {
+        'needs': ['named_diagnoses'],
+        'compute': lambda frames, nodes, options: scale_count(nodes['named_diagnoses']['patient_id'].nunique(), options)
+    },
+    'named_medications': {
+        'inputs': {'medications': ['dm_d_code', 'status', 'adherence_score']},
+        'compute': _named_medications
+    },
+    'med_counts': {
+        'needs': ['named_medications'],
+        'compute': lambda frames, nodes, options: preview_table(
+            nodes['named_medications']['Medication'].value_counts().head(10), options)
+    },
+    'med_summary': {
+        'needs': ['named_medications'],
+        'compute': lambda frames, nodes, options: preview_table(nodes['named_medications'].groupby('Medication').agg(
+            avg_adherence=('adherence_score', 'mean'),
+            active=('Status', lambda s: (s == 'Active').sum())
+        ), options, ['active'])
+    },
+    'qof_lookups': {
+        'inputs': {'demographics': ['patient_id'], 'diagnoses': ['patient_id', 'snomed_code', 'status_code'],
+                   'test_results': ['patient_id', 'test_code', 'result_value', 'test_date'],
+                   'medications': ['patient_id', 'dm_d_code', 'status'],
+                   'appointments': ['patient_id', 'appointment_date', 'status']},
+        'compute': lambda frames, nodes, options: qof_patient_lookups(frames)
+    },
+    'qof': {
+        'needs': ['qof_lookups'],
+        'compute': _qof_achievement
+    },
+    'test_flags': {
+        'inputs': {'test_results': ['test_code', 'result_value', 'reference_min', 'reference_max']},
+        'compute': _test_flags
+    },
+    'episodes': {
+        'inputs': {'admissions': ['patient_id', 'admission_date', 'discharge_date', 'ward_code']},
+        'compute': lambda frames, nodes, options: derive_readmissions(frames['admissions'])
+    },
+    'ward_los': {
+        'needs': ['episodes'],
+        'compute': _ward_los
+    },
+    'incidence': {
+        'inputs': {'diagnoses': ['patient_id', 'snomed_code'], 'medications': ['patient_id', 'dm_d_code']},
+        'compute': _patient_incidence
+    },
+    'multimorbidity': {
+        'needs': ['incidence'],
+        'compute': _multimorbidity_summary
+    },
+    'condition_pairs': {
+        'needs': ['incidence'],
+        'compute': _condition_pairs
+    },
+    'condition_medications': {
+        'needs': ['incidence'],
+        'compute': _condition_medications
+    }
+}
+
+# Report sheets are described independently of the xlsx library: a sheet is a
+# dict of styled cells keyed by (row, column), blocks of rows read lazily, merged
+# ranges, column widths, formula-based conditional formats and charts. A writer
+# backend pulls the sheet's rows in order through sheet_rows() and turns a list
+# of sheets into a workbook file, so each run can pick the one that suits it.
+def new_sheet(title):
+    return {'title': title, 'cells': {}, 'blocks': [], 'merges': [], 'widths': {}, 'rules': [], 'charts': []}
+
+def _cell_ref(ref):
+    """(row, column) of an 'A1' reference; tuples pass through"""
+    if isinstance(ref, tuple):
+        return ref
+    letters, row_idx = re.match(r'([A-Z]+)(\d+)$', ref).groups()
+    return int(row_idx), _column_index(letters)
+
+def put_cell(sheet, ref, value=None, style=None):
+    """Set a cell's value and/or add style properties; a bare call still creates it"""
+    cell = sheet['cells'].setdefault(_cell_ref(ref), {'value': None, 'style': {}})
+    if value is not None:
+        cell['value'] = value
+    if style:
+        cell['style'] = {**cell['style'], **style}
+
+def merge_cells(sheet, cell_range):
+    first, last = cell_range.split(':')
+    sheet['merges'].append((*_cell_ref(first), *_cell_ref(last)))
+    put_cell(sheet, first)
+
+def add_rows(sheet, first_row, rows, first_col=1, styles=None):
+    """Add a block of rows starting at the given corner, read only when the sheet is written
+
+    `rows` may be any iterable, e.g. a generator or DataFrame.itertuples(), and is
+    consumed once; `styles` gives one style per column of the block.
+    """
+    def block_cells():
+        for row_idx, row in enumerate(rows, start=first_row):
+            for offset, value in enumerate(row):
+                yield row_idx, first_col + offset, value, styles[offset] if styles else {}
+    sheet['blocks'].append(block_cells())
+
+def add_values(sheet, values):
+    """Add data values keyed by cell reference over the laid-out cells"""
+    cells = sorted(((*_cell_ref(ref), value, {}) for ref, value in values.items()), key=lambda cell: cell[:2])
+    sheet['blocks'].append(iter(cells))
+
+def sheet_rows(sheet):
+    """Yield (row, [(column, value, style), ...]) in row order
+
+    Cells and row blocks are merged as they are reached, so only one row is held
+    at a time; where they overlap, values fill blanks and styles combine.
+    """
+    static = ((row_idx, col_idx, cell['value'], cell['style'])
+              for (row_idx, col_idx), cell in sorted(sheet['cells'].items()))
+    merged = heapq.merge(static, *sheet['blocks'], key=lambda cell: cell[:2])
+    for row_idx, row_cells in itertools.groupby(merged, key=lambda cell: cell[0]):
+        row = {}
+        for _, col_idx, value, style in row_cells:
+            if col_idx in row:
+                previous_value, previous_style = row[col_idx]
+                value = previous_value if value is None else value
+                style = {**previous_style, **style}
+            row[col_idx] = (value, style)
+        yield row_idx, [(col_idx, value, style) for col_idx, (value, style) in sorted(row.items())]
+
+def add_formula_format(sheet, cell_range, formula, style):
+    """Style cells of a range where the formula (relative to its first cell) holds"""
+    sheet['rules'].append({'range': cell_range, 'formula': formula, 'style': style})
+
+def add_chart(sheet, anchor, kind, series, categories, title=None, x_title=None, y_title=None,
+              height=7.5, width=15, style=None, stacked=False, titles_from_data=True):
+    """Add a 'col', 'bar', 'line' or 'pie' chart
+
+    `series` lists (first_row, column, last_row) ranges, each headed by its title
+    when `titles_from_data`; `categories` is one such range. Sizes are in cm.
+    """
+    sheet['charts'].append({'anchor': anchor, 'kind': kind, 'series': series, 'categories': categories,
+                            'title': title, 'x_title': x_title, 'y_title': y_title, 'height': height,
+                            'width': width, 'style': style, 'stacked': stacked,
+                            'titles_from_data': titles_from_data})
+
+def _openpyxl_style(style):
+    from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+    attrs = {}
+    font = {key: style[key] for key in ('bold', 'italic', 'size', 'color') if key in style}
+    if font:
+        attrs['font'] = Font(**font)
+    if 'fill' in style:
+        attrs['fill'] = PatternFill(start_color=style['fill'], end_color=style['fill'], fill_type='solid')
+    if style.get('border'):
+        side = Side(style='thin')
+        attrs['border'] = Border(left=side, right=side, top=side, bottom=side)
+    if 'align' in style or 'valign' in style:
+        attrs['alignment'] = Alignment(horizontal=style.get('align'), vertical=style.get('valign'))
+    return attrs
+
+def _openpyxl_chart(ws, chart):
+    from openpyxl.chart import BarChart, LineChart, PieChart, Reference
+    if chart['kind'] == 'pie':
+        obj = PieChart()
+    elif chart['kind'] == 'line':
+        obj = LineChart()
+    else:
+        obj = BarChart()
+        obj.type = chart['kind']
+        if chart['stacked']:
+            obj.grouping = 'stacked'
+            obj.overlap = 100
+    if chart['style'] is not None:
+        obj.style = chart['style']
+    obj.title = chart['title']
+    if chart['kind'] != 'pie':
+        obj.x_axis.title = chart['x_title']
+        obj.y_axis.title = chart['y_title']
+
+    for first_row, col_idx, last_row in chart['series']:
+        obj.add_data(Reference(ws, min_col=col_idx, min_row=first_row, max_row=last_row),
+                     titles_from_data=chart['titles_from_data'])
+    first_row, col_idx, last_row = chart['categories']
+    obj.set_categories(Reference(ws, min_col=col_idx, min_row=first_row, max_row=last_row))
+    obj.height = chart['height']
+    obj.width = chart['width']
+    ws.add_chart(obj, chart['anchor'])
+
+def write_openpyxl(sheets, filepath, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Build the whole workbook in openpyxl's object model, then save it"""
+    from copy import copy
+    from openpyxl import Workbook
+    from openpyxl.formatting.rule import FormulaRule
+    wb = Workbook()
+    styled = {}  # style key -> style array of the first cell using it
+    for sheet_idx, sheet in enumerate(sheets):
+        ws = wb.active if sheet_idx == 0 else wb.create_sheet()
+        ws.title = sheet['title']
+        for row_idx, row in sheet_rows(sheet):
+            for col_idx, value, style in row:
+                target = ws.cell(row=row_idx, column=col_idx, value=value)
+                if not style:
+                    continue
+                key = tuple(sorted(style.items()))
+                if key in styled:
+                    target._style = copy(styled[key])
+                else:
+                    for attr, attr_value in _openpyxl_style(style).items():
+                        setattr(target, attr, attr_value)
+                    styled[key] = target._style
+        for first_row, first_col, last_row, last_col in sheet['merges']:
+            ws.merge_cells(start_row=first_row, start_column=first_col, end_row=last_row, end_column=last_col)
+        for col_idx, width in sheet['widths'].items():
+            ws.column_dimensions[_column_letter(col_idx)].width = width
+        for rule in sheet['rules']:
+            ws.conditional_formatting.add(rule['range'], FormulaRule(formula=[rule['formula']],
+                                                                     **_openpyxl_style(rule['style'])))
+        for chart in sheet['charts']:
+            _openpyxl_chart(ws, chart)
+    save_workbook(wb, filepath, compresslevel)
+
+def _xlsxwriter_format(workbook, formats, style):
+    """Shared xlsxwriter format for a style, created on first use"""
+    if not style:
+        return None
+    key = tuple(sorted(style.items()))
+    if key not in formats:
+        props = {}
+        for name, prop in (('bold', 'bold'), ('italic', 'italic'), ('size', 'font_size')):
+            if name in style:
+                props[prop] = style[name]
+        if 'color' in style:
+            props['font_color'] = '#' + style['color']
+        if 'fill' in style:
+            props.update(pattern=1, bg_color='#' + style['fill'])
+        if style.get('border'):
+            props['border'] = 1
+        if 'align' in style:
+            props['align'] = style['align']
+        if 'valign' in style:
+            props['valign'] = {'center': 'vcenter'}.get(style['valign'], style['valign'])
+        formats[key] = workbook.add_format(props)
+    return formats[key]
+
+def _xlsxwriter_chart(workbook, worksheet, chart):
+    kind = {'col': 'column', 'bar': 'bar', 'line': 'line', 'pie': 'pie'}[chart['kind']]
+    obj = workbook.add_chart({'type': kind, **({'subtype': 'stacked'} if chart['stacked'] else {})})
+    name = worksheet.get_name()
+    titled = int(chart['titles_from_data'])
+    cat_first, cat_col, cat_last = chart['categories']
+    for first_row, col_idx, last_row in chart['series']:
+        series = {'values': [name, first_row - 1 + titled, col_idx - 1, last_row - 1, col_idx - 1],
+                  'categories': [name, cat_first - 1, cat_col - 1, cat_last - 1, cat_col - 1]}
+        if titled:
+            series['name'] = [name, first_row - 1, col_idx - 1]
+        obj.add_series(series)
+    if chart['title']:
+        obj.set_title({'name': chart['title']})
+    if chart['kind'] != 'pie':
+        obj.set_x_axis({'name': chart['x_title']} if chart['x_title'] else {})
+        obj.set_y_axis({'name': chart['y_title']} if chart['y_title'] else {})
+    if chart['style'] is not None:
+        obj.set_style(chart['style'])
+    obj.set_size({'width': round(chart['width'] * 96 / 2.54), 'height': round(chart['height'] * 96 / 2.54)})
+    worksheet.insert_chart(chart['anchor'], obj)
+
+def write_xlsxwriter(sheets, filepath, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Stream the workbook with xlsxwriter in constant-memory mode
+
+    Rows are pulled from sheet_rows() one at a time and each finished row is
+    flushed to disk, so memory stays flat however large the row blocks are.
+    xlsxwriter zips the package itself at zlib's default level, so
+    `compresslevel` is ignored.
+    """
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(filepath, {'constant_memory': True})
+    formats = {}
+    for sheet in sheets:
+        worksheet = workbook.add_worksheet(sheet['title'])
+        for col_idx, width in sheet['widths'].items():
+            worksheet.set_column(col_idx - 1, col_idx - 1, width)
+
+        merges = {(first_row, first_col): (last_row, last_col)
+                  for first_row, first_col, last_row, last_col in sheet['merges']}
+        covered = {(row_idx, col_idx)
+                   for (first_row, first_col), (last_row, last_col) in merges.items()
+                   for row_idx in range(first_row, last_row + 1)
+                   for col_idx in range(first_col, last_col + 1)} - set(merges)
+        for row_idx, row in sheet_rows(sheet):
+            for col_idx, value, style in row:
+                cell_format = _xlsxwriter_format(workbook, formats, style)
+                value = value.item() if hasattr(value, 'item') else value
+                if (row_idx, col_idx) in merges:
+                    last_row, last_col = merges[(row_idx, col_idx)]
+                    worksheet.merge_range(row_idx - 1, col_idx - 1, last_row - 1, last_col - 1,
+                                          value if value is not None else '', cell_format)
+                elif (row_idx, col_idx) in covered:
+                    continue
+                elif value is None:
+                    # Unstyled blanks are dropped by xlsxwriter; keep the row so templates can fill it
+                    worksheet.write_blank(row_idx - 1, col_idx - 1, None, cell_format)
+                    if cell_format is None:
+                        worksheet.set_row(row_idx - 1, None)
+                elif isinstance(value, float) and not math.isfinite(value):
+                    worksheet.write_blank(row_idx - 1, col_idx - 1, None, cell_format)
+                else:
+                    worksheet.write(row_idx - 1, col_idx - 1, value, cell_format)
+
+        for rule in sheet['rules']:
+            worksheet.conditional_format(rule['range'], {
+                'type': 'formula', 'criteria': '=' + rule['formula'],
+                'format': _xlsxwriter_format(workbook, formats, rule['style'])})
+        for chart in sheet['charts']:
+            _xlsxwriter_chart(workbook, worksheet, chart)
+    workbook.close()
+
+WRITER_BACKENDS = {'openpyxl': write_openpyxl, 'xlsxwriter': write_xlsxwriter}
+DEFAULT_WRITER = 'openpyxl'
+# Backends that stream cells to disk; filling a template would hold the sheets in
+# memory instead, so reports for these (or larger than TEMPLATE_MAX_CELLS) are rendered
+STREAMING_WRITERS = {'xlsxwriter'}
+TEMPLATE_MAX_CELLS = 100000
+
+def _report_styles():
+    # Styling
+    return {
+        'header_font': {'bold': True, 'size': 14, 'color': "FFFFFF"},
+        'header_fill': {'fill': "2B579A"},
+        'subheader_font': {'bold': True, 'size': 12},
+        'table_header_fill': {'fill': "D9D9D9"},
+        'border': {'border': True}
+    }
 
-    ws_qof['A1'] = "QUALITY OUTCOMES FRAMEWORK (QOF) PERFORMANCE"
-    ws_qof['A1'].font = header_font
-    ws_qof['A1'].fill = header_fill
-    ws_qof.merge_cells('A1:F1')
+def _sheet_header(sheet, styles, title, merge_range):
+    put_cell(sheet, 'A1', title, {**styles['header_font'], **styles['header_fill']})
+    merge_cells(sheet, merge_range)
 
-    ws_qof['A3'] = 'Indicator'
-    ws_qof['B3'] = 'Achievement'
-    ws_qof['C3'] = 'Target'
-    ws_qof['D3'] = 'Points'
-    ws_qof['E3'] = 'Exception %'
-    ws_qof['F3'] = 'Status'
+def _table_headers(sheet, styles, row, headers, first_col='A'):
+    for col, title in zip(_column_letters(first_col, len(headers)), headers):
+        put_cell(sheet, f'{col}{row}', title, {'bold': True, **styles['table_header_fill']})
 
-    for col in ['A3', 'B3', 'C3', 'D3', 'E3', 'F3']:
-        ws_qof[col].font = Font(bold=True)
-        ws_qof[col].fill = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
+def _column_letters(first_col, count):
+    start = _column_index(first_col)
+    return [_column_letter(col_idx) for col_idx in range(start, start + count)]
 
-    for idx, row in qof_df.iterrows():
-        ws_qof[f'A{idx+4}'] = row['indicator_code']
-        ws_qof[f'B{idx+4}'] = f"{row['Achievement Rate']:.1f}%"
-        ws_qof[f'C{idx+4}'] = f"{row['target_percentage']:.1f}%"
-        ws_qof[f'D{idx+4}'] = f"{row['achievement_points']:.1f}"
-        ws_qof[f'E{idx+4}'] = f"{row['exception_reporting']:.1f}%"
-        ws_qof[f'F{idx+4}'] = '✓ Met' if row['Target Met'] else '✗ Not Met'
+def _chart_data_header(sheet, col, row, headers):
+    put_cell(sheet, f'{col}{row}', 'Chart Data', {'bold': True})
+    for header_col, header in zip(_column_letters(col, len(headers)), headers):
+        put_cell(sheet, f'{header_col}{row+1}', header)
+
+def _padded_headers(headers, width):
+    """Headers followed by blanks for the interval columns a preview adds; their cells name them"""
+    return headers + [None] * (width - len(headers))
+
+def _extra_headers(row, df, known):
+    """Header cells naming the columns a preview adds after the `known` columns of a table"""
+    extra = [column for column in df.columns if column not in known]
+    return {f'{col}{row}': column for col, column in zip(_column_letters(_column_letter(len(known) + 2), len(extra)), extra)}
+
+def _layout_executive_summary(sheet, shape, styles):
+    # Title
+    put_cell(sheet, 'A1', "NHS Integration Platform - Clinical Dashboard Report", {'bold': True, 'size': 16})
+    merge_cells(sheet, 'A1:H1')
 
-        if row['Target Met']:
-            ws_qof[f'F{idx+4}'].font = Font(color="008000", bold=True)
-        else:
-            ws_qof[f'F{idx+4}'].font = Font(color="FF0000", bold=True)
+    # Key Metrics
+    put_cell(sheet, 'A6', "KEY PERFORMANCE INDICATORS", {**styles['header_font'], **styles['header_fill']})
+    merge_cells(sheet, 'A6:D6')
 
-    # Add Charts to existing sheets
+    _table_headers(sheet, styles, 8, ['Metric', 'Value', 'Target', 'Status'])
+    for col in 'ABCD':
+        for row in range(8, 9 + shape['metrics'][0]):
+            put_cell(sheet, f'{col}{row}', style=styles['border'])
 
-    # Add pie chart to Patient Demographics sheet
+    # Add line chart for appointment trends
+    summary_chart_row = 8
+    num_months = shape['monthly_appts'][0]
+    _chart_data_header(sheet, 'F', summary_chart_row, ['Month', 'Appointments'])
+    add_chart(sheet, "A17", 'line',
+              series=[(summary_chart_row+1, 7, summary_chart_row+1+num_months)],
+              categories=(summary_chart_row+2, 6, summary_chart_row+1+num_months),
+              title="6-Month Appointment Trends", x_title='Month', y_title='Appointments',
+              height=9, width=12, style=13)
+
+def _cells_executive_summary(nodes):
+    now = nodes['generated']
+    cells = {
+        'A3': f"Report Generated: {now.strftime('%Y-%m-%d %H:%M')}",
+        'A4': f"Reporting Period: {(now - timedelta(days=365)).strftime('%Y-%m-%d')} to {now.strftime('%Y-%m-%d')}"
+    }
+    if nodes['preview_note']:
+        cells['A5'] = nodes['preview_note']
+    for row_idx, row_data in enumerate(nodes['metrics'], start=9):
+        for col, value in zip('ABCD', row_data):
+            cells[f'{col}{row_idx}'] = value
+
+    summary_chart_row = 8
+    for idx, (month, count) in enumerate(nodes['monthly_appts'].items(), start=1):
+        cells[f'F{summary_chart_row+1+idx}'] = month
+        cells[f'G{summary_chart_row+1+idx}'] = count
+    return cells
+
+def _layout_patient_demographics(sheet, shape, styles):
+    _sheet_header(sheet, styles, "PATIENT DEMOGRAPHICS ANALYSIS", 'A1:F1')
+    put_cell(sheet, 'A3', "Age Distribution", styles['subheader_font'])
+    put_cell(sheet, 'E3', "Gender Distribution", styles['subheader_font'])
+
+    # Add pie chart of the age distribution
     # Put chart data at the top, then chart below to avoid overlap
     demo_chart_data_row = 10
-    ws_demo[f'J{demo_chart_data_row}'] = 'Chart Data'
-    ws_demo[f'J{demo_chart_data_row}'].font = Font(bold=True)
-    ws_demo[f'J{demo_chart_data_row+1}'] = 'Age Group'
-    ws_demo[f'K{demo_chart_data_row+1}'] = 'Count'
-    for idx, (age_group, count) in enumerate(age_dist.items(), start=1):
-        ws_demo[f'J{demo_chart_data_row+1+idx}'] = age_group
-        ws_demo[f'K{demo_chart_data_row+1+idx}'] = count
-
-    pie = PieChart()
-    labels = Reference(ws_demo, min_col=10, min_row=demo_chart_data_row+2, max_row=demo_chart_data_row+1+len(age_dist))
-    data = Reference(ws_demo, min_col=11, min_row=demo_chart_data_row+1, max_row=demo_chart_data_row+1+len(age_dist))
-    pie.add_data(data, titles_from_data=True)
-    pie.set_categories(labels)
-    pie.title = "Patient Age Distribution"
-    pie.height = 10
-    pie.width = 15
-    ws_demo.add_chart(pie, "A20")
-
-    # Add bar chart to Clinical Conditions sheet
-    # Place chart data first, then chart below
+    num_groups = shape['age_dist'][0]
+    _chart_data_header(sheet, 'J', demo_chart_data_row, ['Age Group', 'Count'])
+    add_chart(sheet, "A20", 'pie',
+              series=[(demo_chart_data_row+1, 11, demo_chart_data_row+1+num_groups)],
+              categories=(demo_chart_data_row+2, 10, demo_chart_data_row+1+num_groups),
+              title="Patient Age Distribution", height=10, width=15)
+
+def _cells_patient_demographics(nodes):
+    cells = {}
+    patient_count = nodes['patients']
+    for row, (age_group, count) in enumerate(nodes['age_dist'].items(), start=4):
+        cells[f'A{row}'] = age_group
+        cells[f'B{row}'] = count
+        cells[f'C{row}'] = f"{(count/patient_count*100):.1f}%"
+    for row, (gender, count) in enumerate(nodes['gender_dist'].items(), start=4):
+        cells[f'E{row}'] = gender
+        cells[f'F{row}'] = count
+        cells[f'G{row}'] = f"{(count/patient_count*100):.1f}%"
+
+    demo_chart_data_row = 10
+    for idx, (age_group, count) in enumerate(nodes['age_dist'].items(), start=1):
+        cells[f'J{demo_chart_data_row+1+idx}'] = age_group
+        cells[f'K{demo_chart_data_row+1+idx}'] = count
+    return cells
+
+def _layout_clinical_conditions(sheet, shape, styles):
+    _sheet_header(sheet, styles, "TOP 10 CLINICAL CONDITIONS", 'A1:D1')
+    _table_headers(sheet, styles, 3, ['Rank', 'Condition', 'Patient Count', 'Prevalence %'])
+
+    # Add bar chart, placing chart data first, then chart below
+    condition_chart_row = 3
+    _chart_data_header(sheet, 'F', condition_chart_row, ['Condition', 'Count'])
+    add_chart(sheet, "A16", 'col',
+              series=[(condition_chart_row+1, 7, condition_chart_row+6)],
+              categories=(condition_chart_row+2, 6, condition_chart_row+6),
+              title="Top 5 Clinical Conditions", x_title='Condition', y_title='Number of Patients',
+              height=10, width=15, style=10)
+
+def _cells_clinical_conditions(nodes):
+    cells = {}
+    condition_counts = nodes['condition_counts']
+    diagnosed_patients = nodes['diagnosed_patients']
+    for idx, (condition, count) in enumerate(condition_counts.items(), start=1):
+        cells[f'A{idx+3}'] = idx
+        cells[f'B{idx+3}'] = condition
+        cells[f'C{idx+3}'] = count
+        cells[f'D{idx+3}'] = f"{(count/diagnosed_patients*100):.1f}%"
+
     condition_chart_row = 3
-    ws_clinical[f'F{condition_chart_row}'] = 'Chart Data'
-    ws_clinical[f'F{condition_chart_row}'].font = Font(bold=True)
-    ws_clinical[f'F{condition_chart_row+1}'] = 'Condition'
-    ws_clinical[f'G{condition_chart_row+1}'] = 'Count'
     for idx, (condition, count) in enumerate(condition_counts.head(5).items(), start=1):
-        ws_clinical[f'F{condition_chart_row+1+idx}'] = condition[:20]
-        ws_clinical[f'G{condition_chart_row+1+idx}'] = count
-
-    bar = BarChart()
-    bar.type = "col"
-    bar.style = 10
-    bar.title = "Top 5 Clinical Conditions"
-    bar.y_axis.title = 'Number of Patients'
-    bar.x_axis.title = 'Condition'
-
-    data = Reference(ws_clinical, min_col=7, min_row=condition_chart_row+1, max_row=condition_chart_row+6)
-    cats = Reference(ws_clinical, min_col=6, min_row=condition_chart_row+2, max_row=condition_chart_row+6)
-    bar.add_data(data, titles_from_data=True)
-    bar.set_categories(cats)
-    bar.height = 10
-    bar.width = 15
-    ws_clinical.add_chart(bar, "A16")
-
-    # Add pie chart to Medications sheet
-    med_counts = meds_df['Medication'].value_counts().head(6)
+        cells[f'F{condition_chart_row+1+idx}'] = condition[:20]
+        cells[f'G{condition_chart_row+1+idx}'] = count
+    return cells
+
+def _layout_medication_analysis(sheet, shape, styles):
+    _sheet_header(sheet, styles, "MEDICATION PRESCRIBING PATTERNS", 'A1:E1')
+    _table_headers(sheet, styles, 3, ['Rank', 'Medication', 'Prescriptions', 'Avg Adherence', 'Status'])
+
+    # Add pie chart of the top prescriptions
+    med_chart_row = 3
+    med_chart_count = min(shape['med_counts'][0], 6)
+    _chart_data_header(sheet, 'G', med_chart_row, ['Medication', 'Count'])
+    add_chart(sheet, "A17", 'pie',
+              series=[(med_chart_row+1, 8, med_chart_row+1+med_chart_count)],
+              categories=(med_chart_row+2, 7, med_chart_row+1+med_chart_count),
+              title="Top Prescribed Medications", height=10, width=15)
+
+def _cells_medication_analysis(nodes):
+    cells = {}
+    med_summary = nodes['med_summary']
+    for idx, (med, count) in enumerate(nodes['med_counts'].items(), start=1):
+        cells[f'A{idx+3}'] = idx
+        cells[f'B{idx+3}'] = med
+        cells[f'C{idx+3}'] = count
+        cells[f'D{idx+3}'] = f"{(med_summary.at[med, 'avg_adherence']*100):.1f}%"
+        cells[f'E{idx+3}'] = f"{med_summary.at[med, 'active']}/{count} Active"
+
     med_chart_row = 3
-    ws_meds[f'G{med_chart_row}'] = 'Chart Data'
-    ws_meds[f'G{med_chart_row}'].font = Font(bold=True)
-    ws_meds[f'G{med_chart_row+1}'] = 'Medication'
-    ws_meds[f'H{med_chart_row+1}'] = 'Count'
-    for idx, (med, count) in enumerate(med_counts.items(), start=1):
-        ws_meds[f'G{med_chart_row+1+idx}'] = med[:25]
-        ws_meds[f'H{med_chart_row+1+idx}'] = count
-
-    pie2 = PieChart()
-    labels2 = Reference(ws_meds, min_col=7, min_row=med_chart_row+2, max_row=med_chart_row+1+len(med_counts))
-    data2 = Reference(ws_meds, min_col=8, min_row=med_chart_row+1, max_row=med_chart_row+1+len(med_counts))
-    pie2.add_data(data2, titles_from_data=True)
-    pie2.set_categories(labels2)
-    pie2.title = "Top Prescribed Medications"
-    pie2.height = 10
-    pie2.width = 15
-    ws_meds.add_chart(pie2, "A17")
-
-    # Add bar chart to QOF Performance sheet
+    for idx, (med, count) in enumerate(nodes['med_counts'].head(6).items(), start=1):
+        cells[f'G{med_chart_row+1+idx}'] = med[:25]
+        cells[f'H{med_chart_row+1+idx}'] = count
+    return cells
+
+def _layout_qof_performance(sheet, shape, styles):
+    _sheet_header(sheet, styles, "QUALITY OUTCOMES FRAMEWORK (QOF) PERFORMANCE", 'A1:F1')
+    _table_headers(sheet, styles, 3, ['Indicator', 'Achievement', 'Target', 'Points', 'Patients', 'Status'])
+
+    # Colour the status column by its value so the layout stays data independent
+    num_indicators = shape['qof'][0]
+    if num_indicators:
+        status_range = f"F4:F{3 + num_indicators}"
+        add_formula_format(sheet, status_range, 'LEFT(F4,1)="✓"', {'color': "008000", 'bold': True})
+        add_formula_format(sheet, status_range, 'LEFT(F4,1)="✗"', {'color': "FF0000", 'bold': True})
+
+    # Add bar chart of achievement against target
     qof_chart_row = 3
-    ws_qof[f'H{qof_chart_row}'] = 'Chart Data'
-    ws_qof[f'H{qof_chart_row}'].font = Font(bold=True)
-    ws_qof[f'H{qof_chart_row+1}'] = 'Indicator'
-    ws_qof[f'I{qof_chart_row+1}'] = 'Achievement'
-    ws_qof[f'J{qof_chart_row+1}'] = 'Target'
+    _chart_data_header(sheet, 'H', qof_chart_row, ['Indicator', 'Achievement', 'Target'])
+    add_chart(sheet, "A16", 'col',
+              series=[(qof_chart_row+1, 9, qof_chart_row+6), (qof_chart_row+1, 10, qof_chart_row+6)],
+              categories=(qof_chart_row+2, 8, qof_chart_row+6),
+              title="QOF Performance vs Targets", x_title='Indicator', y_title='Percentage',
+              height=10, width=15, style=12)
+
+def _cells_qof_performance(nodes):
+    cells = {}
+    qof_df = nodes['qof'].reset_index(drop=True)
+    for idx, row in qof_df.iterrows():
+        cells[f'A{idx+4}'] = row['indicator_code']
+        cells[f'B{idx+4}'] = f"{row['Achievement Rate']:.1f}%"
+        cells[f'C{idx+4}'] = f"{row['target_percentage']:.1f}%"
+        cells[f'D{idx+4}'] = f"{row['achievement_points']:.1f}"
+        cells[f'E{idx+4}'] = f"{row['numerator']}/{row['denominator']}"
+        cells[f'F{idx+4}'] = '✓ Met' if row['Target Met'] else '✗ Not Met'
 
+    qof_chart_row = 3
     for idx, row in qof_df.head(5).iterrows():
-        ws_qof[f'H{qof_chart_row+2+idx}'] = row['indicator_code']
-        ws_qof[f'I{qof_chart_row+2+idx}'] = row['Achievement Rate']
-        ws_qof[f'J{qof_chart_row+2+idx}'] = row['target_percentage']
-
-    bar2 = BarChart()
-    bar2.type = "col"
-    bar2.style = 12
-    bar2.title = "QOF Performance vs Targets"
-    bar2.y_axis.title = 'Percentage'
-    bar2.x_axis.title = 'Indicator'
-
-    data1 = Reference(ws_qof, min_col=9, min_row=qof_chart_row+1, max_row=qof_chart_row+6)
-    data2 = Reference(ws_qof, min_col=10, min_row=qof_chart_row+1, max_row=qof_chart_row+6)
-    cats = Reference(ws_qof, min_col=8, min_row=qof_chart_row+2, max_row=qof_chart_row+6)
-
-    bar2.add_data(data1, titles_from_data=True)
-    bar2.add_data(data2, titles_from_data=True)
-    bar2.set_categories(cats)
-    bar2.height = 10
-    bar2.width = 15
-    ws_qof.add_chart(bar2, "A16")
-
-    # Add line chart to Executive Summary for appointment trends
-    appt_df = data_dict['appointments'].copy()
-    appt_df['appointment_date'] = pd.to_datetime(appt_df['appointment_date'])
-    appt_df['month'] = appt_df['appointment_date'].dt.to_period('M')
-    monthly_appts = appt_df.groupby('month').size().tail(6)
+        cells[f'H{qof_chart_row+2+idx}'] = row['indicator_code']
+        cells[f'I{qof_chart_row+2+idx}'] = row['Achievement Rate']
+        cells[f'J{qof_chart_row+2+idx}'] = row['target_percentage']
+    return cells
+
+def _layout_test_results(sheet, shape, styles):
+    _sheet_header(sheet, styles, "TEST RESULTS OUTSIDE REFERENCE RANGE", 'A1:H1')
+    _table_headers(sheet, styles, 3, _padded_headers(['Test', 'Results', 'Evaluable', 'High', 'Low', 'Abnormal %',
+                                                      'Critical', 'Critical %'], shape['test_flags'][1] + 1))
+
+    # Add bar chart reading the table directly
+    num_tests = shape['test_flags'][0]
+    add_chart(sheet, f"A{num_tests + 6}", 'col',
+              series=[(3, col, 3+num_tests) for col in (6, 8)],
+              categories=(4, 1, 3+num_tests),
+              title="Abnormal and Critical Results by Test", x_title='Test', y_title='Percentage',
+              height=10, width=15, style=10)
+
+def _cells_test_results(nodes):
+    test_flags = nodes['test_flags']
+    columns = ['results', 'evaluable', 'high', 'low', 'abnormal_pct', 'critical', 'critical_pct']
+    cells = _extra_headers(3, test_flags, columns)
+    columns += [column for column in test_flags.columns if column not in columns]
+    for row_idx, (test, row) in enumerate(zip(test_flags.index, test_flags[columns].itertuples(index=False)), start=4):
+        for col, value in zip(_column_letters('A', len(columns) + 1), [test, *row]):
+            cells[f'{col}{row_idx}'] = value
+    return cells
+
+def _multimorbidity_rows(num_summary, num_pairs):
+    """Header rows of the condition pair and condition-medication tables"""
+    pairs_row = 4 + num_summary + 1
+    links_row = pairs_row + 2 + num_pairs + 1
+    return pairs_row, links_row
+
+def _layout_multimorbidity(sheet, shape, styles):
+    _sheet_header(sheet, styles, "MULTIMORBIDITY AND CO-PRESCRIBING", 'A1:F1')
+    put_cell(sheet, 'A3', "Multimorbidity", styles['subheader_font'])
+
+    num_pairs = shape['condition_pairs'][0]
+    num_links = shape['condition_medications'][0]
+    pairs_row, links_row = _multimorbidity_rows(shape['multimorbidity'][0], num_pairs)
+    put_cell(sheet, f'A{pairs_row}', "Most Common Condition Pairs", styles['subheader_font'])
+    _table_headers(sheet, styles, pairs_row + 1, ['Rank', 'Condition A', 'Condition B', 'Patients', '% of A', '% of B'])
+    put_cell(sheet, f'A{links_row}', "Most Common Condition → Medication Links", styles['subheader_font'])
+    _table_headers(sheet, styles, links_row + 1, ['Rank', 'Condition', 'Medication', 'Patients', '% of Condition'])
+
+    # Add bar chart of the top pairs
+    if num_pairs:
+        _chart_data_header(sheet, 'H', pairs_row, ['Condition Pair', 'Patients'])
+        add_chart(sheet, f"A{links_row + 2 + num_links + 2}", 'bar',
+                  series=[(pairs_row+1, 9, pairs_row+1+num_pairs)],
+                  categories=(pairs_row+2, 8, pairs_row+1+num_pairs),
+                  title="Most Common Condition Pairs", x_title='Condition Pair', y_title='Patients',
+                  height=10, width=15, style=10)
+
+def _cells_multimorbidity(nodes):
+    cells = {}
+    for row_idx, (label, value) in enumerate(nodes['multimorbidity'], start=4):
+        cells[f'A{row_idx}'] = label
+        cells[f'B{row_idx}'] = value
+
+    condition_pairs = nodes['condition_pairs']
+    pairs_row, links_row = _multimorbidity_rows(len(nodes['multimorbidity']), len(condition_pairs))
+    for idx, row in enumerate(condition_pairs.itertuples(index=False), start=1):
+        values = [idx, row.condition_a, row.condition_b, row.patients, f"{row.pct_of_a:.1f}%", f"{row.pct_of_b:.1f}%"]
+        for col, value in zip('ABCDEF', values):
+            cells[f'{col}{pairs_row+1+idx}'] = value
+        cells[f'H{pairs_row+1+idx}'] = f"{row.condition_a[:15]} + {row.condition_b[:15]}"
+        cells[f'I{pairs_row+1+idx}'] = row.patients
+
+    for idx, row in enumerate(nodes['condition_medications'].itertuples(index=False), start=1):
+        values = [idx, row.condition, row.medication, row.patients, f"{row.pct_of_condition:.1f}%"]
+        for col, value in zip('ABCDE', values):
+            cells[f'{col}{links_row+1+idx}'] = value
+    return cells
+
+def _layout_admissions(sheet, shape, styles):
+    _sheet_header(sheet, styles, "ADMISSIONS, READMISSIONS AND LENGTH OF STAY", 'A1:M1')
+    _table_headers(sheet, styles, 6, _padded_headers(['Ward', 'Admissions', 'Mean LOS', 'Median LOS', 'P90 LOS'] +
+                                                     los_band_labels() + ['Readmissions', 'Readmission %'],
+                                                     shape['ward_los'][1] + 1))
+
+    # Add stacked bar chart of the LOS bands reading the table directly
+    num_wards = shape['ward_los'][0]
+    add_chart(sheet, f"A{num_wards + 9}", 'col',
+              series=[(6, col, 6+num_wards) for col in range(6, 6 + len(LOS_BANDS))],
+              categories=(7, 1, 6+num_wards),
+              title="Length of Stay by Ward", x_title='Ward', y_title='Admissions',
+              height=10, width=15, style=10, stacked=True)
+
+def _cells_admissions(nodes):
+    ward_los = nodes['ward_los']
+    admissions, readmissions = ward_los['admissions'].sum(), ward_los['readmissions'].sum()
+    cells = {
+        'A3': f"Readmission window: {READMISSION_WINDOW_DAYS} days from the previous discharge",
+        'A4': f"Readmissions: {readmissions:,} of {admissions:,} admissions "
+              f"({readmissions / admissions * 100 if admissions else 0:.1f}%)"
+    }
+    columns = ['admissions', 'mean_los', 'median_los', 'p90_los'] + los_band_labels() + ['readmissions', 'readmission_pct']
+    cells.update(_extra_headers(6, ward_los, columns))
+    columns += [column for column in ward_los.columns if column not in columns]
+    for row_idx, (ward, row) in enumerate(zip(ward_los.index, ward_los[columns].itertuples(index=False)), start=7):
+        for col, value in zip(_column_letters('A', len(columns) + 1), [ward, *row]):
+            cells[f'{col}{row_idx}'] = value
+    return cells
+
+# Sheets of the human-friendly report in workbook order
+REPORT_SECTIONS = [
+    {'sheet': 'Executive Summary', 'needs': ['generated', 'preview_note', 'metrics', 'monthly_appts'],
+     'layout': _layout_executive_summary, 'cells': _cells_executive_summary},
+    {'sheet': 'Patient Demographics', 'needs': ['patients', 'age_dist', 'gender_dist'],
+     'layout': _layout_patient_demographics, 'cells': _cells_patient_demographics},
+    {'sheet': 'Clinical Conditions', 'needs': ['diagnosed_patients', 'condition_counts'],
+     'layout': _layout_clinical_conditions, 'cells': _cells_clinical_conditions},
+    {'sheet': 'Medication Analysis', 'needs': ['med_counts', 'med_summary'],
+     'layout': _layout_medication_analysis, 'cells': _cells_medication_analysis},
+    {'sheet': 'QOF Performance', 'needs': ['qof'],
+     'layout': _layout_qof_performance, 'cells': _cells_qof_performance},
+    {'sheet': 'Test Results', 'needs': ['test_flags'],
+     'layout': _layout_test_results, 'cells': _cells_test_results},
+    {'sheet': 'Admissions', 'needs': ['ward_los'],
+     'layout': _layout_admissions, 'cells': _cells_admissions},
+    {'sheet': 'Multimorbidity', 'needs': ['multimorbidity', 'condition_pairs', 'condition_medications'],
+     'layout': _layout_multimorbidity, 'cells': _cells_multimorbidity}
+]
+
+def select_sections(sheets=None):
+    """Return the report sections for the requested sheet titles, in workbook order"""
+    if not sheets:
+        return list(REPORT_SECTIONS)
+    known = {section['sheet'] for section in REPORT_SECTIONS}
+    unknown = [sheet for sheet in sheets if sheet not in known]
+    if unknown:
+        raise ValueError(f"Unknown report sheets: {', '.join(unknown)}")
+    return [section for section in REPORT_SECTIONS if section['sheet'] in sheets]
+
+def plan_report(sections):
+    """Resolve the nodes the sections depend on, in dependency order, and the raw
+    columns they read per table"""
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Report node cycle through {name}")
+        visiting.add(name)
+        for dependency in REPORT_NODES[name].get('needs', []):
+            visit(dependency)
+        visiting.discard(name)
+        order.append(name)
+
+    for section in sections:
+        for name in section['needs']:
+            visit(name)
+
+    columns = {}
+    for name in order:
+        for table, table_columns in REPORT_NODES[name].get('inputs', {}).items():
+            columns.setdefault(table, [])
+            columns[table] += [column for column in table_columns if column not in columns[table]]
+    return order, columns
+
+def evaluate_report(data_dict, sheets=None, chart_max_points=CHART_MAX_POINTS, preview_budget=None):
+    """Compute only what the requested sheets need, sharing common intermediates
+
+    With `preview_budget` (seconds) the nodes come from a stratified patient
+    sample sized so the computation fits the budget.
+    """
+    started = time.perf_counter()
+    sections = select_sections(sheets)
+    order, columns = plan_report(sections)
+    if preview_budget is not None:
+        # Patient ids let the sampled patients be followed into every table
+        columns = {table: table_columns + ['patient_id'] if 'patient_id' in data_dict[table] and
+                   'patient_id' not in table_columns else table_columns
+                   for table, table_columns in columns.items()}
+    frames = {table: data_dict[table][table_columns] for table, table_columns in columns.items()}
+
+    options = {'chart_max_points': chart_max_points}
+    if preview_budget is None:
+        return sections, compute_nodes(order, frames, options)
+    return sections, preview_nodes(order, frames, data_dict['demographics'], options,
+                                   preview_budget - (time.perf_counter() - started))
+
+def report_shape(sections, nodes):
+    """Describe the size of every data block; reports of equal shape share a template"""
+    import numpy as np
+    return {
+        section['sheet']: {name: list(np.shape(nodes[name])) for name in section['needs']}
+        for section in sections
+    }
 
-    summary_chart_row = 8
-    ws_summary[f'F{summary_chart_row}'] = 'Chart Data'
-    ws_summary[f'F{summary_chart_row}'].font = Font(bold=True)
-    ws_summary[f'F{summary_chart_row+1}'] = 'Month'
-    ws_summary[f'G{summary_chart_row+1}'] = 'Appointments'
-    for idx, (month, count) in enumerate(monthly_appts.items(), start=1):
-        ws_summary[f'F{summary_chart_row+1+idx}'] = str(month)[-7:]  # Show only YYYY-MM
-        ws_summary[f'G{summary_chart_row+1+idx}'] = count
-
-    line = LineChart()
-    line.title = "6-Month Appointment Trends"
-    line.style = 13
-    line.y_axis.title = 'Appointments'
-    line.x_axis.title = 'Month'
-
-    data = Reference(ws_summary, min_col=7, min_row=summary_chart_row+1, max_row=summary_chart_row+1+len(monthly_appts))
-    cats = Reference(ws_summary, min_col=6, min_row=summary_chart_row+2, max_row=summary_chart_row+1+len(monthly_appts))
-    line.add_data(data, titles_from_data=True)
-    line.set_categories(cats)
-    line.height = 9
-    line.width = 12
-    ws_summary.add_chart(line, "A17")
-
-    # Format column widths - simplified approach
-    for sheet in wb.worksheets:
+def build_report_layout(shape):
+    """Lay out everything that does not depend on the data: titles, merged headers,
+    header fills, borders on the data ranges and charts bound to those ranges"""
+    styles = _report_styles()
+    layouts = {section['sheet']: section['layout'] for section in REPORT_SECTIONS}
+    sheets = []
+    for title, sheet_shape in shape.items():
+        sheet = new_sheet(title)
+        layouts[title](sheet, sheet_shape, styles)
+
+        # Format column widths - simplified approach
         # Set reasonable default widths for common columns
-        for col in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L']:
-            sheet.column_dimensions[col].width = 15
+        sheet['widths'] = {col_idx: 15 for col_idx in range(1, 13)}
+        sheets.append(sheet)
+    return sheets
+
+def report_cells(sections, nodes):
+    """Map every data cell of the human-friendly report to its value, per sheet"""
+    return {section['sheet']: section['cells'](nodes) for section in sections}
+
+def render_human_friendly_report(sections, nodes, filepath, writer=DEFAULT_WRITER,
+                                 compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Write the human-friendly report directly with the chosen writer backend"""
+    sheets = build_report_layout(report_shape(sections, nodes))
+    cells = report_cells(sections, nodes)
+    for sheet in sheets:
+        add_values(sheet, cells[sheet['title']])
+    WRITER_BACKENDS[writer](sheets, filepath, compresslevel)
+
+def load_report_template(shape, writer=DEFAULT_WRITER):
+    """Return the serialized template for a report shape, building it on first use
+
+    Templates are cached in memory and under report-templates/ so batch runs
+    only pay for titles, styles and charts once per distinct shape; the least
+    recently used beyond TEMPLATE_CACHE_SIZE are dropped.
+    """
+    key = hashlib.sha1(json.dumps([REPORT_TEMPLATE_VERSION, writer, shape], sort_keys=True).encode()).hexdigest()[:16]
+    if key in _template_cache:
+        _template_cache[key] = _template_cache.pop(key)  # most recently used last
+        return _template_cache[key]
+
+    template_path = os.path.join(template_folder, f'nhs-report-{key}.xlsx')
+    if os.path.exists(template_path):
+        os.utime(template_path)  # mark as recently used for _evict_templates
+    else:
+        # Write under a temporary name and move it into place in one step, so a
+        # crash or a concurrent worker never leaves a partial template behind
+        os.makedirs(template_folder, exist_ok=True)
+        partial_path = f'{template_path}.{os.getpid()}.tmp'
+        WRITER_BACKENDS[writer](build_report_layout(shape), partial_path, INTERMEDIATE_COMPRESSLEVEL)
+        os.replace(partial_path, template_path)
+        _evict_templates()
+
+    with zipfile.ZipFile(template_path) as archive:
+        parts = {info.filename: archive.read(info) for info in archive.infolist()}
+
+    template = {'parts': parts, 'sheets': _worksheet_parts(parts)}
+    _template_cache[key] = template
+    while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+        del _template_cache[next(iter(_template_cache))]
+    return template
+
+def _evict_templates():
+    """Delete all but the TEMPLATE_CACHE_SIZE most recently used templates under report-templates/"""
+    templates = sorted((entry for entry in os.scandir(template_folder)
+                        if entry.name.startswith('nhs-report-') and entry.name.endswith('.xlsx')),
+                       key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in templates[TEMPLATE_CACHE_SIZE:]:
+        os.remove(entry.path)
+
+def _worksheet_parts(parts):
+    """Map sheet titles to their XML part names inside an xlsx package"""
+    targets = {}
+    for rel in re.findall(r'<Relationship\b[^>]*?>', parts['xl/_rels/workbook.xml.rels'].decode()):
+        rel_id = re.search(r'\bId="([^"]+)"', rel).group(1)
+        target = re.search(r'\bTarget="([^"]+)"', rel).group(1)
+        targets[rel_id] = target.lstrip('/') if target.startswith('/') else 'xl/' + target
+
+    sheets = {}
+    for sheet in re.findall(r'<sheet\b[^>]*?>', parts['xl/workbook.xml'].decode()):
+        title = xml_unescape(re.search(r'\bname="([^"]*)"', sheet).group(1), {'&quot;': '"'})
+        sheets[title] = targets[re.search(r'\br:id="([^"]+)"', sheet).group(1)]
+    return sheets
+
+_ROW_XML = re.compile(r'<row r="(\d+)"([^>]*?)(?:/>|>(.*?)</row>)', re.S)
+_CELL_XML = re.compile(r'<c r="([A-Z]+)\d+"([^>]*?)(?:/>|>.*?</c>)', re.S)
+_STYLE_ATTR = re.compile(r'\bs="(\d+)"')
+
+def _column_letter(col_idx):
+    letters = ''
+    while col_idx:
+        col_idx, remainder = divmod(col_idx - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def _column_index(letters):
+    col_idx = 0
+    for letter in letters:
+        col_idx = col_idx * 26 + ord(letter) - 64
+    return col_idx
+
+def _cell_xml(ref, style, value):
+    """Serialize one cell, using inline strings so sharedStrings stays untouched"""
+    style_attr = f' s="{style}"' if style else ''
+    if hasattr(value, 'item'):  # NumPy scalars
+        value = value.item()
+    if value is None or (isinstance(value, float) and not math.isfinite(value)):
+        return f'<c r="{ref}"{style_attr}/>'
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{style_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"{style_attr} t="n"><v>{value!r}</v></c>'
+    text = xml_escape(str(value))
+    return f'<c r="{ref}"{style_attr} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def _fill_sheet_xml(sheet_xml, sheet_cells):
+    """Write data cells into a template sheet, keeping any styles laid out for them"""
+    by_row = {}
+    for coordinate, value in sheet_cells.items():
+        letters, row_idx = re.match(r'([A-Z]+)(\d+)$', coordinate).groups()
+        row_idx, col_idx = int(row_idx), _column_index(letters)
+        by_row.setdefault(row_idx, {})[col_idx] = value
+
+    def fill_row(match):
+        row_idx = int(match.group(1))
+        if row_idx not in by_row:
+            return match.group(0)
+        row_cells = {_column_index(cell.group(1)): cell.group(0)
+                     for cell in _CELL_XML.finditer(match.group(3) or '')}
+        for col_idx, value in by_row.pop(row_idx).items():
+            style = _STYLE_ATTR.search(row_cells.get(col_idx, ''))
+            row_cells[col_idx] = _cell_xml(f'{_column_letter(col_idx)}{row_idx}',
+                                           style.group(1) if style else None, value)
+        return f'<row r="{row_idx}"{match.group(2)}>' + ''.join(row_cells[col] for col in sorted(row_cells)) + '</row>'
+
+    sheet_xml = _ROW_XML.sub(fill_row, sheet_xml)
+    if by_row:
+        # Rows the layout never touched: append them in order after the existing ones
+        new_rows = ''.join(
+            f'<row r="{row_idx}">' + ''.join(_cell_xml(f'{_column_letter(col_idx)}{row_idx}', None, row_cells[col_idx])
+                                             for col_idx in sorted(row_cells)) + '</row>'
+            for row_idx, row_cells in sorted(by_row.items()))
+        sheet_xml = _insert_rows(sheet_xml, new_rows)
+    return sheet_xml
+
+def _insert_rows(sheet_xml, new_rows):
+    """Merge serialized rows into sheetData keeping rows sorted by index"""
+    rows = {int(match.group(1)): match.group(0) for match in _ROW_XML.finditer(sheet_xml)}
+    rows.update({int(match.group(1)): match.group(0) for match in _ROW_XML.finditer(new_rows)})
+    sheet_data = '<sheetData>' + ''.join(rows[row_idx] for row_idx in sorted(rows)) + '</sheetData>'
+    sheet_xml = re.sub(r'<sheetData>.*?</sheetData>|<sheetData\s*/>', lambda _: sheet_data, sheet_xml, count=1, flags=re.S)
+    return re.sub(r'<dimension ref="[^"]*"\s*/>', '', sheet_xml, count=1)
+
+def fill_report_template(template, cells, filepath, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Clone a serialized template and fill only its data ranges"""
+    filled = {}
+    for title, sheet_cells in cells.items():
+        part = template['sheets'][title]
+        filled[part] = _fill_sheet_xml(template['parts'][part].decode(), sheet_cells).encode()
+
+    write_zip_parts({name: filled.get(name, data) for name, data in template['parts'].items()},
+                    filepath, compresslevel)
+
+def create_human_friendly_report(data_dict, filepath, sheets=None, use_template=True, chart_max_points=CHART_MAX_POINTS,
+                                 writer=DEFAULT_WRITER, preview_budget=None, compresslevel=DOWNLOAD_COMPRESSLEVEL):
+    """Transform raw data into human-friendly report with charts
+
+    `sheets` limits the report to those sheet titles; only the aggregates they
+    depend on are computed. `writer` names the backend in WRITER_BACKENDS that
+    writes the workbook (or template); `use_template` is ignored for
+    STREAMING_WRITERS and reports over TEMPLATE_MAX_CELLS cells, which are
+    always rendered directly. With `preview_budget` (seconds) a preview
+    is built from a stratified patient sample; the file is replaced in one step,
+    so a later full run supersedes it. `compresslevel` is the deflate level of
+    the full report; previews are short-lived and use INTERMEDIATE_COMPRESSLEVEL.
+    """
+    sections, nodes = evaluate_report(data_dict, sheets=sheets, chart_max_points=chart_max_points,
+                                      preview_budget=preview_budget)
 
     # Save the workbook
-    wb.save(filepath)
-    print(f"Human-friendly report saved to {filepath}")
+    partial_path = os.path.splitext(filepath)[0] + '.partial.xlsx'
+    if preview_budget is not None:
+        compresslevel = INTERMEDIATE_COMPRESSLEVEL
+    cells = report_cells(sections, nodes)
+    if use_template and writer not in STREAMING_WRITERS and sum(map(len, cells.values())) <= TEMPLATE_MAX_CELLS:
+        fill_report_template(load_report_template(report_shape(sections, nodes), writer), cells,
+                             partial_path, compresslevel)
+    else:
+        render_human_friendly_report(sections, nodes, partial_path, writer, compresslevel)
+    os.replace(partial_path, filepath)
+    print(f"{'Preview' if preview_budget is not None else 'Human-friendly'} report saved to {filepath}")
+
+def main(argv=None):
+    from concurrent.futures import ProcessPoolExecutor
+    parser = argparse.ArgumentParser(description="NHS Integration Platform - Report Generator")
+    parser.add_argument('--sheets', help="Comma-separated report sheets to build, e.g. "
+                                         "\"QOF Performance,Executive Summary\" (default: all)")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="Write the raw input file in the background while the report is built")
+    parser.add_argument('--writer', choices=sorted(WRITER_BACKENDS), default=DEFAULT_WRITER,
+                        help=f"Workbook writer backend (default: {DEFAULT_WRITER})")
+    parser.add_argument('--compresslevel', type=int, choices=range(10), default=DOWNLOAD_COMPRESSLEVEL, metavar='0-9',
+                        help=f"Deflate level of the report (default: {DOWNLOAD_COMPRESSLEVEL}); the raw input file "
+                             f"always uses {INTERMEDIATE_COMPRESSLEVEL}")
+    parser.add_argument('--preview', type=float, nargs='?', const=PREVIEW_BUDGET, metavar='SECONDS',
+                        help="First write a preview report from a stratified sample within this time budget "
+                             f"(default: {PREVIEW_BUDGET:g}), then replace it with the full report")
+    args = parser.parse_args(argv)
+    sheets = [sheet.strip() for sheet in args.sheets.split(',')] if args.sheets else None
+    try:
+        select_sections(sheets)
+    except ValueError as e:
+        parser.error(str(e))
 
-def main():
     print("NHS Integration Platform - Report Generator")
     print("=" * 50)
 
@@ -523,14 +1856,34 @@ def main():
     print("\n1. Generating raw NHS data...")
     raw_data = generate_raw_data()
 
-    # Save raw data to input file
+    os.makedirs(public_folder, exist_ok=True)
     input_file = os.path.join(public_folder, 'input-report.xlsx')
-    save_raw_data(raw_data, input_file)
-
-    # Create human-friendly report
-    print("\n2. Creating human-friendly report with visualizations...")
     output_file = os.path.join(public_folder, 'sample-report.xlsx')
-    create_human_friendly_report(raw_data, output_file)
+    if args.pipelined:
+        # The report reads raw_data in memory, so the raw workbook can be serialized concurrently
+        print("\n2. Writing raw data in the background and creating human-friendly report...")
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            raw_future = executor.submit(save_raw_data, raw_data, input_file)
+            if args.preview is not None:
+                create_human_friendly_report(raw_data, output_file, sheets=sheets, writer=args.writer,
+                                             preview_budget=args.preview)
+            create_human_friendly_report(raw_data, output_file, sheets=sheets, writer=args.writer,
+                                         compresslevel=args.compresslevel)
+            raw_future.result()
+    else:
+        if args.preview is not None:
+            # Built from raw_data in memory, so the draft is ready before the raw file is written
+            print("\n   Building a preview report from a sample of the raw data...")
+            create_human_friendly_report(raw_data, output_file, sheets=sheets, writer=args.writer,
+                                         preview_budget=args.preview)
+
+        # Save raw data to input file
+        save_raw_data(raw_data, input_file)
+
+        # Create human-friendly report
+        print("\n2. Creating human-friendly report with visualizations...")
+        create_human_friendly_report(raw_data, output_file, sheets=sheets, writer=args.writer,
+                                     compresslevel=args.compresslevel)
 
     print("\n" + "=" * 50)
     print("Report generation complete!")
@@ -547,7 +1900,7 @@ def main():
     print(f"- Total appointments: {len(raw_data['appointments'])}")
     print(f"- Total test results: {len(raw_data['test_results'])}")
     print(f"- Total admissions: {len(raw_data['admissions'])}")
-    print(f"- QOF indicators tracked: {len(raw_data['qof_metrics'])}")
+    print(f"- QOF indicators tracked: {len(QOF_INDICATORS)}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file